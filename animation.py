@@ -0,0 +1,134 @@
+"""Renders an animation of a scene seen from a moving camera
+
+The scene is loaded and built once, with its BVH and the meshes' trees, and every frame only swaps the camera
+(Scene.with_camera), so a frame costs little more than tracing its rays. With workers > 1 the frames are
+rendered in parallel by a pool of processes that receive the scene once, when they start.
+
+    python animation.py scene.json "frames/frame_%04d.png" --turntable 48 [--workers 4]
+    python animation.py scene.json "frames/frame_%04d.ppm" --keyframes camera.json
+
+Keyframe files hold {"frames": number of frames, "keyframes": [{"frame": 0, "eye": [x, y, z],
+"look_at": [x, y, z], "up": [x, y, z]}, ...]}, the camera moves linearly between keyframes
+and fields missing from a keyframe keep their previous value.
+"""
+from __future__ import annotations
+from components import Camera, Image, Point, Scene, Vector3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from engine import RenderEngine, default_engine
+from utils import build_scene, load_scene_infos
+from typing import Iterator
+import argparse
+import json
+import os
+import time
+
+
+def interpolate_cameras(camera: Camera, keyframes: "list[dict]", frames: "int | None" = None) -> "list[Camera]":
+    """Returns the camera of every frame, moving linearly between the keyframes
+    Each keyframe has a frame number and may have an eye, look_at and up, the others come from the keyframe
+    before it or, for the first one, from camera. Frames before the first keyframe and after the last one keep still
+    """
+    positions = []
+    eye, look_at, up = tuple(camera.eye), tuple(camera.look_at), tuple(camera.up)
+    for keyframe in sorted(keyframes, key=lambda keyframe: keyframe["frame"]):
+        eye = tuple(keyframe.get("eye", eye))
+        look_at = tuple(keyframe.get("look_at", look_at))
+        up = tuple(keyframe.get("up", up))
+        positions.append((keyframe["frame"], eye + look_at + up))
+    if frames is None:
+        frames = positions[-1][0] + 1 if positions else 1
+
+    cameras = []
+    following = 0
+    for frame in range(frames):
+        while following < len(positions) and positions[following][0] <= frame:
+            following += 1
+        if not positions:
+            values = eye + look_at + up
+        elif following == 0 or following == len(positions):
+            values = positions[max(following - 1, 0)][1]
+        else:
+            (start, before), (end, after) = positions[following - 1], positions[following]
+            t = (frame - start) / (end - start)
+            values = tuple(a + (b - a) * t for a, b in zip(before, after))
+        cameras.append(Camera(camera.v_res, camera.h_res, camera.pixel_size, camera.focal_distance,
+                              Point(*values[:3]), Point(*values[3:6]), Vector3(*values[6:])))
+    return cameras
+
+
+def turntable(camera: Camera, frames: int, axis: "Vector3 | None" = None) -> "list[Camera]":
+    """Returns the cameras of a full turn around the point the camera looks at,
+    rotating around axis, the up vector of the camera by default
+    """
+    axis = axis or camera.up
+    return [camera.rotate(camera.look_at, axis, 360 * frame / frames) for frame in range(frames)]
+
+
+def render_animation(scene: Scene, cameras: "list[Camera]", engine: "RenderEngine | None" = None,
+                     workers: int = 1, anti_aliasing: int = 0, seed: int = 0) -> "Iterator[tuple[int, Image]]":
+    """Renders the scene from each camera, yields (frame number, image) as soon as each frame is finished
+    Frames come in order when rendering serially and in completion order with workers
+    """
+    engine = engine or default_engine()
+    # Built once, before the pool starts, so every frame and worker shares the trees
+    scene.bvh
+    if workers <= 1:
+        for frame, camera in enumerate(cameras):
+            yield frame, engine.render(scene.with_camera(camera), anti_aliasing=anti_aliasing, seed=seed)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(engine, scene)) as executor:
+        futures = {executor.submit(_render_frame_in_worker, camera, anti_aliasing, seed): frame
+                   for frame, camera in enumerate(cameras)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# State of each process of the animation pool, set once by the pool initializer
+_worker_engine: "RenderEngine | None" = None
+_worker_scene: "Scene | None" = None
+
+def _init_worker(engine: RenderEngine, scene: Scene) -> None:
+    global _worker_engine, _worker_scene
+    _worker_engine = engine
+    _worker_scene = scene
+
+def _render_frame_in_worker(camera: Camera, anti_aliasing: int, seed: int) -> Image:
+    return _worker_engine.render(_worker_scene.with_camera(camera), anti_aliasing=anti_aliasing, seed=seed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scene", help="Path of the json or binary scene")
+    parser.add_argument("output", help="Path of the frames with a %%d style field for the frame number, "
+                                       "written as PNG if it ends with .png, binary PPM otherwise")
+    cameras = parser.add_mutually_exclusive_group(required=True)
+    cameras.add_argument("--keyframes", help="Json file with the keyframes of the camera")
+    cameras.add_argument("--turntable", type=int, metavar="FRAMES",
+                         help="Turn the camera around the point it looks at in this number of frames")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes rendering frames in parallel")
+    parser.add_argument("--anti-aliasing", type=int, default=0, help="Number of random samples per pixel")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the anti-aliasing samples")
+    args = parser.parse_args()
+
+    scene = build_scene(load_scene_infos(args.scene))
+    if args.turntable:
+        cameras = turntable(scene.camera, args.turntable)
+    else:
+        with open(args.keyframes) as keyframes_file:
+            keyframes = json.load(keyframes_file)
+        cameras = interpolate_cameras(scene.camera, keyframes["keyframes"], keyframes.get("frames"))
+
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    for done, (frame, image) in enumerate(
+            render_animation(scene, cameras, workers=args.workers, anti_aliasing=args.anti_aliasing,
+                             seed=args.seed), 1):
+        image.save(args.output % frame)
+        print(f"frame {frame}: {done}/{len(cameras)} in {time.perf_counter() - start:.3f}s", flush=True)
+
+
+if __name__ == "__main__":
+    main()
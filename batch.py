@@ -0,0 +1,233 @@
+"""Renders many scenes with one warm interpreter and pool of processes
+
+Each scene is loaded, rendered and written by one process of the pool, which lives for the whole batch,
+so only the first scenes pay for starting the interpreter (and warming up the JIT under PyPy).
+Scenes are started from the most expensive to the cheapest, so a big scene doesn't end up alone at the end,
+and a scene that fails is reported without stopping the others. If a process of the pool dies, the scenes
+that weren't finished are rendered again each in a process of its own, so only the scene that killed it fails.
+
+    python batch.py inputs/ "scenes/*.json" manifest.txt [--output-dir out] [--format png] [--workers 4]
+
+Sources are directories (every .json and .rtscene inside), glob patterns, scene files or manifests:
+.txt files with a scene path per line, optionally followed by the path of its image.
+With --cache the workers share a directory of rendered tiles (utils.RenderCache), so running a batch again
+only renders the scenes that changed.
+"""
+from __future__ import annotations
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from engine import RenderEngine, default_engine
+from sampler import AdaptiveSampler
+from utils import RenderCache, build_scene, load_scene_infos, optimize_scene, read_settings
+from utils.binary_scene import MAGIC
+from typing import Iterator
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+SCENE_EXTENSIONS = (".json", ".rtscene")
+
+
+def find_scenes(sources: "list[str]", output_dir: str = ".", extension: str = ".ppm") -> "list[tuple[str, str]]":
+    """Returns the (scene path, image path) of every scene of the sources, without repeating scenes
+    Images are named after their scene in output_dir, unless a manifest gives their path,
+    scenes with the same name get a number so they don't overwrite each other
+    """
+    jobs: dict[str, str] = {}
+    images: set[str] = set()
+
+    def add(scene_path: str, image_path: "str | None" = None) -> None:
+        if scene_path in jobs:
+            return
+        if image_path is None:
+            name = os.path.splitext(os.path.basename(scene_path))[0]
+            image_path = os.path.join(output_dir, name + extension)
+            number = 1
+            while image_path in images:
+                number += 1
+                image_path = os.path.join(output_dir, f"{name}-{number}{extension}")
+        jobs[scene_path] = image_path
+        images.add(image_path)
+
+    for source in sources:
+        if os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                if name.endswith(SCENE_EXTENSIONS):
+                    add(os.path.join(source, name))
+        elif source.endswith(".txt"):
+            base = os.path.dirname(source)
+            with open(source) as manifest:
+                for line in manifest:
+                    fields = line.split("#")[0].split()
+                    if fields:
+                        # Relative paths are relative to the manifest
+                        add(*(os.path.join(base, field) for field in fields[:2]))
+        elif glob.has_magic(source):
+            for path in sorted(glob.glob(source)):
+                add(path)
+        else:
+            add(source)
+    return list(jobs.items())
+
+
+def scene_cost(scene_path: str, anti_aliasing: int = 0) -> float:
+    """Rough relative cost of rendering a scene: samples traced times the size of the file,
+    which grows with the number of objects. Scenes that can't be read cost 0, they will fail quickly
+    """
+    try:
+        with open(scene_path, "rb") as file:
+            is_binary = file.read(len(MAGIC)) == MAGIC
+        if is_binary:
+            settings = read_settings(scene_path)
+            pixels = settings["cam_width"] * settings["cam_height"]
+        else:
+            with open(scene_path) as file:
+                settings = json.load(file)
+            pixels = settings["h_res"] * settings["v_res"]
+        return pixels * max(anti_aliasing, 1) * os.path.getsize(scene_path)
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+
+# Engines of the process, kept between scenes
+_engines: "dict[bool, RenderEngine]" = {}
+
+
+def render_scene_file(scene_path: str, image_path: str, anti_aliasing: int = 0, seed: int = 0,
+                      adaptive: bool = False, optimize: bool = False,
+                      cache: "str | None" = None, cache_size: int = 1 << 30) -> dict:
+    """Loads, renders and writes a scene, returns its timings or the error that stopped it
+    With a cache directory, tiles rendered before are read from it instead of rendered
+    """
+    result: dict = {"scene": scene_path, "output": image_path}
+    start = time.perf_counter()
+    try:
+        infos = load_scene_infos(scene_path)
+        if optimize:
+            infos, _ = optimize_scene(infos)
+        if cache is None:
+            scene = build_scene(infos)
+            scene.bvh
+        loaded = time.perf_counter()
+        result["load_seconds"] = loaded - start
+
+        if adaptive not in _engines:
+            _engines[adaptive] = default_engine(AdaptiveSampler() if adaptive else None)
+        if cache is None:
+            image = _engines[adaptive].render(scene, anti_aliasing=anti_aliasing, seed=seed)
+        else:
+            tile_cache = RenderCache(cache, cache_size)
+            image = tile_cache.render(_engines[adaptive], infos, anti_aliasing, seed)
+            result["cached_tiles"] = tile_cache.hits
+            result["rendered_tiles"] = tile_cache.misses
+        rendered = time.perf_counter()
+        result["render_seconds"] = rendered - loaded
+
+        directory = os.path.dirname(image_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        image.save(image_path)
+        result["write_seconds"] = time.perf_counter() - rendered
+    except Exception as error:
+        result["error"] = f"{type(error).__name__}: {error}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def render_batch(jobs: "list[tuple[str, str]]", workers: int = 1, anti_aliasing: int = 0,
+                 **options) -> "Iterator[dict]":
+    """Renders the (scene path, image path) jobs, the most expensive first,
+    yields the result of render_scene_file of each scene as soon as it is written
+    With workers > 1 the scenes are rendered in parallel by a pool that lives for the whole batch
+    """
+    jobs = sorted(jobs, key=lambda job: scene_cost(job[0], anti_aliasing), reverse=True)
+    if workers <= 1:
+        for scene_path, image_path in jobs:
+            yield render_scene_file(scene_path, image_path, anti_aliasing, **options)
+        return
+
+    crashed = set()
+    with ProcessPoolExecutor(workers) as executor:
+        # The pool starts the tasks in submission order, so the biggest scenes start first
+        futures = {executor.submit(render_scene_file, *job, anti_aliasing, **options): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                crashed.add(futures[future])
+    if crashed:
+        yield from render_isolated([job for job in jobs if job in crashed], workers, anti_aliasing, **options)
+
+
+def render_isolated(jobs: "list[tuple[str, str]]", workers: int = 1, anti_aliasing: int = 0,
+                    **options) -> "Iterator[dict]":
+    """Renders each scene in a process of its own, up to workers at a time,
+    a scene whose process dies is reported as failed
+    """
+    pending = deque(jobs)
+    running: dict = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                scene_path, image_path = job = pending.popleft()
+                executor = ProcessPoolExecutor(1)
+                future = executor.submit(render_scene_file, scene_path, image_path, anti_aliasing, **options)
+                running[future] = (job, executor)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                (scene_path, image_path), executor = running.pop(future)
+                executor.shutdown()
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    yield {"scene": scene_path, "output": image_path,
+                           "error": "BrokenProcessPool: the process rendering the scene died"}
+    finally:
+        for _, executor in running.values():
+            executor.shutdown(cancel_futures=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="+", help="Directories, glob patterns, scene files or .txt manifests")
+    parser.add_argument("--output-dir", default=".", help="Directory of the images not named by a manifest")
+    parser.add_argument("--format", choices=("ppm", "png"), default="ppm", help="Format of the images")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of processes rendering scenes in parallel")
+    parser.add_argument("--anti-aliasing", type=int, default=0, help="Number of random samples per pixel")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Spend anti-aliasing samples only on noisy pixels and edges")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the anti-aliasing samples")
+    parser.add_argument("--optimize", action="store_true", help="Optimize each scene before rendering it")
+    parser.add_argument("--report", help="Write the timings of every scene to this JSON file")
+    parser.add_argument("--cache", help="Directory of rendered tiles shared by the workers")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Size in MB the cache is kept under")
+    args = parser.parse_args()
+
+    jobs = find_scenes(args.sources, args.output_dir, "." + args.format)
+    start = time.perf_counter()
+    results = []
+    for result in render_batch(jobs, args.workers, args.anti_aliasing, seed=args.seed,
+                               adaptive=args.adaptive, optimize=args.optimize,
+                               cache=args.cache, cache_size=args.cache_size << 20):
+        results.append(result)
+        if "error" in result:
+            print(f"FAILED {result['scene']}: {result['error']}", flush=True)
+        else:
+            print(f"{result['scene']} -> {result['output']}: load {result['load_seconds']:.3f}s "
+                  f"render {result['render_seconds']:.3f}s write {result['write_seconds']:.3f}s", flush=True)
+
+    failed = sum("error" in result for result in results)
+    print(f"{len(results) - failed} scenes rendered, {failed} failed in {time.perf_counter() - start:.3f}s")
+    if args.report:
+        with open(args.report, "w") as report:
+            json.dump(results, report, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
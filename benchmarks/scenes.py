@@ -0,0 +1,235 @@
+"""Benchmark of whole renders over the scenes in inputs/
+
+Renders every scene at each resolution and anti-aliasing level, each case in a fresh process,
+and reports load time, render time, primary, secondary and shadow rays per second and peak memory.
+Results can be saved as JSON, compared against a baseline saved before and checked against golden images,
+so performance work can't silently change pixels. Exits with 1 on regressions, changed images
+or missing golden images, which are only written with --update-golden.
+
+    python -m benchmarks.scenes [scenes...] [--size 64x48] [--anti-aliasing 0 4]
+        [--engine scalar] [--output results.json] [--baseline baseline.json] [--threshold 0.1]
+        [--golden goldens/] [--update-golden]
+"""
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from engine import RenderEngine, default_engine
+from utils import load_from_json, build_scene
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+RAY_KINDS = ("primary", "secondary", "shadow")
+
+
+def make_engine(name: str) -> RenderEngine:
+    if name == "scalar":
+        return RenderEngine()
+    if name == "vectorized":
+        from vectorized_engine import VectorizedRenderEngine
+        return VectorizedRenderEngine()
+    return default_engine()
+
+
+def count_rays(engine: RenderEngine) -> "dict[str, int]":
+    """Wraps the tracing methods of the engine instance to count the rays traced of each kind
+    Works with the scalar engine and with the packets of the vectorized engine
+    """
+    counts = dict.fromkeys(RAY_KINDS, 0)
+    if hasattr(engine, "trace_packet"):
+        trace_packet = engine.trace_packet
+        shade_packet = engine.shade_packet
+
+        def counting_trace_packet(packet, scene, origins, directions, depth=0, weights=None):
+            counts["secondary" if depth else "primary"] += len(origins)
+            return trace_packet(packet, scene, origins, directions, depth, weights)
+
+        def counting_shade_packet(packet, scene, owner, hit_pos, normal):
+            counts["shadow"] += len(owner) * len(scene.lights)
+            return shade_packet(packet, scene, owner, hit_pos, normal)
+        engine.trace_packet = counting_trace_packet
+        engine.shade_packet = counting_shade_packet
+    else:
+        trace_ray = engine.trace_ray
+        occluded = engine.occluded
+
+        def counting_trace_ray(ray, scene, depth=0):
+            counts["secondary" if depth else "primary"] += 1
+            return trace_ray(ray, scene, depth)
+
+        def counting_occluded(ray, scene, max_distance, light=None):
+            counts["shadow"] += 1
+            return occluded(ray, scene, max_distance, light)
+        engine.trace_ray = counting_trace_ray
+        engine.occluded = counting_occluded
+    return counts
+
+
+def golden_path(directory: str, case: dict) -> str:
+    return os.path.join(directory, f"{case['scene']}_{case['width']}x{case['height']}_aa{case['anti_aliasing']}.ppm")
+
+
+def compare_images(image: bytes, golden: bytes) -> "tuple[int, int]":
+    """Number of pixels that differ between two 8 bit RGB images and the largest channel difference"""
+    if len(image) != len(golden):
+        return max(len(image), len(golden)) // 3, 255
+    pixels = 0
+    largest = 0
+    for offset in range(0, len(image), 3):
+        difference = max(abs(a - b) for a, b in zip(image[offset:offset + 3], golden[offset:offset + 3]))
+        if difference:
+            pixels += 1
+            largest = max(largest, difference)
+    return pixels, largest
+
+
+def run_case(json_path: str, width: int, height: "int | None", anti_aliasing: int, engine_name: str,
+             golden: "str | None" = None, update_golden: bool = False) -> dict:
+    """Loads and renders a scene once, meant to run in its own process so peak memory is its own"""
+    start = time.perf_counter()
+    infos = load_from_json(json_path)
+    if height is None:
+        height = round(width * infos["cam_height"] / infos["cam_width"])
+    infos["cam_square_size"] *= infos["cam_width"] / width
+    infos["cam_width"], infos["cam_height"] = width, height
+    scene = build_scene(infos)
+    scene.bvh
+    load_seconds = time.perf_counter() - start
+
+    engine = make_engine(engine_name)
+    rays = count_rays(engine)
+    start = time.perf_counter()
+    image = engine.render(scene, anti_aliasing=anti_aliasing)
+    render_seconds = time.perf_counter() - start
+    data = image.to_bytes()
+
+    case = {
+        "scene": os.path.splitext(os.path.basename(json_path))[0],
+        "width": width,
+        "height": height,
+        "anti_aliasing": anti_aliasing,
+        "engine": type(engine).__name__,
+        "load_seconds": load_seconds,
+        "render_seconds": render_seconds,
+        "rays": rays,
+        "rays_per_second": {kind: count / render_seconds for kind, count in rays.items()},
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "image_sha256": hashlib.sha256(data).hexdigest(),
+    }
+    if golden is not None:
+        path = golden_path(golden, case)
+        header = b"P6 %d %d\n255\n" % (width, height)
+        if update_golden:
+            os.makedirs(golden, exist_ok=True)
+            with open(path, "wb") as golden_file:
+                golden_file.write(header + data)
+            case["golden"] = "written"
+        elif not os.path.exists(path):
+            case["golden"] = "missing"
+        else:
+            with open(path, "rb") as golden_file:
+                expected = golden_file.read()[len(header):]
+            pixels, largest = compare_images(data, expected)
+            case["golden"] = {"differing_pixels": pixels, "largest_difference": largest}
+    return case
+
+
+def case_key(case: dict) -> tuple:
+    return case["scene"], case["width"], case["height"], case["anti_aliasing"], case["engine"]
+
+
+def compare_with_baseline(results: "list[dict]", baseline: "list[dict]", threshold: float,
+                          min_seconds: float = 0.005) -> "list[str]":
+    """Returns a message for every case that got slower than the baseline by more than threshold (0.1 is 10%)
+    Differences under min_seconds are taken as noise
+    """
+    previous = {case_key(case): case for case in baseline}
+    regressions = []
+    for case in results:
+        old = previous.get(case_key(case))
+        if old is None:
+            continue
+        for field in ("render_seconds", "load_seconds"):
+            if case[field] > old[field] * (1 + threshold) and case[field] - old[field] > min_seconds:
+                regressions.append(
+                    f"{case['scene']} {case['width']}x{case['height']} aa={case['anti_aliasing']}: "
+                    f"{field} {old[field]:.3f} -> {case[field]:.3f}")
+    return regressions
+
+
+def parse_size(size: str) -> "tuple[int, int | None]":
+    """WIDTHxHEIGHT, or only WIDTH keeping the aspect ratio of the scene"""
+    width, _, height = size.partition("x")
+    return int(width), int(height) if height else None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenes", nargs="*", help="Scene files, every inputs/*.json by default")
+    parser.add_argument("--size", nargs="+", default=["64"],
+                        help="Resolutions as WIDTHxHEIGHT or WIDTH, keeping the aspect ratio of the scene")
+    parser.add_argument("--anti-aliasing", nargs="+", type=int, default=[0], help="Anti-aliasing levels")
+    parser.add_argument("--engine", choices=("default", "scalar", "vectorized"), default="default")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative slowdown over the baseline reported as a regression")
+    parser.add_argument("--golden", help="Directory of golden images to compare the renders with")
+    parser.add_argument("--update-golden", action="store_true", help="Write the golden images instead of comparing with them")
+    args = parser.parse_args()
+
+    scenes = args.scenes or sorted(glob.glob(os.path.join("inputs", "*.json")))
+    cases = [
+        (scene, *parse_size(size), anti_aliasing, args.engine, args.golden, args.update_golden)
+        for scene in scenes for size in args.size for anti_aliasing in args.anti_aliasing]
+
+    results = []
+    failed = False
+    written = missing = 0
+    # A spawned process per case, so the peak memory of a case doesn't include the ones before it
+    # (a pool for each case, max_tasks_per_child needs Python 3.11 and PyPy is 3.10)
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = executor.submit(run_case, *case).result()
+        results.append(result)
+        rates = " ".join(f"{kind} {result['rays_per_second'][kind]:9.0f}/s" for kind in RAY_KINDS)
+        line = (f"{result['scene']:>14} {result['width']}x{result['height']} aa={result['anti_aliasing']}: "
+                f"load {result['load_seconds']:6.3f}s render {result['render_seconds']:7.3f}s "
+                f"{rates} peak {result['peak_rss_mib']:6.1f} MiB")
+        golden = result.get("golden")
+        if golden == "written":
+            written += 1
+            line += " golden written"
+        elif golden == "missing":
+            missing += 1
+            failed = True
+            line += " MISSING golden image"
+        elif isinstance(golden, dict) and golden["differing_pixels"]:
+            failed = True
+            line += f" CHANGED {golden['differing_pixels']} pixels (up to {golden['largest_difference']})"
+        print(line, flush=True)
+    if written or missing:
+        print(f"golden images: {written} written, {missing} missing" +
+              (", run with --update-golden to write them" if missing else ""))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare_with_baseline(results, json.load(baseline), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
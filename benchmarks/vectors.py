@@ -0,0 +1,89 @@
+"""Microbenchmark of Vector3 allocations in the scalar engine
+
+Counts how many Vector3 (and Color/Point) objects are created per traced ray,
+the memory taken by each vector and the time of the basic operations.
+
+    python -m benchmarks.vectors [scene.json] [--size 32]
+"""
+from components import Vector3, Color, Ray
+from engine import RenderEngine
+from utils import load_from_json, build_scene
+import argparse
+import timeit
+import tracemalloc
+
+
+class ConstructionCounter:
+    """Counts calls to a class __init__ while active, subclasses included"""
+    def __init__(self, cls) -> None:
+        self.cls = cls
+        self.count = 0
+
+    def __enter__(self) -> "ConstructionCounter":
+        original = self.original = self.cls.__init__
+
+        def counting_init(instance, *args, **kwargs):
+            self.count += 1
+            original(instance, *args, **kwargs)
+        self.cls.__init__ = counting_init
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.cls.__init__ = self.original
+
+
+def allocations_per_ray(json_path: str, size: int) -> "tuple[float, int]":
+    """Renders the scene at size x size pixels, returns vectors created per ray and the number of rays"""
+    infos = load_from_json(json_path)
+    infos["cam_square_size"] *= infos["cam_width"] / size
+    infos["cam_width"] = infos["cam_height"] = size
+    scene = build_scene(infos)
+    engine = RenderEngine()
+    engine.render(scene)
+    with ConstructionCounter(Ray) as rays, ConstructionCounter(Vector3) as vectors:
+        engine.render(scene)
+    return vectors.count / rays.count, rays.count
+
+
+def bytes_per_vector(count: int = 100_000) -> float:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    vectors = [Vector3(float(i), 2., 3.) for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    # The list holding the vectors is not part of their cost
+    return (size - vectors.__sizeof__()) / count
+
+
+def operation_times(number: int = 200_000) -> "dict[str, float]":
+    """Nanoseconds per operation"""
+    a = Color(.1, .2, .3)
+    b = Color(.3, .2, .1)
+    cases = {
+        "a + b": lambda: a + b,
+        "a * 2": lambda: a * 2,
+        "a ^ b": lambda: a ^ b,
+        "a + b * 2": lambda: a + b * 2,
+    }
+    if hasattr(Vector3, "imul_add"):
+        cases["a.iadd(b)"] = lambda: a.iadd(b)
+        cases["a.imul_add(b, 2)"] = lambda: a.imul_add(b, 2)
+    return {name: timeit.timeit(case, number=number) / number * 1e9 for name, case in cases.items()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jsonpath", nargs="?", default="inputs/espelho1.json")
+    parser.add_argument("--size", type=int, default=32, help="Side in pixels of the rendered image")
+    args = parser.parse_args()
+
+    per_ray, rays = allocations_per_ray(args.jsonpath, args.size)
+    print(f"{args.jsonpath}: {rays} rays, {per_ray:.1f} vectors allocated per ray")
+    print(f"{bytes_per_vector():.0f} bytes per Vector3")
+    for name, nanoseconds in operation_times().items():
+        print(f"{name:>18}: {nanoseconds:6.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
-from .mixins import LinearTransformationsMixin
+from .mixins import LinearTransformationsMixin, affine_matrix, matrix_multiply, invert_affine, rotation_matrix
 from .vectors import Vector3, Color, Point
 from .material import Material, ChequeredMaterial
 from .ray import Ray
-from .objects3D import Object3D, Sphere, Plane, Triangle, TriangleMesh, RevolutionSurface, BezierCurve
+from .bvh import AABB, BVH
+from .objects3D import Object3D, Sphere, Plane, Triangle, TriangleMesh, RevolutionSurface, BezierCurve, Instance
 from .light import Light
-from .image import Image
+from .image import Image, PPMStreamWriter
 from .camera import Camera
-from .scene import Scene
\ No newline at end of file
+from .scene import Scene
+from .compiled import CompiledScene
@@ -0,0 +1,271 @@
+from __future__ import annotations
+from array import array
+from components import Point, Ray
+
+INFINITY = float('inf')
+# Used instead of infinity for the inverse of a zero direction component, so 0 * inverse stays 0 instead of nan
+BIG_INVERSE = 1e30
+
+
+class AABB:
+    """Axis aligned bounding box, defined by its minimum and maximum corners"""
+    def __init__(self, minimum: Point, maximum: Point) -> None:
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __str__(self) -> str:
+        return f'(Minimum: {self.minimum}, Maximum: {self.maximum})'
+
+    @classmethod
+    def from_points(cls, points: "list[Point]") -> AABB:
+        """Smallest box containing all the points, slightly padded so flat boxes still get hit"""
+        xs = [point.x for point in points]
+        ys = [point.y for point in points]
+        zs = [point.z for point in points]
+        return cls(Point(min(xs), min(ys), min(zs)), Point(max(xs), max(ys), max(zs))).padded()
+
+    def padded(self, relative: float = 1e-7) -> AABB:
+        """Returns the box grown by a tiny margin to absorb rounding errors on the slab test"""
+        margin = relative * (1 + max(
+            abs(self.minimum.x), abs(self.minimum.y), abs(self.minimum.z),
+            abs(self.maximum.x), abs(self.maximum.y), abs(self.maximum.z)))
+        return AABB(
+            Point(self.minimum.x - margin, self.minimum.y - margin, self.minimum.z - margin),
+            Point(self.maximum.x + margin, self.maximum.y + margin, self.maximum.z + margin))
+
+    def union(self, other: AABB) -> AABB:
+        """Smallest box containing both boxes"""
+        return AABB(
+            Point(min(self.minimum.x, other.minimum.x), min(self.minimum.y, other.minimum.y), min(self.minimum.z, other.minimum.z)),
+            Point(max(self.maximum.x, other.maximum.x), max(self.maximum.y, other.maximum.y), max(self.maximum.z, other.maximum.z)))
+
+    def centroid(self) -> Point:
+        """Center point of the box"""
+        return Point(
+            (self.minimum.x + self.maximum.x) / 2,
+            (self.minimum.y + self.maximum.y) / 2,
+            (self.minimum.z + self.maximum.z) / 2)
+
+    def overlaps(self, other: AABB) -> bool:
+        """Checks if two boxes share any point"""
+        return self.minimum.x <= other.maximum.x and other.minimum.x <= self.maximum.x \
+            and self.minimum.y <= other.maximum.y and other.minimum.y <= self.maximum.y \
+            and self.minimum.z <= other.maximum.z and other.minimum.z <= self.maximum.z
+
+    def intersects(self, ray: Ray, max_distance: float = INFINITY) -> bool:
+        """Slab test, checks if the ray enters the box before max_distance"""
+        near, far = slab_distances(
+            ray.origin.x, ray.origin.y, ray.origin.z, *inverse_direction(ray),
+            self.minimum.x, self.minimum.y, self.minimum.z,
+            self.maximum.x, self.maximum.y, self.maximum.z)
+        return near <= far and far >= 0 and near <= max_distance
+
+
+def inverse_direction(ray: Ray) -> "tuple[float, float, float]":
+    """Component-wise inverse of the ray direction, zeros become a huge number"""
+    direction = ray.direction
+    return (
+        1 / direction.x if direction.x else BIG_INVERSE,
+        1 / direction.y if direction.y else BIG_INVERSE,
+        1 / direction.z if direction.z else BIG_INVERSE)
+
+
+def slab_distances(
+        ox: float, oy: float, oz: float, ix: float, iy: float, iz: float,
+        min_x: float, min_y: float, min_z: float,
+        max_x: float, max_y: float, max_z: float) -> "tuple[float, float]":
+    """Returns the distances where a ray enters and leaves a box, the ray misses it if near > far"""
+    near = (min_x - ox) * ix
+    far = (max_x - ox) * ix
+    if near > far:
+        near, far = far, near
+    t1 = (min_y - oy) * iy
+    t2 = (max_y - oy) * iy
+    if t1 > t2:
+        t1, t2 = t2, t1
+    if t1 > near:
+        near = t1
+    if t2 < far:
+        far = t2
+    t1 = (min_z - oz) * iz
+    t2 = (max_z - oz) * iz
+    if t1 > t2:
+        t1, t2 = t2, t1
+    if t1 > near:
+        near = t1
+    if t2 < far:
+        far = t2
+    return near, far
+
+
+class BVH:
+    """Bounding volume hierarchy over a list of primitives identified by their index
+
+    The tree only knows the primitives' boxes, the actual intersection is delegated
+    to a callable receiving (index, ray), so it can index objects of a scene or faces of a mesh.
+    Nodes are stored flat as tuples:
+    (min_x, min_y, min_z, max_x, max_y, max_z, left, right, split_axis, primitives),
+    where primitives is None for inner nodes and a tuple of indices for leaves.
+    """
+    LEAF_SIZE = 4
+
+    def __init__(self, boxes: "list[AABB]", leaf_size: int = LEAF_SIZE) -> None:
+        self.leaf_size = leaf_size
+        self.nodes: list[tuple] = []
+        self.size = len(boxes)
+        if boxes:
+            bounds = [
+                (box.minimum.x, box.minimum.y, box.minimum.z, box.maximum.x, box.maximum.y, box.maximum.z)
+                for box in boxes]
+            self._build(bounds, list(range(len(boxes))))
+
+    def bounding_box(self) -> "AABB | None":
+        """Box around every primitive in the tree"""
+        if not self.nodes:
+            return None
+        min_x, min_y, min_z, max_x, max_y, max_z = self.nodes[0][:6]
+        return AABB(Point(min_x, min_y, min_z), Point(max_x, max_y, max_z))
+
+    def to_arrays(self) -> "tuple[array, array, array]":
+        """Flattens the tree in three arrays, so it can be stored and loaded without being rebuilt:
+        the bounds of the nodes (6 doubles per node), their links (left, right, split_axis,
+        first primitive and number of primitives per node) and the primitives of all leaves
+        """
+        bounds = array('d')
+        links = array('i')
+        primitives = array('I')
+        for min_x, min_y, min_z, max_x, max_y, max_z, left, right, axis, leaf in self.nodes:
+            bounds.extend((min_x, min_y, min_z, max_x, max_y, max_z))
+            if leaf is None:
+                links.extend((left, right, axis, 0, -1))
+            else:
+                links.extend((left, right, axis, len(primitives), len(leaf)))
+                primitives.extend(leaf)
+        return bounds, links, primitives
+
+    @classmethod
+    def from_arrays(cls, bounds: array, links: array, primitives: array, size: int, leaf_size: int = LEAF_SIZE) -> BVH:
+        """Rebuilds a tree of size primitives from the arrays of to_arrays, or memoryviews of them"""
+        bvh = cls([], leaf_size)
+        bvh.size = size
+        bounds = bounds.tolist()
+        links = links.tolist()
+        primitives = primitives.tolist()
+        for node in range(len(links) // 5):
+            left, right, axis, first, count = links[node * 5:node * 5 + 5]
+            leaf = None if count < 0 else tuple(primitives[first:first + count])
+            bvh.nodes.append((*bounds[node * 6:node * 6 + 6], left, right, axis, leaf))
+        return bvh
+
+    def _build(self, bounds: "list[tuple]", indices: "list[int]") -> int:
+        """Recursively splits the primitives at the median of the widest centroid axis, returns the node index"""
+        min_x = min(bounds[i][0] for i in indices)
+        min_y = min(bounds[i][1] for i in indices)
+        min_z = min(bounds[i][2] for i in indices)
+        max_x = max(bounds[i][3] for i in indices)
+        max_y = max(bounds[i][4] for i in indices)
+        max_z = max(bounds[i][5] for i in indices)
+
+        node_index = len(self.nodes)
+        if len(indices) <= self.leaf_size:
+            self.nodes.append((min_x, min_y, min_z, max_x, max_y, max_z, -1, -1, 0, tuple(indices)))
+            return node_index
+
+        centroids = {i: (
+            bounds[i][0] + bounds[i][3],
+            bounds[i][1] + bounds[i][4],
+            bounds[i][2] + bounds[i][5]) for i in indices}
+        extents = [
+            max(centroids[i][axis] for i in indices) - min(centroids[i][axis] for i in indices)
+            for axis in range(3)]
+        axis = extents.index(max(extents))
+        # Sorting keeps ties in index order, so the tree is deterministic
+        indices = sorted(indices, key=lambda i: centroids[i][axis])
+        middle = len(indices) // 2
+
+        # Placeholder, children are only known after building them
+        self.nodes.append(None)
+        left = self._build(bounds, indices[:middle])
+        right = self._build(bounds, indices[middle:])
+        self.nodes[node_index] = (min_x, min_y, min_z, max_x, max_y, max_z, left, right, axis, None)
+        return node_index
+
+    def nearest(self, ray: Ray, intersect, max_distance: float = INFINITY) -> "tuple[float, any, int] | tuple[None, None, None]":
+        """Finds the closest primitive hit by the ray
+        intersect(index, ray) must return (distance, payload) or (None, None).
+        Ties in distance are broken by the lowest index, so the result doesn't depend on the tree shape.
+        Returns the distance, the payload and the index of the primitive hit
+        """
+        nodes = self.nodes
+        if not nodes:
+            return None, None, None
+        ox, oy, oz = ray.origin.x, ray.origin.y, ray.origin.z
+        ix, iy, iz = inverse_direction(ray)
+        negative = (ix < 0, iy < 0, iz < 0)
+
+        best_distance = max_distance
+        best_payload = None
+        best_index = None
+        stack = [0]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            min_x, min_y, min_z, max_x, max_y, max_z, left, right, axis, primitives = nodes[pop()]
+            near, far = slab_distances(ox, oy, oz, ix, iy, iz, min_x, min_y, min_z, max_x, max_y, max_z)
+            if near > far or far < 0 or near > best_distance:
+                continue
+            if primitives is None:
+                # Visits the child closer to the ray origin first
+                if negative[axis]:
+                    push(left)
+                    push(right)
+                else:
+                    push(right)
+                    push(left)
+                continue
+            for index in primitives:
+                distance, payload = intersect(index, ray)
+                if distance is not None and (
+                        distance < best_distance
+                        or (distance == best_distance and best_index is not None and index < best_index)):
+                    best_distance = distance
+                    best_payload = payload
+                    best_index = index
+
+        if best_index is None:
+            return None, None, None
+        return best_distance, best_payload, best_index
+
+    def any_hit(self, ray: Ray, occludes, max_distance: float = INFINITY) -> "int | None":
+        """Finds any primitive blocking the ray before max_distance, stopping at the first one
+        occludes(index, ray, max_distance) must return True if the primitive blocks the ray.
+        Returns the index of the blocking primitive, None if nothing blocks the ray
+        """
+        nodes = self.nodes
+        if not nodes:
+            return None
+        ox, oy, oz = ray.origin.x, ray.origin.y, ray.origin.z
+        ix, iy, iz = inverse_direction(ray)
+        negative = (ix < 0, iy < 0, iz < 0)
+
+        stack = [0]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            min_x, min_y, min_z, max_x, max_y, max_z, left, right, axis, primitives = nodes[pop()]
+            near, far = slab_distances(ox, oy, oz, ix, iy, iz, min_x, min_y, min_z, max_x, max_y, max_z)
+            if near > far or far < 0 or near > max_distance:
+                continue
+            if primitives is None:
+                # Blockers near the ray origin are more likely, so the closer child is visited first
+                if negative[axis]:
+                    push(left)
+                    push(right)
+                else:
+                    push(right)
+                    push(left)
+                continue
+            for index in primitives:
+                if occludes(index, ray, max_distance):
+                    return index
+        return None
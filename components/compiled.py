@@ -0,0 +1,346 @@
+from __future__ import annotations
+from components import (Object3D, Sphere, Plane, Triangle, TriangleMesh, RevolutionSurface,
+    Vector3, Ray, AABB, BVH, Scene)
+from components.bvh import INFINITY, inverse_direction, slab_distances
+from array import array
+import math
+
+
+class CompiledScene(Scene):
+    """Scene frozen into flat typed arrays, grouped by primitive type
+
+    Spheres, planes and triangles (loose ones, faces of meshes and of revolution surfaces) are stored
+    as struct-of-arrays buffers, so finding hits runs one loop per type over plain floats instead of
+    calling intersects on every object and allocating vectors for its constants.
+    Objects of other types (like instances) keep their own intersects and occluded.
+    All bounded primitives share one BVH whose leaves list their primitives by type.
+
+    Primitives are ranked by (object index, face index), ties in distance go to the lowest rank,
+    so hits are exactly the ones of the Scene it was compiled from.
+    Built by Scene.compile, it renders like any scene and can be pickled.
+    """
+    SPHERE_STRIDE = 4
+    PLANE_STRIDE = 6
+    TRIANGLE_STRIDE = TriangleMesh.FACE_STRIDE
+    EPSILON = 0.001
+
+    def __init__(self, scene: Scene) -> None:
+        super().__init__(scene.camera, list(scene.objects), scene.lights, scene.ambient_color,
+                         scene.bg_color, scene.max_depth)
+        self.build_bvh()
+
+    def build_bvh(self) -> None:
+        """Compiles the objects again, must be called if the objects list is changed after compiling"""
+        self.version += 1
+        # center x, y, z and squared radius
+        self.spheres = array('d')
+        # point x, y, z and normal x, y, z
+        self.planes = array('d')
+        # vertex_0, edge1, edge2 and normal, like TriangleMesh.face_data
+        self.triangles = array('d')
+        # Owner object index and rank of each primitive of a type
+        self.sphere_owners, self.plane_owners, self.triangle_owners = array('I'), array('I'), array('I')
+        self.sphere_ranks, self.plane_ranks, self.triangle_ranks = array('Q'), array('Q'), array('Q')
+        # Objects of other types, as (rank, object index)
+        bounded_others: list[tuple[int, int]] = []
+        self.unbounded_others: list[tuple[int, int]] = []
+        # Loose triangles, which return their own normal object
+        self.loose_triangles: dict[int, Triangle] = {}
+
+        boxes: list[AABB] = []
+        bounded: list[tuple[str, int]] = []
+        for index, obj in enumerate(self.objects):
+            rank = index << 32
+            kind = type(obj)
+            if kind is Sphere:
+                bounded.append(("sphere", len(self.sphere_owners)))
+                boxes.append(obj.bounding_box())
+                self.spheres.extend((obj.center.x, obj.center.y, obj.center.z, obj.radius ** 2))
+                self.sphere_owners.append(index)
+                self.sphere_ranks.append(rank)
+            elif kind is Plane:
+                self.planes.extend((obj.point.x, obj.point.y, obj.point.z, obj.normal.x, obj.normal.y, obj.normal.z))
+                self.plane_owners.append(index)
+                self.plane_ranks.append(rank)
+            elif kind is Triangle:
+                self.loose_triangles[len(self.triangle_owners)] = obj
+                bounded.append(("triangle", len(self.triangle_owners)))
+                boxes.append(obj.bounding_box())
+                edge1 = obj.vertex_1 - obj.vertex_0
+                edge2 = obj.vertex_2 - obj.vertex_0
+                self.triangles.extend((*obj.vertex_0, *edge1, *edge2, *obj.normal))
+                self.triangle_owners.append(index)
+                self.triangle_ranks.append(rank)
+            elif kind is TriangleMesh or kind is RevolutionSurface:
+                mesh = obj.triangle_mesh if kind is RevolutionSurface else obj
+                face_data = mesh.face_data
+                vertices = mesh.list_vertices
+                for face, triangle in enumerate(mesh.list_triangles):
+                    bounded.append(("triangle", len(self.triangle_owners)))
+                    boxes.append(AABB.from_points([vertices[triangle[0]], vertices[triangle[1]], vertices[triangle[2]]]))
+                    self.triangles.extend(face_data[face * self.TRIANGLE_STRIDE:(face + 1) * self.TRIANGLE_STRIDE])
+                    self.triangle_owners.append(index)
+                    self.triangle_ranks.append(rank + face)
+            else:
+                box = obj.bounding_box()
+                if box is None:
+                    self.unbounded_others.append((rank, index))
+                else:
+                    bounded.append(("other", len(bounded_others)))
+                    boxes.append(box)
+                    bounded_others.append((rank, index))
+        self.bounded_others = bounded_others
+
+        self._bvh = BVH(boxes)
+        # Leaves list their spheres, triangles and other objects apart, so each type runs its own loop
+        self.nodes = []
+        for node in self._bvh.nodes:
+            primitives = node[9]
+            if primitives is not None:
+                leaf = {"sphere": [], "triangle": [], "other": []}
+                for primitive in primitives:
+                    kind, index = bounded[primitive]
+                    leaf[kind].append(index)
+                primitives = (tuple(leaf["sphere"]), tuple(leaf["triangle"]), tuple(leaf["other"]))
+            self.nodes.append((*node[:9], primitives))
+        self.bounded_objects = []
+        self.unbounded_objects = []
+
+    def compile(self) -> CompiledScene:
+        return self
+
+    def find_nearest(self, ray: Ray) -> "tuple[float, Vector3, Object3D] | tuple[None, None, None]":
+        """Finds the closest object hit by the ray, running the loop of each primitive type over its arrays
+        Same distances, normals and ties as Scene.find_nearest
+        """
+        EPSILON = self.EPSILON
+        origin = ray.origin
+        direction = ray.direction
+        ox, oy, oz = origin.x, origin.y, origin.z
+        dx, dy, dz = direction.x, direction.y, direction.z
+        best_distance = INFINITY
+        best_rank = -1
+        # Type and index of the best primitive, the normal is only computed for it
+        best_kind = None
+        best_index = -1
+        best_normal = None
+
+        planes = self.planes
+        for index, rank in enumerate(self.plane_ranks):
+            offset = index * 6
+            px, py, pz, nx, ny, nz = planes[offset:offset + 6]
+            denominator = (nx * dx) + (ny * dy) + (nz * dz)
+            if abs(denominator) >= 0.001:
+                distance = ((nx * (px - ox)) + (ny * (py - oy)) + (nz * (pz - oz))) / denominator
+                if distance > 0.001 and (distance < best_distance or (distance == best_distance and rank < best_rank)):
+                    best_distance, best_rank, best_kind, best_index = distance, rank, "plane", index
+        objects = self.objects
+        for rank, index in self.unbounded_others:
+            distance, normal = objects[index].intersects(ray)
+            if distance is not None and (distance < best_distance or (distance == best_distance and rank < best_rank)):
+                best_distance, best_rank, best_kind, best_index, best_normal = distance, rank, "other", index, normal
+
+        nodes = self.nodes
+        if nodes:
+            spheres = self.spheres
+            sphere_ranks = self.sphere_ranks
+            triangles = self.triangles
+            triangle_ranks = self.triangle_ranks
+            bounded_others = self.bounded_others
+            # A tree of a single leaf tests its few primitives without the box test
+            single_leaf = len(nodes) == 1
+            ix, iy, iz = (0., 0., 0.) if single_leaf else inverse_direction(ray)
+            negative = (ix < 0, iy < 0, iz < 0)
+            stack = [0]
+            pop = stack.pop
+            push = stack.append
+            while stack:
+                min_x, min_y, min_z, max_x, max_y, max_z, left, right, axis, primitives = nodes[pop()]
+                if not single_leaf:
+                    near, far = slab_distances(ox, oy, oz, ix, iy, iz, min_x, min_y, min_z, max_x, max_y, max_z)
+                    if near > far or far < 0 or near > best_distance:
+                        continue
+                if primitives is None:
+                    # Visits the child closer to the ray origin first
+                    if negative[axis]:
+                        push(left)
+                        push(right)
+                    else:
+                        push(right)
+                        push(left)
+                    continue
+                leaf_spheres, leaf_triangles, leaf_others = primitives
+                # Same operations as Sphere.intersects
+                for index in leaf_spheres:
+                    offset = index * 4
+                    cx, cy, cz, radius2 = spheres[offset:offset + 4]
+                    sx, sy, sz = ox - cx, oy - cy, oz - cz
+                    b = 2 * ((dx * sx) + (dy * sy) + (dz * sz))
+                    c = ((sx * sx) + (sy * sy) + (sz * sz)) - radius2
+                    discriminant = (b**2) - (4*c)
+                    if discriminant >= 0:
+                        distance = (-b - math.sqrt(discriminant)) / 2
+                        if distance <= 0.001:
+                            distance = (-b + math.sqrt(discriminant)) / 2
+                            if distance <= 0.001:
+                                continue
+                        rank = sphere_ranks[index]
+                        if distance < best_distance or (distance == best_distance and rank < best_rank):
+                            best_distance, best_rank, best_kind, best_index = distance, rank, "sphere", index
+                # Same operations as Triangle.intersects and TriangleMesh._intersect_face
+                for index in leaf_triangles:
+                    offset = index * 12
+                    v0x, v0y, v0z, e1x, e1y, e1z, e2x, e2y, e2z = triangles[offset:offset + 9]
+                    hx = dy * e2z - dz * e2y
+                    hy = dz * e2x - dx * e2z
+                    hz = dx * e2y - dy * e2x
+                    a = (e1x * hx) + (e1y * hy) + (e1z * hz)
+                    if -EPSILON < a < EPSILON:
+                        continue
+                    f = 1/a
+                    sx = ox - v0x
+                    sy = oy - v0y
+                    sz = oz - v0z
+                    u = f * ((sx * hx) + (sy * hy) + (sz * hz))
+                    if u < 0.0 or u > 1.0:
+                        continue
+                    qx = sy * e1z - sz * e1y
+                    qy = sz * e1x - sx * e1z
+                    qz = sx * e1y - sy * e1x
+                    v = f * ((dx * qx) + (dy * qy) + (dz * qz))
+                    if v < 0.0 or u + v > 1.0:
+                        continue
+                    distance = f * ((e2x * qx) + (e2y * qy) + (e2z * qz))
+                    if distance > EPSILON:
+                        rank = triangle_ranks[index]
+                        if distance < best_distance or (distance == best_distance and rank < best_rank):
+                            best_distance, best_rank, best_kind, best_index = distance, rank, "triangle", index
+                for index in leaf_others:
+                    rank, object_index = bounded_others[index]
+                    distance, normal = objects[object_index].intersects(ray)
+                    if distance is not None and (
+                            distance < best_distance or (distance == best_distance and rank < best_rank)):
+                        best_distance, best_rank, best_kind, best_index, best_normal = \
+                            distance, rank, "other", object_index, normal
+
+        if best_kind is None:
+            return None, None, None
+        if best_kind == "sphere":
+            sphere = objects[self.sphere_owners[best_index]]
+            return best_distance, sphere._get_normal(ray.origin + ray.direction * best_distance), sphere
+        if best_kind == "triangle":
+            owner = objects[self.triangle_owners[best_index]]
+            if best_index in self.loose_triangles:
+                return best_distance, owner.normal, owner
+            offset = best_index * 12 + 9
+            return best_distance, Vector3(*self.triangles[offset:offset + 3]), owner
+        if best_kind == "plane":
+            plane = objects[self.plane_owners[best_index]]
+            return best_distance, plane.normal, plane
+        return best_distance, best_normal, objects[best_index]
+
+    def occluder(self, ray: Ray, max_distance: float, skip: "Object3D | None" = None) -> "Object3D | None":
+        """Returns any object blocking the ray before max_distance, None if there is none
+        Same blockers as Scene.occluder, skip is an object already known not to block the ray
+        """
+        EPSILON = self.EPSILON
+        origin = ray.origin
+        direction = ray.direction
+        ox, oy, oz = origin.x, origin.y, origin.z
+        dx, dy, dz = direction.x, direction.y, direction.z
+        objects = self.objects
+
+        nodes = self.nodes
+        if nodes:
+            spheres = self.spheres
+            sphere_owners = self.sphere_owners
+            triangles = self.triangles
+            triangle_owners = self.triangle_owners
+            bounded_others = self.bounded_others
+            single_leaf = len(nodes) == 1
+            ix, iy, iz = (0., 0., 0.) if single_leaf else inverse_direction(ray)
+            negative = (ix < 0, iy < 0, iz < 0)
+            stack = [0]
+            pop = stack.pop
+            push = stack.append
+            while stack:
+                min_x, min_y, min_z, max_x, max_y, max_z, left, right, axis, primitives = nodes[pop()]
+                if not single_leaf:
+                    near, far = slab_distances(ox, oy, oz, ix, iy, iz, min_x, min_y, min_z, max_x, max_y, max_z)
+                    if near > far or far < 0 or near > max_distance:
+                        continue
+                if primitives is None:
+                    # Blockers near the ray origin are more likely, so the closer child is visited first
+                    if negative[axis]:
+                        push(left)
+                        push(right)
+                    else:
+                        push(right)
+                        push(left)
+                    continue
+                leaf_spheres, leaf_triangles, leaf_others = primitives
+                # Same operations as Sphere.occluded
+                for index in leaf_spheres:
+                    if skip is not None and objects[sphere_owners[index]] is skip:
+                        continue
+                    offset = index * 4
+                    cx, cy, cz, radius2 = spheres[offset:offset + 4]
+                    sx, sy, sz = ox - cx, oy - cy, oz - cz
+                    b = 2 * ((dx * sx) + (dy * sy) + (dz * sz))
+                    c = ((sx * sx) + (sy * sy) + (sz * sz)) - radius2
+                    discriminant = (b**2) - (4*c)
+                    if discriminant >= 0:
+                        distance = (-b - math.sqrt(discriminant)) / 2
+                        if distance > 0.001:
+                            blocked = distance < max_distance
+                        else:
+                            distance = (-b + math.sqrt(discriminant)) / 2
+                            blocked = 0.001 < distance < max_distance
+                        if blocked:
+                            return objects[sphere_owners[index]]
+                for index in leaf_triangles:
+                    if skip is not None and objects[triangle_owners[index]] is skip:
+                        continue
+                    offset = index * 12
+                    v0x, v0y, v0z, e1x, e1y, e1z, e2x, e2y, e2z = triangles[offset:offset + 9]
+                    hx = dy * e2z - dz * e2y
+                    hy = dz * e2x - dx * e2z
+                    hz = dx * e2y - dy * e2x
+                    a = (e1x * hx) + (e1y * hy) + (e1z * hz)
+                    if -EPSILON < a < EPSILON:
+                        continue
+                    f = 1/a
+                    sx = ox - v0x
+                    sy = oy - v0y
+                    sz = oz - v0z
+                    u = f * ((sx * hx) + (sy * hy) + (sz * hz))
+                    if u < 0.0 or u > 1.0:
+                        continue
+                    qx = sy * e1z - sz * e1y
+                    qy = sz * e1x - sx * e1z
+                    qz = sx * e1y - sy * e1x
+                    v = f * ((dx * qx) + (dy * qy) + (dz * qz))
+                    if v < 0.0 or u + v > 1.0:
+                        continue
+                    distance = f * ((e2x * qx) + (e2y * qy) + (e2z * qz))
+                    if EPSILON < distance < max_distance:
+                        return objects[triangle_owners[index]]
+                for index in leaf_others:
+                    obj = objects[bounded_others[index][1]]
+                    if obj is not skip and obj.occluded(ray, max_distance):
+                        return obj
+
+        planes = self.planes
+        for index, owner in enumerate(self.plane_owners):
+            offset = index * 6
+            px, py, pz, nx, ny, nz = planes[offset:offset + 6]
+            denominator = (nx * dx) + (ny * dy) + (nz * dz)
+            if abs(denominator) >= 0.001:
+                distance = ((nx * (px - ox)) + (ny * (py - oy)) + (nz * (pz - oz))) / denominator
+                if 0.001 < distance < max_distance and objects[owner] is not skip:
+                    return objects[owner]
+        for _, index in self.unbounded_others:
+            obj = objects[index]
+            if obj is not skip and obj.occluded(ray, max_distance):
+                return obj
+        return None
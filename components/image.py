@@ -1,29 +1,176 @@
 from __future__ import annotations
+from array import array
 from io import TextIOWrapper
+from typing import BinaryIO, Iterable
+import mmap
+import struct
+import zlib
 
 from components import Color
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def rgb_bytes(values: array) -> bytes:
+    """Converts a flat array of r, g, b floats to 8 bit RGB, the same values of Color.to_RGB
+    Each color is scaled down by its brightest channel when it is over 1
+    """
+    if numpy is not None:
+        values = numpy.frombuffer(values, dtype=numpy.float64 if values.typecode == 'd' else numpy.float32)
+        values = values.astype(numpy.float64).reshape(-1, 3)
+        brightest = numpy.maximum(values.max(axis=1), 1)
+        rgb = (values * 255) // brightest[:, None]
+        return numpy.clip(rgb, 0, 255).astype(numpy.uint8).tobytes()
+
+    data = bytearray(len(values))
+    for offset in range(0, len(values), 3):
+        r, g, b = values[offset], values[offset + 1], values[offset + 2]
+        brightest = max(r, g, b, 1)
+        data[offset] = min(max(int((r * 255) // brightest), 0), 255)
+        data[offset + 1] = min(max(int((g * 255) // brightest), 0), 255)
+        data[offset + 2] = min(max(int((b * 255) // brightest), 0), 255)
+    return bytes(data)
+
+def color_array(colors: "Iterable[Color]", typecode: str = 'd') -> array:
+    """Flat array with the r, g, b values of the colors"""
+    values = array(typecode)
+    for color in colors:
+        values.extend((color.x, color.y, color.z))
+    return values
+
 class Image:
+    """Framebuffer of width x height pixels
+
+    Colors are stored as floats in a single flat array, three per pixel (r, g, b) row by row,
+    instead of one Color object per pixel.
+    Doubles are used so the written bytes are exactly the ones computed from the traced colors.
+    """
+    TYPECODE = 'd'
+
     def __init__(self, width: int, height: int) -> None:
         self.width = width
         self.height = height
-        self.pixels: list[list[Color]] = [[Color() for _ in range(width)] for _ in range(height)]
-    
+        self.buffer = array(self.TYPECODE, bytes(array(self.TYPECODE).itemsize * width * height * 3))
+
     def set_pixel(self, x: int, y: int, color: Color) -> None:
         """Sets color of pixel on column x and roll y as color, x=0 and y=0 it the top left of the image"""
-        self.pixels[y][x] = color
+        offset = (y * self.width + x) * 3
+        self.buffer[offset:offset + 3] = array(self.TYPECODE, (color.x, color.y, color.z))
+
+    def get_pixel(self, x: int, y: int) -> Color:
+        """Returns a new Color with the value of the pixel on column x and row y"""
+        offset = (y * self.width + x) * 3
+        return Color(*self.buffer[offset:offset + 3])
+
+    def set_tile(self, tile: "tuple[int, int, int, int]", colors: "Iterable[Color]") -> None:
+        """Sets the pixels of a tile (x_start, y_start, x_end, y_end) from its colors row by row"""
+        self.set_tile_values(tile, color_array(colors, self.TYPECODE))
+
+    def set_tile_values(self, tile: "tuple[int, int, int, int]", values: array) -> None:
+        """Sets the pixels of a tile from a flat array of r, g, b values, row by row"""
+        x_start, y_start, x_end, y_end = tile
+        row_size = (x_end - x_start) * 3
+        for row, y in enumerate(range(y_start, y_end)):
+            offset = (y * self.width + x_start) * 3
+            self.buffer[offset:offset + row_size] = values[row * row_size:(row + 1) * row_size]
+
+    @property
+    def pixels(self) -> "list[list[Color]]":
+        """Colors as a list of rows, built on every access, prefer get_pixel or buffer"""
+        return [[self.get_pixel(x, y) for x in range(self.width)] for y in range(self.height)]
+
+    def to_bytes(self) -> bytes:
+        """Returns the 8 bit RGB value of every pixel, row by row, the same values of Color.to_RGB"""
+        return rgb_bytes(self.buffer)
 
     def write_ppm(self, img_file: TextIOWrapper) -> None:
-        """Writes image on a ppm file"""
+        """Writes image on a ppm file (ASCII P3)"""
         # Header of file
         img_file.write("P3 {} {}\n255\n".format(self.width, self.height))
 
         # Writes each pixel
-        for row in self.pixels:
-            for color in row:
+        for y in range(self.height):
+            for x in range(self.width):
                 img_file.write(
                     '{} {} {} '.format(
-                        *color.to_RGB()
+                        *self.get_pixel(x, y).to_RGB()
                     )
                 )
-            img_file.write('\n')
\ No newline at end of file
+            img_file.write('\n')
+
+    def write_ppm_binary(self, img_file: BinaryIO) -> None:
+        """Writes image on a binary ppm file (P6) with a single write, img_file must be opened in binary mode"""
+        img_file.write(b"P6 %d %d\n255\n" % (self.width, self.height) + self.to_bytes())
+
+    def write_png(self, img_file: BinaryIO, compression: int = 6) -> None:
+        """Writes image on a png file (8 bit RGB), img_file must be opened in binary mode"""
+        data = self.to_bytes()
+        row_size = self.width * 3
+        # Every scanline starts with its filter type, 0 means no filter
+        scanlines = b"".join(
+            b"\x00" + data[row * row_size:(row + 1) * row_size] for row in range(self.height))
+
+        def chunk(kind: bytes, content: bytes) -> bytes:
+            return struct.pack(">I", len(content)) + kind + content + struct.pack(">I", zlib.crc32(kind + content))
+
+        header = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+        img_file.write(
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(scanlines, compression))
+            + chunk(b"IEND", b""))
+
+    def save(self, path: str) -> None:
+        """Writes the image choosing the format by extension: .png for PNG, anything else as binary PPM"""
+        with open(path, 'wb') as img_file:
+            if path.lower().endswith('.png'):
+                self.write_png(img_file)
+            else:
+                self.write_ppm_binary(img_file)
+
+
+class PPMStreamWriter:
+    """Writes a binary PPM (P6) tile by tile as the render progresses
+
+    The file is created at its final size with a black image and memory mapped,
+    each tile is copied into place as soon as it arrives, in any order.
+    Rows already written survive if the render crashes or is interrupted,
+    and other programs can read the file while it is being rendered.
+    """
+    def __init__(self, path: str, width: int, height: int, flush_every: int = 1) -> None:
+        self.path = path
+        self.width = width
+        self.height = height
+        self.flush_every = flush_every
+        self.header = b"P6 %d %d\n255\n" % (width, height)
+        self.tiles_written = 0
+        self.file = open(path, 'w+b')
+        self.file.truncate(len(self.header) + width * height * 3)
+        self.data = mmap.mmap(self.file.fileno(), 0)
+        self.data[:len(self.header)] = self.header
+
+    def write_tile(self, tile: "tuple[int, int, int, int]", colors: "Iterable[Color]") -> None:
+        """Copies the colors of a tile (x_start, y_start, x_end, y_end), given row by row, into the file"""
+        x_start, y_start, x_end, y_end = tile
+        data = rgb_bytes(color_array(colors))
+        row_size = (x_end - x_start) * 3
+        for row, y in enumerate(range(y_start, y_end)):
+            offset = len(self.header) + (y * self.width + x_start) * 3
+            self.data[offset:offset + row_size] = data[row * row_size:(row + 1) * row_size]
+        self.tiles_written += 1
+        if self.tiles_written % self.flush_every == 0:
+            self.data.flush()
+
+    def close(self) -> None:
+        if not self.data.closed:
+            self.data.flush()
+            self.data.close()
+            self.file.close()
+
+    def __enter__(self) -> PPMStreamWriter:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
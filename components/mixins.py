@@ -1,7 +1,89 @@
 from abc import abstractmethod
 import math
 
+IDENTITY = [
+    [1, 0, 0, 0],
+    [0, 1, 0, 0],
+    [0, 0, 1, 0],
+    [0, 0, 0, 1]]
+
+def affine_matrix(matrix: list[list[float]]) -> list[list[float]]:
+    """Returns a new 4x4 matrix from a 3x3 or 4x4 one, 3x3 matrices get no translation"""
+    if len(matrix) == 3:
+        return [list(row) + [0] for row in matrix] + [[0, 0, 0, 1]]
+    return [list(row) for row in matrix]
+
+def matrix_multiply(A: list[list[float]], B: list[list[float]]) -> list[list[float]]:
+    """Returns the product A B of two matrices"""
+    m = len(A)
+    n = len(B[0])
+    product = []
+    for i in range(m):
+        row = []
+        for j in range(n):
+            element = 0
+            for k in range(len(B)):
+                element += A[i][k] * B[k][j]
+            row.append(element)
+        product.append(row)
+    return product
+
+def invert_affine(matrix: list[list[float]]) -> list[list[float]]:
+    """Returns the inverse of a 4x4 affine matrix (last row 0, 0, 0, 1), raises ValueError if it is singular"""
+    (a, b, c, tx), (d, e, f, ty), (g, h, i, tz) = matrix[0], matrix[1], matrix[2]
+    cofactor_a = e * i - f * h
+    cofactor_b = f * g - d * i
+    cofactor_c = d * h - e * g
+    determinant = a * cofactor_a + b * cofactor_b + c * cofactor_c
+    if determinant == 0:
+        raise ValueError("Singular transformation matrix")
+    inverse = [
+        [cofactor_a / determinant, (c * h - b * i) / determinant, (b * f - c * e) / determinant],
+        [cofactor_b / determinant, (a * i - c * g) / determinant, (c * d - a * f) / determinant],
+        [cofactor_c / determinant, (b * g - a * h) / determinant, (a * e - b * d) / determinant]]
+    for row in inverse:
+        row.append(-(row[0] * tx + row[1] * ty + row[2] * tz))
+    inverse.append([0, 0, 0, 1])
+    return inverse
+
+def rotation_matrix(point, vector, angle: float) -> list[list[float]]:
+    """Returns the 4x4 matrix rotating by angle(degrees) around the axis defined by a point and a vector clockwise"""
+    # Convert angle from degrees to radians
+    angle = math.radians(angle)
+    
+    # Normalize the axis vector
+    axis = vector.normalize()
+    
+    # Calculate the rotation matrix
+    cos_a = math.cos(angle)
+    sin_a = math.sin(angle)
+    ux = axis.x
+    uy = axis.y
+    uz = axis.z
+    rot_matrix = [
+        [cos_a + ux**2*(1-cos_a), ux*uy*(1-cos_a) - uz*sin_a, ux*uz*(1-cos_a) + uy*sin_a, 0],
+        [uy*ux*(1-cos_a) + uz*sin_a, cos_a + uy**2*(1-cos_a), uy*uz*(1-cos_a) - ux*sin_a, 0],
+        [uz*ux*(1-cos_a) - uy*sin_a, uz*uy*(1-cos_a) + ux*sin_a, cos_a + uz**2*(1-cos_a), 0],
+        [0, 0, 0, 1]]
+
+    to_origin_matrix = [
+        [1, 0, 0, -point.x],
+        [0, 1, 0, -point.y],
+        [0, 0, 1, -point.z], 
+        [0, 0, 0, 1]]
+
+    back_from_origin_matrix = [
+        [1, 0, 0, point.x],
+        [0, 1, 0, point.y],
+        [0, 0, 1, point.z], 
+        [0, 0, 0, 1]]
+
+    return matrix_multiply(back_from_origin_matrix, matrix_multiply(rot_matrix, to_origin_matrix))
+
 class LinearTransformationsMixin:
+    # Empty slots so classes like Vector3 can drop their per instance __dict__
+    __slots__ = ()
+
     @abstractmethod
     def transform(self, matrix: list[list[float]]) -> any:
         """Returns the tranformed object using a 3x3 or 4x4 matrix"""
@@ -19,53 +101,7 @@ class LinearTransformationsMixin:
 
     def rotate(self, point, vector, angle: float) -> any:
         """Return the object after being rotated by angle(degrees) around the axis defined by a point and a vector clockwise"""
-        # Convert angle from degrees to radians
-        angle = math.radians(angle)
-        
-        # Normalize the axis vector
-        axis = vector.normalize()
-        
-        # Calculate the rotation matrix
-        cos_a = math.cos(angle)
-        sin_a = math.sin(angle)
-        ux = axis.x
-        uy = axis.y
-        uz = axis.z
-        rot_matrix = [
-            [cos_a + ux**2*(1-cos_a), ux*uy*(1-cos_a) - uz*sin_a, ux*uz*(1-cos_a) + uy*sin_a, 0],
-            [uy*ux*(1-cos_a) + uz*sin_a, cos_a + uy**2*(1-cos_a), uy*uz*(1-cos_a) - ux*sin_a, 0],
-            [uz*ux*(1-cos_a) - uy*sin_a, uz*uy*(1-cos_a) + ux*sin_a, cos_a + uz**2*(1-cos_a), 0],
-            [0, 0, 0, 1]]
-
-        to_origin_matrix = [
-            [1, 0, 0, -point.x],
-            [0, 1, 0, -point.y],
-            [0, 0, 1, -point.z], 
-            [0, 0, 0, 1]]
-
-        back_from_origin_matrix = [
-            [1, 0, 0, point.x],
-            [0, 1, 0, point.y],
-            [0, 0, 1, point.z], 
-            [0, 0, 0, 1]]
-
-        def matrix_multiply(A, B):
-            m = len(A)
-            n = len(B[0])
-            product = []
-            for i in range(m):
-                row = []
-                for j in range(n):
-                    element = 0
-                    for k in range(len(B)):
-                        element += A[i][k] * B[k][j]
-                    row.append(element)
-                product.append(row)
-            return product
-
-        final_matrix = matrix_multiply(back_from_origin_matrix, matrix_multiply(rot_matrix, to_origin_matrix))
-
-        return self.transform(final_matrix)
+        return self.transform(rotation_matrix(point, vector, angle))
 
     def scale(self, vector) -> any:
         distotion_matrix = [
@@ -1,6 +1,8 @@
 from __future__ import annotations
 from abc import abstractmethod
-from components import Material, Vector3, Point, Ray, LinearTransformationsMixin
+from components import Material, Vector3, Point, Ray, LinearTransformationsMixin, AABB, BVH, affine_matrix, invert_affine, matrix_multiply, rotation_matrix
+from components.mixins import IDENTITY
+from array import array
 import math
 
 class Object3D(LinearTransformationsMixin):
@@ -14,6 +16,8 @@ class Object3D(LinearTransformationsMixin):
     
     - normal method
 
+    Objects can also give a bounding_box so the scene can index them in a BVH,
+    objects without one (like planes) are treated as unbounded.
     """
     def __init__(self, material: Material) -> None:
         self.material = material
@@ -29,6 +33,17 @@ class Object3D(LinearTransformationsMixin):
         """Returns the normal of the Object3D surface in a given point"""
         pass
 
+    def bounding_box(self) -> "AABB | None":
+        """Returns the axis aligned box containing the object, None if it is unbounded"""
+        return None
+
+    def occluded(self, ray: Ray, max_distance: float) -> bool:
+        """Checks if the object blocks the ray before max_distance, like intersects but without the normal
+        Objects should override it when they can skip work intersects does
+        """
+        distance, _ = self.intersects(ray)
+        return distance is not None and distance < max_distance
+
 
 class Sphere(Object3D):
     """3D sphere shape, has center, radius and material"""
@@ -63,10 +78,29 @@ class Sphere(Object3D):
                 return distance, self._get_normal(hit_point)
         return None, None
     
+    def occluded(self, ray: Ray, max_distance: float) -> bool:
+        """Same distances as intersects, without the hit point and normal"""
+        sphere_to_ray = ray.origin - self.center
+        b = 2 * (ray.direction ^ sphere_to_ray)
+        c = (sphere_to_ray ^ sphere_to_ray) - self.radius ** 2
+        discriminant = (b**2) - (4*c)
+
+        if discriminant >= 0:
+            distance = (-b - math.sqrt(discriminant)) / 2
+            if distance > 0.001:
+                return distance < max_distance
+            distance = (-b + math.sqrt(discriminant)) / 2
+            return 0.001 < distance < max_distance
+        return False
+
     def _get_normal(self, surface_point: Point) -> Vector3:
         """Returns surface normal to the point on the sphere's surface"""
         return (surface_point-self.center).normalize()
 
+    def bounding_box(self) -> AABB:
+        radius = Vector3(self.radius, self.radius, self.radius)
+        return AABB(self.center - radius, self.center + radius).padded()
+
     def transform(self, matrix: list[list[float]]) -> Object3D:
         new_center = self.center.transform(matrix)
         return Sphere(new_center, self.radius, self.material)
@@ -165,32 +199,109 @@ class Triangle(Object3D):
         new_vertex_2 = self.vertex_2.transform(matrix)
         return Triangle(new_vertex_0, new_vertex_1, new_vertex_2, self.material)
 
+    def bounding_box(self) -> AABB:
+        return AABB.from_points([self.vertex_0, self.vertex_1, self.vertex_2])
+
 class TriangleMesh(Object3D):
+    """Mesh of triangles sharing a list of vertices
+
+    Edges and normals of every face are computed once and stored in a flat array,
+    FACE_STRIDE floats per face: vertex_0, edge1, edge2 and normal.
+    Faces are indexed in their own BVH so a ray only tests the few faces close to it.
+    """
+    FACE_STRIDE = 12
+
     def __init__(self, list_vertices: list[Point], list_triangles: list[tuple[int, int, int]], material: Material) -> None:
         super().__init__(material)
         self.list_vertices = list_vertices
         self.list_triangles = list_triangles
+        self.face_data = array('d')
+        boxes = []
+        for triangle_data in list_triangles:
+            vertex_0 = list_vertices[triangle_data[0]]
+            vertex_1 = list_vertices[triangle_data[1]]
+            vertex_2 = list_vertices[triangle_data[2]]
+            edge1 = vertex_1 - vertex_0
+            edge2 = vertex_2 - vertex_0
+            normal = edge1.cross_product(edge2).normalize()
+            self.face_data.extend((
+                vertex_0.x, vertex_0.y, vertex_0.z,
+                edge1.x, edge1.y, edge1.z,
+                edge2.x, edge2.y, edge2.z,
+                normal.x, normal.y, normal.z))
+            boxes.append(AABB.from_points([vertex_0, vertex_1, vertex_2]))
+        self.bvh = BVH(boxes)
+
+    @classmethod
+    def from_face_data(
+            cls, list_vertices: list[Point], list_triangles: list[tuple[int, int, int]],
+            face_data: array, bvh: BVH, material: Material) -> TriangleMesh:
+        """Builds a mesh from face data and a BVH computed before, skipping the work done on __init__"""
+        mesh = cls.__new__(cls)
+        Object3D.__init__(mesh, material)
+        mesh.list_vertices = list_vertices
+        mesh.list_triangles = list_triangles
+        mesh.face_data = face_data
+        mesh.bvh = bvh
+        return mesh
+
+    def _intersect_face(self, index: int, ray: Ray) -> "tuple[float, None] | tuple[None, None]":
+        """Same test as Triangle.intersects, over the precomputed face data and without allocations"""
+        EPSILON = 0.001
+        offset = index * self.FACE_STRIDE
+        v0x, v0y, v0z, e1x, e1y, e1z, e2x, e2y, e2z = self.face_data[offset:offset + 9]
+        direction = ray.direction
+        dx, dy, dz = direction.x, direction.y, direction.z
+        hx = dy * e2z - dz * e2y
+        hy = dz * e2x - dx * e2z
+        hz = dx * e2y - dy * e2x
+        a = (e1x * hx) + (e1y * hy) + (e1z * hz)
+        if -EPSILON < a < EPSILON:
+            return None, None
+        f = 1/a
+        origin = ray.origin
+        sx = origin.x - v0x
+        sy = origin.y - v0y
+        sz = origin.z - v0z
+        u = f * ((sx * hx) + (sy * hy) + (sz * hz))
+        if u < 0.0 or u > 1.0:
+            return None, None
+        qx = sy * e1z - sz * e1y
+        qy = sz * e1x - sx * e1z
+        qz = sx * e1y - sy * e1x
+        v = f * ((dx * qx) + (dy * qy) + (dz * qz))
+        if v < 0.0 or u + v > 1.0:
+            return None, None
+        t = f * ((e2x * qx) + (e2y * qy) + (e2z * qz))
+        if t > EPSILON:
+            return t, None
+        return None, None
+
+    def face_normal(self, index: int) -> Vector3:
+        """Returns the precomputed normal of a face"""
+        offset = index * self.FACE_STRIDE + 9
+        return Vector3(*self.face_data[offset:offset + 3])
 
     def intersects(self, ray: Ray) -> "tuple[float, Vector3] | tuple[None, None]":
-        distance_min = None
-        hit_normal = None
-        for triangle_data in self.list_triangles:
-            vertecies = (
-                self.list_vertices[triangle_data[0]],
-                self.list_vertices[triangle_data[1]],
-                self.list_vertices[triangle_data[2]]
-            )
-            triangle = Triangle(*vertecies, self.material)
-            distance, normal = triangle.intersects(ray)
-            if distance is not None and (distance_min is None or distance < distance_min):
-                distance_min = distance
-                hit_normal = normal
-
-        return distance_min, hit_normal
+        distance, _, face = self.bvh.nearest(ray, self._intersect_face)
+        if face is None:
+            return None, None
+        return distance, self.face_normal(face)
+
+    def _occludes_face(self, index: int, ray: Ray, max_distance: float) -> bool:
+        distance, _ = self._intersect_face(index, ray)
+        return distance is not None and distance < max_distance
+
+    def occluded(self, ray: Ray, max_distance: float) -> bool:
+        """Stops at the first face closer than max_distance"""
+        return self.bvh.any_hit(ray, self._occludes_face, max_distance) is not None
 
     def _get_normal(self, triangle: Triangle) -> Vector3:
         return triangle._get_normal()
 
+    def bounding_box(self) -> "AABB | None":
+        return self.bvh.bounding_box()
+
     def transform(self, matrix: list[list[float]]) -> Object3D:
         new_verticies = []
         for vertex in self.list_vertices:
@@ -202,24 +313,41 @@ class TriangleMesh(Object3D):
 class BezierCurve:
     def __init__(self, control_points: list[Point]):
         self.control_points = control_points
+        n = len(control_points) - 1
+        # Binomial coefficients of the Bernstein basis, the same for every t
+        self.binomials = [math.comb(n, i) for i in range(n + 1)]
 
     def __call__(self, t: float) -> Point:
         n = len(self.control_points) - 1
-        point = Vector3()
-        for i in range(n + 1):
-            binomial = math.comb(n, i)
+        x = y = z = 0.0
+        for i, (binomial, control_point) in enumerate(zip(self.binomials, self.control_points)):
             basis = binomial * (1 - t) ** (n - i) * t ** i
-            point += basis * self.control_points[i]
-        return point
+            x += basis * control_point.x
+            y += basis * control_point.y
+            z += basis * control_point.z
+        return Point(x, y, z)
 
 
 class RevolutionSurface(Object3D):
+    """Surface swept by a Bezier curve turning around the axis defined by a point and a vector
+
+    The surface is tessellated into a TriangleMesh of resolution x resolution vertices: the curve is evaluated once
+    per row and each column turns the whole row by the same rotation matrix. Surfaces with the same curve,
+    resolution and axis share their mesh, the last MESH_CACHE_SIZE meshes are kept.
+    Rays are first tested against a capped cylinder around the axis holding the control points, which holds
+    the whole surface, since a Bezier curve stays in the convex hull of its control points.
+    """
+    MESH_CACHE_SIZE = 32
+    # Vertices, triangles, face data and BVH of the last meshes, by curve, resolution and axis
+    _meshes: "dict[tuple, tuple]" = {}
+
     def __init__(self, control_points: list[Point], resolution: int, point: Point, vector: Vector3, material: Material):
         super().__init__(material)
         self.bezier_curve = BezierCurve(control_points)
         self.point = point
         self.vector = vector
         self.triangle_mesh = self.generate_mesh(resolution)
+        self.bounds = self.bounding_cylinder()
 
     def evaluate_point(self, u, v):
         """Evaluate a point on the revolution surface at (u, v)"""
@@ -227,24 +355,37 @@ class RevolutionSurface(Object3D):
 
         # Rotate the point around the line
         theta = math.degrees(2 * math.pi * v)
-        point_on_curve.rotate(self.point, self.vector, theta)
-
         return point_on_curve.rotate(self.point, self.vector, theta)
 
     def generate_mesh(self, resolution):
         """Generate a triangle mesh for the revolution surface"""
+        key = (tuple(tuple(point) for point in self.bezier_curve.control_points), resolution,
+               tuple(self.point), tuple(self.vector))
+        meshes = RevolutionSurface._meshes
+        if key in meshes:
+            # Moved to the end, the least recently used mesh is the first one
+            meshes[key] = meshes.pop(key)
+            return TriangleMesh.from_face_data(*meshes[key], self.material)
+
+        # Same points as evaluate_point(u, v) for every u and v, curve and matrices computed once per row and column
+        profile = [self.bezier_curve(i / (resolution - 1)) for i in range(resolution)]
+        rotations = []
+        for j in range(resolution):
+            v = j / (resolution - 1)
+            matrix = rotation_matrix(self.point, self.vector, math.degrees(2 * math.pi * v))
+            rotations.append(matrix[0] + matrix[1] + matrix[2])
         vertices = []
-        indices = []
-
-        # Generate the vertices and normals
-        for i in range(resolution):
-            u = i / (resolution - 1)
-            for j in range(resolution):
-                v = j / (resolution - 1)
-                point = self.evaluate_point(u, v)
-                vertices.append(point)
+        for point in profile:
+            x, y, z = point.x, point.y, point.z
+            w = 1.0
+            for m in rotations:
+                vertices.append(Point(
+                    x * m[0] + y * m[1] + z * m[2] + w * m[3],
+                    x * m[4] + y * m[5] + z * m[6] + w * m[7],
+                    x * m[8] + y * m[9] + z * m[10] + w * m[11]))
 
         # Generate the indices for the triangle mesh
+        indices = []
         for i in range(resolution - 1):
             for j in range(resolution - 1):
                 a = i * resolution + j
@@ -253,10 +394,146 @@ class RevolutionSurface(Object3D):
                 d = (i + 1) * resolution + j
                 indices.extend([[a, b, c], [a, c, d]])
 
-        return TriangleMesh(vertices, indices, self.material)
+        mesh = TriangleMesh(vertices, indices, self.material)
+        meshes[key] = (mesh.list_vertices, mesh.list_triangles, mesh.face_data, mesh.bvh)
+        if len(meshes) > self.MESH_CACHE_SIZE:
+            del meshes[next(iter(meshes))]
+        return mesh
+
+    def bounding_cylinder(self) -> "tuple[float, ...]":
+        """Returns the cylinder around the axis holding the control points, as the axis point and unit vector,
+        the squared radius and the lowest and highest distances along the axis, slightly padded
+        """
+        axis = self.vector.normalize()
+        radius2, low, high = 0.0, math.inf, -math.inf
+        for control_point in self.bezier_curve.control_points:
+            offset = control_point - self.point
+            height = offset ^ axis
+            radius2 = max(radius2, (offset ^ offset) - height * height)
+            low = min(low, height)
+            high = max(high, height)
+        margin = 1e-7 * (1 + max(abs(low), abs(high), math.sqrt(radius2)))
+        radius = math.sqrt(radius2) + margin
+        return (self.point.x, self.point.y, self.point.z, axis.x, axis.y, axis.z,
+                radius * radius, low - margin, high + margin)
+
+    def _may_hit(self, ray: Ray, max_distance: float) -> bool:
+        """Checks if the ray gets into the bounding cylinder before max_distance"""
+        px, py, pz, ax, ay, az, radius2, low, high = self.bounds
+        origin = ray.origin
+        direction = ray.direction
+        wx, wy, wz = origin.x - px, origin.y - py, origin.z - pz
+        dx, dy, dz = direction.x, direction.y, direction.z
+        w_axis = wx * ax + wy * ay + wz * az
+        d_axis = dx * ax + dy * ay + dz * az
+
+        # Part of the ray between the caps
+        near, far = 0.0, max_distance
+        if d_axis == 0:
+            if not low <= w_axis <= high:
+                return False
+        else:
+            t0 = (low - w_axis) / d_axis
+            t1 = (high - w_axis) / d_axis
+            if t0 > t1:
+                t0, t1 = t1, t0
+            near = max(near, t0)
+            far = min(far, t1)
+            if near > far:
+                return False
+
+        # Part of the ray inside the side, components perpendicular to the axis
+        wx, wy, wz = wx - w_axis * ax, wy - w_axis * ay, wz - w_axis * az
+        dx, dy, dz = dx - d_axis * ax, dy - d_axis * ay, dz - d_axis * az
+        a = dx * dx + dy * dy + dz * dz
+        b = wx * dx + wy * dy + wz * dz
+        c = wx * wx + wy * wy + wz * wz - radius2
+        if a == 0:
+            return c <= 0
+        discriminant = b * b - a * c
+        if discriminant < 0:
+            return False
+        root = math.sqrt(discriminant)
+        return max(near, (-b - root) / a) <= min(far, (-b + root) / a)
 
     def intersects(self, ray: Ray) -> "tuple[float, Vector3] | tuple[None, None]":
+        if not self._may_hit(ray, math.inf):
+            return None, None
         return self.triangle_mesh.intersects(ray)
 
+    def occluded(self, ray: Ray, max_distance: float) -> bool:
+        return self._may_hit(ray, max_distance) and self.triangle_mesh.occluded(ray, max_distance)
+
     def _get_normal(self, triangle: Triangle) -> Vector3:
-        return self.triangle_mesh._get_normal(triangle)
\ No newline at end of file
+        return self.triangle_mesh._get_normal(triangle)
+
+    def bounding_box(self) -> AABB:
+        return self.triangle_mesh.bounding_box()
+
+
+class Instance(Object3D):
+    """Object placed in the scene by a transformation, sharing its geometry instead of copying it
+
+    The forward matrix and its inverse are computed once, rays are moved into the space of the object
+    when they are intersected, so many instances of a big mesh cost the memory of one mesh.
+    Transforming an instance, or making an instance of an instance, composes the matrices into one.
+    Instances have the material of their object unless they are given one.
+    """
+    def __init__(self, obj: Object3D, matrix: "list[list[float]] | None" = None, material: "Material | None" = None) -> None:
+        material = material or obj.material
+        matrix = affine_matrix(matrix if matrix is not None else IDENTITY)
+        if isinstance(obj, Instance):
+            matrix = matrix_multiply(matrix, obj.matrix)
+            obj = obj.object
+        super().__init__(material)
+        self.object = obj
+        self.matrix = matrix
+        self.inverse = invert_affine(matrix)
+        # Rows of the inverse without the last one, flattened for _object_ray
+        self._inverse = tuple(value for row in self.inverse[:3] for value in row)
+
+    def __str__(self) -> str:
+        return '-Instance:' \
+        f'\tObject: {self.object}' \
+        f'\tMatrix: {self.matrix}'
+
+    def _object_ray(self, ray: Ray) -> "tuple[Ray, float]":
+        """Returns the ray in the space of the object and the length the ray's unit direction has there"""
+        m00, m01, m02, m03, m10, m11, m12, m13, m20, m21, m22, m23 = self._inverse
+        origin = ray.origin
+        direction = ray.direction
+        x, y, z = origin.x, origin.y, origin.z
+        dx, dy, dz = direction.x, direction.y, direction.z
+        object_direction = Vector3(
+            m00 * dx + m01 * dy + m02 * dz, m10 * dx + m11 * dy + m12 * dz, m20 * dx + m21 * dy + m22 * dz)
+        object_origin = Point(
+            m00 * x + m01 * y + m02 * z + m03, m10 * x + m11 * y + m12 * z + m13, m20 * x + m21 * y + m22 * z + m23)
+        return Ray(object_origin, object_direction), object_direction.magnitude()
+
+    def intersects(self, ray: Ray) -> "tuple[float, Vector3] | tuple[None, None]":
+        object_ray, scale = self._object_ray(ray)
+        distance, normal = self.object.intersects(object_ray)
+        if distance is None:
+            return None, None
+        return distance / scale, self._get_normal(normal)
+
+    def occluded(self, ray: Ray, max_distance: float) -> bool:
+        object_ray, scale = self._object_ray(ray)
+        return self.object.occluded(object_ray, max_distance * scale)
+
+    def _get_normal(self, object_normal: Vector3) -> Vector3:
+        """Returns the normal in the scene of a normal of the object, transformed by the inverse transpose"""
+        m00, m01, m02, _, m10, m11, m12, _, m20, m21, m22, _ = self._inverse
+        x, y, z = object_normal.x, object_normal.y, object_normal.z
+        return Vector3(m00 * x + m10 * y + m20 * z, m01 * x + m11 * y + m21 * z, m02 * x + m12 * y + m22 * z).normalize()
+
+    def bounding_box(self) -> "AABB | None":
+        box = self.object.bounding_box()
+        if box is None:
+            return None
+        low, high = box.minimum, box.maximum
+        corners = [Point(x, y, z) for x in (low.x, high.x) for y in (low.y, high.y) for z in (low.z, high.z)]
+        return AABB.from_points([corner.transform(self.matrix) for corner in corners])
+
+    def transform(self, matrix: list[list[float]]) -> Object3D:
+        return Instance(self, matrix, self.material)
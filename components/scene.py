@@ -1,10 +1,18 @@
 from __future__ import annotations
-from components import Camera, Light, Object3D, Color
+from components import Camera, Light, Object3D, Color, BVH, Ray, Vector3
+from typing import TYPE_CHECKING
+import copy
+
+if TYPE_CHECKING:
+    from components.compiled import CompiledScene
 
 
 class Scene:
     """All the information needed to render a image with the ray tracing engine
     Has a camera, a list of objects, a width and a height
+
+    Bounded objects are indexed in a BVH built on first use,
+    unbounded ones (planes) are kept in a side list and tested against every ray.
     """
     def __init__(
             self,
@@ -22,4 +30,106 @@ class Scene:
         self.width = camera.h_res
         self.height = camera.v_res
         self.bg_color = bg_color
-        self.max_depth = max_depth
\ No newline at end of file
+        self.max_depth = max_depth
+        self._bvh: "BVH | None" = None
+        # Counts the builds of the BVH, so caches of the objects know they were edited
+        self.version = 0
+        self.bounded_objects: list[tuple[int, Object3D]] = []
+        self.unbounded_objects: list[tuple[int, Object3D]] = []
+
+    @property
+    def bvh(self) -> BVH:
+        """BVH over the bounded objects, built once per scene"""
+        if self._bvh is None:
+            self.build_bvh()
+        return self._bvh
+
+    def build_bvh(self) -> None:
+        """(Re)builds the BVH, must be called again if the objects list, the objects or their materials
+        are changed after rendering started
+        """
+        self.version += 1
+        self.bounded_objects = []
+        self.unbounded_objects = []
+        boxes = []
+        for index, obj in enumerate(self.objects):
+            box = obj.bounding_box()
+            if box is None:
+                self.unbounded_objects.append((index, obj))
+            else:
+                self.bounded_objects.append((index, obj))
+                boxes.append(box)
+
+        # A tree that fits in a single leaf only adds overhead, so tiny scenes are searched linearly
+        if len(boxes) <= BVH.LEAF_SIZE:
+            self.unbounded_objects = list(enumerate(self.objects))
+            self.bounded_objects = []
+            boxes = []
+        self._bvh = BVH(boxes)
+
+    def with_camera(self, camera: Camera) -> Scene:
+        """Returns the scene seen from another camera with the same resolution,
+        sharing the objects, lights and BVH with this scene instead of building them again
+        """
+        self.bvh
+        scene = copy.copy(self)
+        scene.camera = camera
+        return scene
+
+    def compile(self) -> CompiledScene:
+        """Returns the scene frozen into flat arrays of each primitive type (see CompiledScene),
+        which finds the same hits faster. This scene stays editable, compile it again after editing it
+        """
+        from components.compiled import CompiledScene
+        return CompiledScene(self)
+
+    def _intersect_bounded(self, index: int, ray: Ray) -> "tuple[float, Vector3] | tuple[None, None]":
+        return self.bounded_objects[index][1].intersects(ray)
+
+    def _occludes_bounded(self, index: int, ray: Ray, max_distance: float) -> bool:
+        return self.bounded_objects[index][1].occluded(ray, max_distance)
+
+    def occluder(self, ray: Ray, max_distance: float, skip: "Object3D | None" = None) -> "Object3D | None":
+        """Returns any object blocking the ray before max_distance, None if there is none
+        Stops at the first blocker found, which isn't necessarily the closest one.
+        skip is an object already known not to block the ray, it isn't tested again
+        """
+        bvh = self.bvh
+        if bvh.size:
+            occludes = self._occludes_bounded
+            if skip is not None:
+                bounded_objects = self.bounded_objects
+                occludes = lambda index, ray, max_distance: \
+                    bounded_objects[index][1] is not skip and bounded_objects[index][1].occluded(ray, max_distance)
+            bvh_index = bvh.any_hit(ray, occludes, max_distance)
+            if bvh_index is not None:
+                return self.bounded_objects[bvh_index][1]
+        for _, obj in self.unbounded_objects:
+            if obj is not skip and obj.occluded(ray, max_distance):
+                return obj
+        return None
+
+    def find_nearest(self, ray: Ray) -> "tuple[float, Vector3, Object3D] | tuple[None, None, None]":
+        """Finds the closest object hit by the ray, traversing the BVH and then the unbounded objects
+        Ties are broken by the position of the objects in the list, like a linear search would
+        """
+        bvh = self.bvh
+        if bvh.size:
+            distance_min, hit_normal, bvh_index = bvh.nearest(ray, self._intersect_bounded)
+        else:
+            distance_min, hit_normal, bvh_index = None, None, None
+        if bvh_index is None:
+            object_index, object_hit = None, None
+        else:
+            object_index, object_hit = self.bounded_objects[bvh_index]
+
+        for index, obj in self.unbounded_objects:
+            distance, normal = obj.intersects(ray)
+            if distance is not None and (
+                    object_hit is None or distance < distance_min
+                    or (distance == distance_min and index < object_index)):
+                distance_min = distance
+                hit_normal = normal
+                object_index, object_hit = index, obj
+
+        return distance_min, hit_normal, object_hit
\ No newline at end of file
@@ -1,10 +1,18 @@
 from __future__ import annotations
-from components import LinearTransformationsMixin
+from components import LinearTransformationsMixin, affine_matrix
 import math
 
 class Vector3(LinearTransformationsMixin):
+    """Simple 3D Vector Class with basic operations
+
+    Operators check their operands with asserts (removed when running with python -O)
+    and always return a new vector. The i* methods (iadd, isub, imul, imul_add, inormalize)
+    skip the checks and update the vector in place, for inner loops that would otherwise
+    allocate a temporary per operation. They return the vector itself so calls can be chained.
+    """
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, x=.0, y=.0, z=.0) -> None:
-        """Simple 3D Vector Class with basic operations"""
         self.x = x
         self.y = y
         self.z = z
@@ -37,7 +45,44 @@ class Vector3(LinearTransformationsMixin):
     
     def normalize(self) -> Vector3:
         """Returns the normalized Vector"""
-        return self / self.magnitude()
+        magnitude = math.sqrt((self.x * self.x) + (self.y * self.y) + (self.z * self.z)) or 1
+        return self.__class__(self.x / magnitude, self.y / magnitude, self.z / magnitude)
+
+    def iadd(self, other: Vector3) -> Vector3:
+        """Adds other to this vector in place"""
+        self.x += other.x
+        self.y += other.y
+        self.z += other.z
+        return self
+
+    def isub(self, other: Vector3) -> Vector3:
+        """Subtracts other from this vector in place"""
+        self.x -= other.x
+        self.y -= other.y
+        self.z -= other.z
+        return self
+
+    def imul(self, scalar: float) -> Vector3:
+        """Multiplies this vector by a scalar in place"""
+        self.x *= scalar
+        self.y *= scalar
+        self.z *= scalar
+        return self
+
+    def imul_add(self, other: Vector3, scalar: float) -> Vector3:
+        """Adds other * scalar to this vector in place, without the temporary vector"""
+        self.x += other.x * scalar
+        self.y += other.y * scalar
+        self.z += other.z * scalar
+        return self
+
+    def inormalize(self) -> Vector3:
+        """Normalizes this vector in place"""
+        magnitude = math.sqrt((self.x * self.x) + (self.y * self.y) + (self.z * self.z)) or 1
+        self.x /= magnitude
+        self.y /= magnitude
+        self.z /= magnitude
+        return self
     
     def __add__(self, other: Vector3) -> Vector3:
         """Returns the sum of the two Vectors"""
@@ -91,9 +136,7 @@ class Vector3(LinearTransformationsMixin):
             and (len(matrix) == 3 or len(matrix) == 4) \
             and all(len(row) == 3 or len(row) == 4 for row in matrix), "Invalid matrix"
         if len(matrix) == 3:
-            for row in matrix:
-                row.append(0)
-            matrix.append([0,0,0,1])
+            matrix = affine_matrix(matrix)
 
         x, y, z = self.x, self.y, self.z
         w = 1.0
@@ -105,6 +148,8 @@ class Vector3(LinearTransformationsMixin):
 
 class Color(Vector3):
     """Stores colors as RGB triplets, based of Vector3"""
+    __slots__ = ()
+
     @classmethod
     def from_hex(cls, hex="#000000") -> Color:
         """Creates Color from hexcode"""
@@ -124,4 +169,4 @@ class Color(Vector3):
 
 class Point(Vector3):
     """Point stores coordinates of a point in 3D space, based on Vector"""
-    pass
\ No newline at end of file
+    __slots__ = ()
\ No newline at end of file
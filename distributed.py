@@ -0,0 +1,407 @@
+"""Distributed rendering: a coordinator hands the tiles of an image to workers on any number of hosts over TCP
+
+    python distributed.py coordinator scene.json image.png --port 5000 --workers 3 [--anti-aliasing 4]
+    python distributed.py worker coordinator-host:5000 [--processes 4]
+
+Workers connect to the coordinator, which sends each of them the engine and the scene once per render and then
+tiles to render, a couple at a time so workers don't wait for the network between tiles.
+Tiles are scheduled by work stealing: every worker starts with its own queue, a contiguous block of the tiles,
+and a worker that empties its queue steals the back half of the longest queue left, so workers stuck with
+expensive tiles (glass, reflections) hand the rest of their block to the others.
+Tiles of a worker that disconnects or stays silent for dead_after seconds are handed to the others, and once
+nothing is left to steal, idle workers render again the tiles that are taking much longer than the mean,
+keeping whichever copy finishes first.
+
+Connections are authenticated with a shared key (--authkey or the RAYTRACER_AUTHKEY environment variable)
+and messages are pickles, so only run workers and coordinators that trust each other.
+Workers need the same version of the code, and NumPy if the coordinator uses the vectorized engine.
+"""
+from __future__ import annotations
+from collections import deque
+from components import Image, Scene
+from components.image import color_array
+from engine import RenderEngine, default_engine
+from multiprocessing.connection import Client, Connection, Listener
+from utils import build_scene, load_scene_infos
+import argparse
+import itertools
+import multiprocessing
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+
+HEARTBEAT_SECONDS = 5.0
+AUTHKEY_VARIABLE = "RAYTRACER_AUTHKEY"
+
+
+class WorkerState:
+    """What the coordinator knows about a connected worker"""
+    def __init__(self, name: str) -> None:
+        self.name = name
+        # Tiles of the worker's own block, it renders them from the front and others steal from the back
+        self.tiles: "deque[tuple[int, int, int, int]]" = deque()
+        self.in_flight: "dict[tuple[int, int, int, int], float]" = {}
+        self.job_id: "int | None" = None
+        self.tiles_done = 0
+
+
+class RenderJob:
+    """A render handed out by the coordinator"""
+    def __init__(self, job_id: int, payload: bytes, tiles: "list[tuple[int, int, int, int]]", width: int, height: int) -> None:
+        self.id = job_id
+        self.payload = payload
+        self.tiles = tiles
+        self.image = Image(width, height)
+        self.done: "set[tuple[int, int, int, int]]" = set()
+        # Tiles no worker owns, from workers that died, rendered before any block
+        self.orphans: "deque[tuple[int, int, int, int]]" = deque()
+        # Workers rendering each tile and when they got it
+        self.in_flight: "dict[tuple[int, int, int, int], dict[str, float]]" = {}
+        self.seconds = 0.0
+        self.stats = {"steals": 0, "reassigned": 0, "duplicated": 0, "tiles_by_worker": {}}
+
+
+class Coordinator:
+    """Listens for workers on address and renders images with them, see the module documentation
+
+    prefetch is the number of tiles each worker has at a time, tiles in flight for more than
+    straggler_factor times the mean time of a tile are rendered again by idle workers.
+    """
+    def __init__(self, address: "tuple[str, int]" = ("127.0.0.1", 0), authkey: bytes = b"",
+                 engine: "RenderEngine | None" = None, prefetch: int = 2, dead_after: float = 30.0,
+                 straggler_factor: float = 3.0) -> None:
+        self.engine = engine or default_engine()
+        self.prefetch = prefetch
+        self.dead_after = dead_after
+        self.straggler_factor = straggler_factor
+        self.workers: "list[WorkerState]" = []
+        self.job: "RenderJob | None" = None
+        self.last_stats: dict = {}
+        self._job_ids = itertools.count()
+        self._closing = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._threads: "list[threading.Thread]" = []
+        self._listener = Listener(address, authkey=authkey)
+        self.address: "tuple[str, int]" = self._listener.address
+        self._accepting = threading.Thread(target=self._accept, daemon=True)
+        self._accepting.start()
+
+    def wait_for_workers(self, count: int, timeout: "float | None" = None) -> bool:
+        """Waits until count workers are connected, returns False if they didn't connect in time"""
+        with self._changed:
+            return self._changed.wait_for(lambda: len(self.workers) >= count, timeout)
+
+    def render(self, scene: Scene, anti_aliasing: int = 0, seed: int = 0, tile_size: "int | None" = None,
+               show_progress: bool = False, timeout: "float | None" = None) -> Image:
+        """Renders the scene with the connected workers and the ones connecting meanwhile, like engine.render
+        Raises TimeoutError if the image isn't finished in timeout seconds
+        """
+        tiles = self.engine.split_tiles(scene.width, scene.height, tile_size or self.engine.TILE_SIZE)
+        payload = pickle.dumps((self.engine, scene, anti_aliasing, seed))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            job = RenderJob(next(self._job_ids), payload, tiles, scene.width, scene.height)
+            # Contiguous blocks, neighbouring tiles tend to cost the same so stealing evens them out
+            workers = self.workers
+            for worker in workers:
+                # Tiles of an earlier render that timed out, their results will be thrown away
+                worker.in_flight.clear()
+            if workers:
+                block = -(-len(tiles) // len(workers))
+                for index, worker in enumerate(workers):
+                    worker.tiles = deque(tiles[index * block:(index + 1) * block])
+            else:
+                job.orphans.extend(tiles)
+            self.job = job
+            self._changed.notify_all()
+
+            reported = 0
+            while len(job.done) < len(tiles):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.job = None
+                    raise TimeoutError(f"{len(tiles) - len(job.done)} tiles of {len(tiles)} weren't rendered in time")
+                self._changed.wait(remaining)
+                if show_progress and len(job.done) != reported:
+                    reported = len(job.done)
+                    print(f"{(reported / len(tiles)) * 100:.2f}%", end='\r')
+            self.job = None
+            self.last_stats = job.stats
+        return job.image
+
+    def close(self) -> None:
+        """Stops the workers and stops listening"""
+        with self._changed:
+            self._closing = True
+            self._changed.notify_all()
+        # Closing the listener doesn't interrupt accept, a connection wakes it up
+        host, port = self.address
+        try:
+            socket.create_connection(("127.0.0.1" if host in ("", "0.0.0.0") else host, port), timeout=1).close()
+        except OSError:
+            pass
+        self._accepting.join(HEARTBEAT_SECONDS)
+        self._listener.close()
+        for thread in self._threads:
+            thread.join(HEARTBEAT_SECONDS)
+
+    def __enter__(self) -> Coordinator:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _accept(self) -> None:
+        while not self._closing:
+            try:
+                connection = self._listener.accept()
+            except Exception:
+                # Failed authentication or handshake
+                continue
+            if self._closing:
+                connection.close()
+                return
+            thread = threading.Thread(target=self._serve_worker, args=(connection,), daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _serve_worker(self, connection: Connection) -> None:
+        """Feeds tiles to one worker and collects its results until it disconnects or the coordinator closes"""
+        worker = None
+        try:
+            message = connection.recv() if connection.poll(self.dead_after) else None
+            if not (isinstance(message, tuple) and message[:1] == ("hello",)):
+                return
+            worker = WorkerState(str(message[1]))
+            with self._changed:
+                self.workers.append(worker)
+                self._changed.notify_all()
+            last_heard = time.monotonic()
+            while True:
+                with self._changed:
+                    if self._closing:
+                        connection.send(("stop",))
+                        return
+                    job = self.job
+                    sends = []
+                    while job is not None and len(worker.in_flight) < self.prefetch:
+                        tile = self._next_tile(job, worker)
+                        if tile is None:
+                            break
+                        if worker.job_id != job.id:
+                            worker.job_id = job.id
+                            sends.append(("scene", job.id, job.payload))
+                        now = time.monotonic()
+                        worker.in_flight[tile] = now
+                        job.in_flight.setdefault(tile, {})[worker.name] = now
+                        sends.append(("tile", job.id, tile))
+                for message in sends:
+                    connection.send(message)
+
+                if not connection.poll(0.2):
+                    if time.monotonic() - last_heard > self.dead_after:
+                        return
+                    continue
+                message = connection.recv()
+                last_heard = time.monotonic()
+                if message[0] == "tile":
+                    self._tile_done(worker, *message[1:])
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+            if worker is not None:
+                self._remove_worker(worker)
+
+    def _next_tile(self, job: RenderJob, worker: WorkerState) -> "tuple[int, int, int, int] | None":
+        """Next tile for the worker: an orphan, a tile of its block, a stolen tile or a straggler, called locked"""
+        while job.orphans:
+            tile = job.orphans.popleft()
+            if tile not in job.done:
+                return tile
+        while worker.tiles:
+            tile = worker.tiles.popleft()
+            if tile not in job.done:
+                return tile
+
+        victim = max((other for other in self.workers if other is not worker), key=lambda other: len(other.tiles), default=None)
+        if victim is not None and victim.tiles:
+            stolen = [victim.tiles.pop() for _ in range((len(victim.tiles) + 1) // 2)]
+            worker.tiles.extend(reversed(stolen))
+            job.stats["steals"] += 1
+            return worker.tiles.popleft()
+
+        # Nothing left to steal, render again a tile that is taking too long somewhere else
+        finished = sum(job.stats["tiles_by_worker"].values())
+        if not finished:
+            return None
+        too_long = time.monotonic() - self.straggler_factor * job.seconds / finished
+        stragglers = [
+            (min(workers.values()), tile) for tile, workers in job.in_flight.items()
+            if len(workers) == 1 and worker.name not in workers and min(workers.values()) < too_long]
+        if not stragglers:
+            return None
+        job.stats["duplicated"] += 1
+        return min(stragglers)[1]
+
+    def _tile_done(self, worker: WorkerState, job_id: int, tile, values: bytes, seconds: float) -> None:
+        tile = tuple(tile)
+        with self._changed:
+            worker.in_flight.pop(tile, None)
+            job = self.job
+            if job is None or job.id != job_id or tile in job.done:
+                return
+            colors = color_array(())
+            colors.frombytes(values)
+            job.image.set_tile_values(tile, colors)
+            job.done.add(tile)
+            job.in_flight.pop(tile, None)
+            job.seconds += seconds
+            worker.tiles_done += 1
+            tiles_by_worker = job.stats["tiles_by_worker"]
+            tiles_by_worker[worker.name] = tiles_by_worker.get(worker.name, 0) + 1
+            self._changed.notify_all()
+
+    def _remove_worker(self, worker: WorkerState) -> None:
+        """Hands the tiles of a worker that is gone to the others"""
+        with self._changed:
+            self.workers.remove(worker)
+            job = self.job
+            if job is not None and worker.job_id == job.id:
+                lost = list(worker.in_flight) + list(worker.tiles)
+                for tile in lost:
+                    rendering = job.in_flight.get(tile)
+                    if rendering is not None:
+                        rendering.pop(worker.name, None)
+                        if rendering:
+                            # Another worker has a copy of it
+                            continue
+                        del job.in_flight[tile]
+                    if tile not in job.done:
+                        job.orphans.append(tile)
+                        job.stats["reassigned"] += 1
+            worker.tiles.clear()
+            worker.in_flight.clear()
+            self._changed.notify_all()
+
+
+def run_worker(address: "tuple[str, int]", authkey: bytes, name: "str | None" = None, retry_seconds: float = 0) -> int:
+    """Renders the tiles a coordinator sends until it stops or disconnects, returns the number of tiles rendered
+    With retry_seconds, keeps trying to connect for that long while the coordinator isn't listening yet
+    """
+    deadline = time.monotonic() + retry_seconds
+    while True:
+        try:
+            connection = Client(address, authkey=authkey)
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(message) -> None:
+        with lock:
+            connection.send(message)
+
+    def heartbeat() -> None:
+        # Long tiles would look like a dead worker otherwise
+        while not stopped.wait(HEARTBEAT_SECONDS):
+            try:
+                send(("alive",))
+            except OSError:
+                return
+
+    send(("hello", name or f"{socket.gethostname()}:{os.getpid()}"))
+    threading.Thread(target=heartbeat, daemon=True).start()
+    rendered = 0
+    current = None
+    try:
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == "scene":
+                job_id, payload = message[1:]
+                engine, scene, anti_aliasing, seed = pickle.loads(payload)
+                # Same hits faster, see main.py
+                if type(engine) is RenderEngine:
+                    scene = scene.compile()
+                scene.bvh
+                current = job_id, engine, scene, anti_aliasing, seed
+            elif message[0] == "tile":
+                job_id, tile = message[1:]
+                if current is None or current[0] != job_id:
+                    continue
+                _, engine, scene, anti_aliasing, seed = current
+                start = time.perf_counter()
+                colors = engine.render_tile(scene, tile, anti_aliasing, seed)
+                send(("tile", job_id, tile, color_array(colors, Image.TYPECODE).tobytes(), time.perf_counter() - start))
+                rendered += 1
+            elif message[0] == "stop":
+                break
+    finally:
+        stopped.set()
+        connection.close()
+    return rendered
+
+
+def parse_address(address: str) -> "tuple[str, int]":
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Renders the tiles of an image on workers over TCP")
+    parser.add_argument("--authkey", default=os.environ.get(AUTHKEY_VARIABLE),
+                        help=f"Key shared by the coordinator and its workers, {AUTHKEY_VARIABLE} by default")
+    modes = parser.add_subparsers(dest="mode", required=True)
+    coordinator_parser = modes.add_parser("coordinator", help="Render a scene with the workers that connect")
+    coordinator_parser.add_argument("scene", help="Path of the json or binary scene")
+    coordinator_parser.add_argument("imageout", help="Path of the image")
+    coordinator_parser.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    coordinator_parser.add_argument("--port", type=int, default=5000, help="Port to listen on")
+    coordinator_parser.add_argument("--workers", type=int, default=1, help="Workers to wait for before starting")
+    coordinator_parser.add_argument("--anti-aliasing", type=int, default=0, help="Number of random samples per pixel")
+    coordinator_parser.add_argument("--seed", type=int, default=0, help="Seed of the anti-aliasing samples")
+    coordinator_parser.add_argument("--tile-size", type=int, default=None, help="Side in pixels of the square tiles")
+    worker_parser = modes.add_parser("worker", help="Render tiles for a coordinator")
+    worker_parser.add_argument("address", help="host:port of the coordinator")
+    worker_parser.add_argument("--processes", type=int, default=1, help="Number of worker processes to start")
+    worker_parser.add_argument("--retry", type=float, default=60, help="Seconds to keep trying to connect")
+    args = parser.parse_args()
+    if not args.authkey:
+        parser.error(f"--authkey or {AUTHKEY_VARIABLE} is needed")
+    authkey = args.authkey.encode()
+
+    if args.mode == "worker":
+        address = parse_address(args.address)
+        processes = [multiprocessing.Process(target=run_worker, args=(address, authkey, None, args.retry))
+                     for _ in range(args.processes - 1)]
+        for process in processes:
+            process.start()
+        rendered = run_worker(address, authkey, retry_seconds=args.retry)
+        for process in processes:
+            process.join()
+        print(f"{rendered} tiles rendered")
+        sys.exit()
+
+    scene = build_scene(load_scene_infos(args.scene))
+    with Coordinator((args.host, args.port), authkey) as coordinator:
+        print(f"Waiting for {args.workers} workers on {args.host}:{args.port}", flush=True)
+        coordinator.wait_for_workers(args.workers)
+        start = time.perf_counter()
+        image = coordinator.render(scene, args.anti_aliasing, args.seed, args.tile_size, show_progress=True)
+        stats = coordinator.last_stats
+        print(f"Rendered in {time.perf_counter() - start:.3f}s, {stats['steals']} steals, "
+              f"{stats['reassigned']} tiles reassigned, {stats['duplicated']} duplicated")
+        for name, count in sorted(stats["tiles_by_worker"].items()):
+            print(f"{name}: {count} tiles")
+    image.save(args.imageout)
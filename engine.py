@@ -1,17 +1,124 @@
 from math import sqrt
-from components import Vector3, Color, Point, Ray, Object3D, Image, Scene
+from components import Vector3, Color, Point, Ray, Object3D, Image, Scene, Light, Material
 
-from random import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from random import Random
+from typing import Iterator, Sequence, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from sampler import AdaptiveSampler
+    from utils.checkpoint import RenderCheckpoint
 
 class RenderEngine:
     """Renders 3D objects into a 2D image using ray tracing"""
 
     MIN_DISPLACE = 0.001
+    TILE_SIZE = 32
+    # Weight of a ray too small for its color to change an 8 bit channel of the pixel on its own
+    PRUNE_WEIGHT = 0.5 / 255
+
+    def __init__(
+            self, sampler: "AdaptiveSampler | None" = None, min_weight: float = 0.0,
+            russian_roulette: bool = False) -> None:
+        # With a sampler, anti_aliasing is the maximum number of samples of a pixel instead of a fixed number
+        self.sampler = sampler
+        # Secondary rays whose color would count less than min_weight in the pixel aren't traced, see rayTrace
+        self.min_weight = min_weight
+        self.russian_roulette = russian_roulette
+        self.pruned_rays = 0
+        self._roulette = Random(0)
+        # Last object found blocking each light, see occluded
+        self.shadow_cache: "dict[Light, Object3D]" = {}
+        self._shadow_cache_scene: "Scene | None" = None
+
+    def render(
+            self, scene: Scene, show_progress: bool = False, anti_aliasing: int = 0,
+            workers: int = 1, tile_size: "int | None" = None, seed: int = 0,
+            checkpoint: "RenderCheckpoint | None" = None) -> Image:
+        """Renders the scene into an image
+
+        The image is split into square tiles of tile_size pixels (TILE_SIZE by default). With workers > 1 the tiles
+        are rendered by a pool of processes that receive the scene once, when they start.
+        Anti-aliasing samples come from a random generator seeded by seed and the tile position,
+        so the output is reproducible and the same for any number of workers.
+        With a checkpoint (utils.RenderCheckpoint) finished tiles are accumulated into it, tiles that already have
+        enough samples are skipped and the others only render the samples they are missing.
+        """
+        tiles = self.split_tiles(scene.width, scene.height, tile_size or self.TILE_SIZE)
+        if checkpoint is not None and self.sampler is not None:
+            raise ValueError("Checkpoints count the same samples for every pixel, they can't be used with a sampler")
+        if checkpoint is not None:
+            samples = max(anti_aliasing, 1)
+            done_samples = {tile: checkpoint.tile_samples(tile) for tile in tiles}
+            tiles = [tile for tile in tiles if done_samples[tile] < samples]
+            results = self.render_iter(scene, anti_aliasing, workers, seed=seed, tiles=tiles, first_samples=done_samples)
+        else:
+            pixels = Image(scene.width, scene.height)
+            results = self.render_iter(scene, anti_aliasing, workers, seed=seed, tiles=tiles)
+
+        for done, (tile, colors) in enumerate(results, 1):
+            if checkpoint is not None:
+                checkpoint.add_tile(tile, colors, samples - done_samples[tile])
+            else:
+                pixels.set_tile(tile, colors)
+            if show_progress:
+                print(f"{(done / len(tiles)) * 100:.2f}%", end='\r')
+
+        if checkpoint is not None:
+            checkpoint.flush()
+            return checkpoint.to_image()
+        return pixels
+
+    @staticmethod
+    def split_tiles(width: int, height: int, tile_size: "int | tuple[int, int]" = TILE_SIZE) -> "list[tuple[int, int, int, int]]":
+        """Splits the image in tiles (x_start, y_start, x_end, y_end), ends are exclusive
+        tile_size is the side of square tiles or a (width, height) pair, (image width, 1) gives scanlines
+        """
+        tile_width, tile_height = tile_size if isinstance(tile_size, tuple) else (tile_size, tile_size)
+        return [
+            (x, y, min(x + tile_width, width), min(y + tile_height, height))
+            for y in range(0, height, tile_height)
+            for x in range(0, width, tile_width)]
+
+    def render_iter(
+            self, scene: Scene, anti_aliasing: int = 0, workers: int = 1,
+            tile_size: "int | tuple[int, int] | None" = None, seed: int = 0,
+            tiles: "list[tuple[int, int, int, int]] | None" = None,
+            first_samples: "dict[tuple[int, int, int, int], int] | None" = None
+            ) -> "Iterator[tuple[tuple[int, int, int, int], list[Color]]]":
+        """Streams the render: yields each tile (x_start, y_start, x_end, y_end) with its colors, row by row,
+        as soon as it is finished. Tiles come in order when rendering serially and in completion order with workers.
+        Stopping the iteration cancels the tiles that were not started yet.
+        first_samples maps tiles to the anti-aliasing samples they already have, only the remaining ones are rendered.
+        """
+        first_samples = first_samples or {}
+        if tiles is None:
+            tiles = self.split_tiles(scene.width, scene.height, tile_size or self.TILE_SIZE)
+        # Built here so forked workers inherit the tree instead of each building their own
+        scene.bvh
+        if workers <= 1:
+            for tile in tiles:
+                yield tile, self.render_tile(scene, tile, anti_aliasing, seed, first_samples.get(tile, 0))
+            return
+
+        executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self, scene))
+        try:
+            futures = {executor.submit(_render_tile_in_worker, tile, anti_aliasing, seed, first_samples.get(tile, 0)): tile
+                for tile in tiles}
+            for future in as_completed(futures):
+                colors, pruned_rays = future.result()
+                self.pruned_rays += pruned_rays
+                yield futures[future], colors
+        finally:
+            executor.shutdown(cancel_futures=True)
 
-    def render(self, scene: Scene, show_progress: bool = False, anti_aliasing: int = 0) -> Image:
+    def view_plane(self, scene: Scene) -> "tuple[Point, Point, Vector3, Vector3, float]":
+        """Returns the camera's focus, the position of the top left pixel
+        and the u and v vectors that walk right and up on the view plane, plus the pixel size
+        """
         width = scene.width
         height = scene.height
-        
+
         camera = scene.camera
         pixel_size = camera.pixel_size
         cam_focal_distance = camera.focal_distance
@@ -27,145 +134,292 @@ class RenderEngine:
         y_vector = (height / 2) * v
         x_vector = (width / 2 ) * u
         image_center = z_vector + pixel_size * (y_vector - x_vector)
+        return cam_focus, image_center, u, v, pixel_size
 
-        pixels = Image(width, height)
+    def render_tile(
+            self, scene: Scene, tile: "tuple[int, int, int, int]",
+            anti_aliasing: int = 0, seed: int = 0, first_sample: int = 0) -> "list[Color]":
+        """Renders the pixels of a tile, returns their colors row by row
+        With anti-aliasing, the color of each pixel is the mean of samples first_sample to anti_aliasing - 1
+        """
+        if self.russian_roulette:
+            self.start_roulette(seed, tile, first_sample)
+        if anti_aliasing and self.sampler is not None:
+            return self.sampler.render_tile(self, scene, tile, anti_aliasing, seed, first_sample)
+        x_start, y_start, x_end, y_end = tile
+        cam_focus, image_center, u, v, pixel_size = self.view_plane(scene)
+        # The scene may have been edited since the last tile
+        self.shadow_cache.clear()
+
+        colors = []
         if anti_aliasing:
-            for y in range(0, height):
-                for x in range(0, width):
+            random = self.sample_random(seed, tile, first_sample).random
+            samples = anti_aliasing - first_sample
+            for y in range(y_start, y_end):
+                for x in range(x_start, x_end):
                     ray_color = Color()
-                    for _ in range(0, anti_aliasing):
-                        position = image_center + pixel_size * ((x + random()) * u - (y + random()) * v)
-                        ray_direction = (position - cam_focus).normalize()
-                        ray = Ray(cam_focus, ray_direction)
-                        ray_color += self.rayTrace(ray, scene)
-                    pixels.set_pixel(x, y, ray_color/anti_aliasing)
-                if show_progress:
-                    print(f"{(y / height) * 100:.2f}%", end='\r')
+                    for _ in range(0, samples):
+                        # image_center + pixel_size * ((x + random()) * u - (y + random()) * v) - cam_focus
+                        ray_direction = u * (x + random())
+                        ray_direction.imul_add(v, -(y + random())).imul(pixel_size).iadd(image_center).isub(cam_focus)
+                        ray = Ray(cam_focus, ray_direction.inormalize())
+                        ray_color.iadd(self.rayTrace(ray, scene))
+                    colors.append(ray_color/samples)
         else:
-            for y in range(0, height):
-                for x in range(0, width):
-                    position = image_center + pixel_size * (x * u - y * v)
-                    ray_direction = (position - cam_focus).normalize()
-                    ray = Ray(cam_focus, ray_direction)
-                    pixels.set_pixel(x, y, self.rayTrace(ray, scene))
-                if show_progress:
-                    print(f"{(y / height) * 100:.2f}%", end='\r')
-        return pixels
+            for y in range(y_start, y_end):
+                for x in range(x_start, x_end):
+                    # image_center + pixel_size * (x * u - y * v) - cam_focus, without temporaries
+                    ray_direction = u * x
+                    ray_direction.imul_add(v, -y).imul(pixel_size).iadd(image_center).isub(cam_focus)
+                    ray = Ray(cam_focus, ray_direction.inormalize())
+                    colors.append(self.rayTrace(ray, scene))
+        return colors
     
-    def rayTrace(self, ray: Ray, scene: Scene, depth=0) -> Color:
-        """Traces the ray and finds the color for it"""
-        color: Color = Color()
-        
+    def trace_points(self, scene: Scene, xs: "list[float]", ys: "list[float]") -> "list[tuple[float, float, float]]":
+        """Traces camera rays through points of the view plane given in pixels, (0, 0) is the top left corner,
+        returns the r, g, b values of each ray
+        """
+        cam_focus, image_center, u, v, pixel_size = self.view_plane(scene)
+        self.shadow_cache.clear()
+        colors = []
+        for x, y in zip(xs, ys):
+            ray_direction = u * x
+            ray_direction.imul_add(v, -y).imul(pixel_size).iadd(image_center).isub(cam_focus)
+            color = self.rayTrace(Ray(cam_focus, ray_direction.inormalize()), scene)
+            colors.append((color.x, color.y, color.z))
+        return colors
+
+    @staticmethod
+    def sample_random(seed: int, tile: "tuple[int, int, int, int]", first_sample: int = 0) -> Random:
+        """Random generator for the anti-aliasing samples of a tile
+        Renders resumed from a checkpoint start at first_sample > 0 and get a different sequence for the new samples
+        """
+        x_start, y_start = tile[:2]
+        if first_sample:
+            return Random(f"{seed}:{x_start}:{y_start}:{first_sample}")
+        return Random(f"{seed}:{x_start}:{y_start}")
+
+    def start_roulette(self, seed: int, tile: "tuple[int, int, int, int]", first_sample: int = 0) -> None:
+        """Seeds the Russian roulette with the tile position, so the image doesn't depend on the order
+        tiles are rendered in or on the number of workers
+        """
+        self._roulette.seed(f"roulette:{seed}:{tile[0]}:{tile[1]}:{first_sample}")
+
+    def rayTrace(self, ray: Ray, scene: Scene, depth=0, weight: float = 1.0) -> Color:
+        """Traces the ray and finds the color for it, weight is how much its color counts in the pixel
+        The returned color may be shared (the background), callers must not change it in place
+
+        The secondary rays wait on an explicit stack instead of being traced by recursive calls,
+        each hit waits there too until the colors of its secondary rays are added to it.
+        Rays weighing less than min_weight are pruned, or with russian_roulette survive with probability
+        weight / min_weight and count as min_weight, which keeps the expected color unchanged.
+        """
+        trace_ray = self.trace_ray
+        min_weight = self.min_weight
+        russian_roulette = self.russian_roulette
+        # Rays to trace as (ray, depth, weight) and hits waiting for the colors of their secondary rays
+        # as (None, color, coefficients)
+        stack: list = [(ray, depth, weight)]
+        # Finished colors, the ones of the secondary rays of a hit end up on top in the order they were spawned
+        results: "list[Color]" = []
+        push = stack.append
+        finish = results.append
+        while stack:
+            entry = stack.pop()
+            if entry[0] is None:
+                _, color, coefficients = entry
+                first = len(results) - len(coefficients)
+                for secondary_color, coefficient in zip(results[first:], coefficients):
+                    color.imul_add(secondary_color, coefficient)
+                del results[first:]
+                finish(color)
+                continue
+
+            ray, depth, weight = entry
+            color, secondary = trace_ray(ray, scene, depth)
+            if not secondary:
+                finish(color)
+                continue
+            coefficients = []
+            pending = []
+            for secondary_ray, coefficient in secondary:
+                ray_weight = weight * coefficient
+                if ray_weight < min_weight:
+                    if not russian_roulette or self._roulette.random() * min_weight >= ray_weight:
+                        self.pruned_rays += 1
+                        continue
+                    coefficient *= min_weight / ray_weight
+                    ray_weight = min_weight
+                coefficients.append(coefficient)
+                pending.append((secondary_ray, depth + 1, ray_weight))
+            if pending:
+                push((None, color, coefficients))
+                stack.extend(reversed(pending))
+            else:
+                finish(color)
+        return results[0]
+
+    def trace_ray(self, ray: Ray, scene: Scene, depth=0) -> "tuple[Color, Sequence[tuple[Ray, float]]]":
+        """Finds the color of the nearest hit of a single ray, without the light its secondary rays bring,
+        returns it with the secondary rays and the coefficients their colors are weighted by.
+        There are no secondary rays on a miss or at scene.max_depth
+        """
         # Finding the nearest object hit by the ray in the scene
         distance_hit, normal_hit, object_hit = self.find_nearest(ray, scene)
         if object_hit is None:
-            return scene.bg_color
-        
-        hit_pos = ray.origin + ray.direction * distance_hit
+            return scene.bg_color, ()
+
+        direction = ray.direction
+        hit_pos = (direction * distance_hit).iadd(ray.origin)
         hit_normal = normal_hit
-        color += self.color_at(object_hit, hit_pos, hit_normal, scene)
-        if depth < scene.max_depth:
-            material_hit = object_hit.material
-            # Checks if object is reflective
-            if material_hit.reflection > 0:
-                normal = hit_normal
-                omega = -ray.direction
-                # Checks if ray is leaving the object, is so, invert normal and coefficient (air coefficient is 1)
-                if normal ^ omega < 0:
-                    relative_refraction = 1/material_hit.refraction
-                    normal = -hit_normal
-
-                # Note to self: we might want to do this as a object3D method that returns
-                # the reflected ray or None if the ray does not reflect
-                new_ray_pos = hit_pos + normal * self.MIN_DISPLACE
-                new_ray_dir = ray.direction - 2 * ray.direction.dot_product(normal) * normal
-                new_ray = Ray(new_ray_pos, new_ray_dir)
-                # Attenuating the reflected color by reflection coefficient
-                color += self.rayTrace(new_ray, scene, depth+1) * material_hit.reflection
-            # Checks if object is not opaque
-            if material_hit.refraction > 0:
-                # Note to self: we might want to do this as a object3D method that returns
-                # the refracted ray or None if the ray does not refract
-
-                normal = hit_normal
-                omega = -ray.direction
-                relative_refraction = material_hit.refraction
-                # Checks if ray is leaving the object, is so, invert normal and coefficient (air coefficient is 1)
-                if normal ^ omega < 0:
-                    relative_refraction = 1/material_hit.refraction
-                    normal = -hit_normal
-
-                # delta for the refraction formula
-                delta = 1 - (1/(relative_refraction**2)) * (1 - (normal ^ omega)**2)
-
-                # if delta is less than 0, total refraction occurs and we have no new ray
-                if delta >= 0:
-                    inverse_refraction = 1 / relative_refraction
-
-                    # generating the new ray
-                    new_ray_dir = - inverse_refraction * omega - (sqrt(delta) - inverse_refraction * (normal ^ omega)) * normal
-                    new_ray_pos = hit_pos - normal * self.MIN_DISPLACE
-                    new_ray = Ray(new_ray_pos, new_ray_dir)
-                    # Attenuating the ray color by transmission coefficient
-                    color += self.rayTrace(new_ray, scene, depth+1) * material_hit.transmission
-                else:
-                    # Note to self: This part might be a little weird
-                    # when we have total refraction we do generate a ray,
-                    # but that ray goes in the same direction it would go if it was a reflected ray,
-                    # but we use the transmission index and not the reflection index.
-                    # there might be a cleaner way of doing this
-                    new_ray_pos = hit_pos + normal * self.MIN_DISPLACE
-                    new_ray_dir = ray.direction - 2 * ray.direction.dot_product(normal) * normal
-                    new_ray = Ray(new_ray_pos, new_ray_dir)
-                    # Attenuating the reflected color by reflection coefficient
-                    color += self.rayTrace(new_ray, scene, depth+1) * material_hit.transmission
-                        
-        return color
-    
+        # color_at returns a new color, so it can be accumulated in place
+        color = self.color_at(object_hit, hit_pos, hit_normal, scene)
+        if depth >= scene.max_depth:
+            return color, ()
+        secondary = []
+        material_hit = object_hit.material
+        reflected_ray, transmitted_ray = self.secondary_rays(direction, hit_pos, hit_normal, material_hit)
+        if reflected_ray is not None:
+            # Attenuating the reflected color by reflection coefficient
+            secondary.append((reflected_ray, material_hit.reflection))
+        if transmitted_ray is not None:
+            # Attenuating the ray color by transmission coefficient
+            secondary.append((transmitted_ray, material_hit.transmission))
+        return color, secondary
+
+    def secondary_rays(
+            self, direction: Vector3, hit_pos: Point, hit_normal: Vector3, material: Material
+            ) -> "tuple[Ray | None, Ray | None]":
+        """Returns the reflected ray and the transmitted ray leaving a hit point, None for the ones the material
+        doesn't spawn. Their colors are weighted by the reflection and the transmission of the material
+        """
+        reflected_ray = None
+        transmitted_ray = None
+        # Checks if object is reflective
+        if material.reflection > 0:
+            normal = hit_normal
+            # Checks if ray is leaving the object (normal ^ -direction < 0), if so, invert normal
+            if normal ^ direction > 0:
+                normal = -hit_normal
+
+            # hit_pos + normal * MIN_DISPLACE and direction - 2 * (direction ^ normal) * normal
+            new_ray_pos = (normal * self.MIN_DISPLACE).iadd(hit_pos)
+            new_ray_dir = (normal * -(2 * direction.dot_product(normal))).iadd(direction)
+            reflected_ray = Ray(new_ray_pos, new_ray_dir)
+        # Checks if object is not opaque
+        if material.refraction > 0:
+            normal = hit_normal
+            omega = -direction
+            relative_refraction = material.refraction
+            # Checks if ray is leaving the object, is so, invert normal and coefficient (air coefficient is 1)
+            if normal ^ omega < 0:
+                relative_refraction = 1/material.refraction
+                normal = -hit_normal
+
+            # delta for the refraction formula
+            delta = 1 - (1/(relative_refraction**2)) * (1 - (normal ^ omega)**2)
+
+            # if delta is less than 0, total refraction occurs and we have no new ray
+            if delta >= 0:
+                inverse_refraction = 1 / relative_refraction
+
+                # generating the new ray
+                # - inverse_refraction * omega - (sqrt(delta) - inverse_refraction * (normal ^ omega)) * normal
+                new_ray_dir = (omega * -inverse_refraction).imul_add(
+                    normal, -(sqrt(delta) - inverse_refraction * (normal ^ omega)))
+                new_ray_pos = (normal * -self.MIN_DISPLACE).iadd(hit_pos)
+            else:
+                # Note to self: This part might be a little weird
+                # when we have total refraction we do generate a ray,
+                # but that ray goes in the same direction it would go if it was a reflected ray,
+                # but we use the transmission index and not the reflection index.
+                # there might be a cleaner way of doing this
+                new_ray_pos = (normal * self.MIN_DISPLACE).iadd(hit_pos)
+                new_ray_dir = (normal * -(2 * direction.dot_product(normal))).iadd(direction)
+            transmitted_ray = Ray(new_ray_pos, new_ray_dir)
+        return reflected_ray, transmitted_ray
+
     def find_nearest(self, ray: Ray, scene: Scene) -> "tuple[float, Vector3, Object3D] | tuple[None, None, None]":
         """Finds the nearest point of intersection of a ray with any object in a scene
         Returns a tuple of distance to the hit point and the object that was hit
+        Uses the scene's BVH, so the cost grows logarithmically with the number of objects
         """
-        distance_min = None
-        object_hit = None
-        hit_normal = None
-        for obj in scene.objects:
-            distance, normal = obj.intersects(ray)
-            if distance is not None and (object_hit is None or distance < distance_min):
-                distance_min = distance
-                hit_normal = normal
-                object_hit = obj
-
-        return (distance_min, hit_normal, object_hit)
+        return scene.find_nearest(ray)
     
+    def occluded(self, ray: Ray, scene: Scene, max_distance: float, light: "Light | None" = None) -> bool:
+        """Checks if any object blocks the ray before max_distance, stopping at the first blocker
+        Shadow rays towards the same light tend to be blocked by the same object,
+        so the last blocker found for the light is tested before searching the whole scene
+        """
+        if self._shadow_cache_scene is not scene:
+            self.shadow_cache.clear()
+            self._shadow_cache_scene = scene
+        last_occluder = None
+        if light is not None:
+            last_occluder = self.shadow_cache.get(light)
+            if last_occluder is not None and last_occluder.occluded(ray, max_distance):
+                return True
+        occluder = scene.occluder(ray, max_distance, last_occluder)
+        if occluder is None:
+            return False
+        if light is not None:
+            self.shadow_cache[light] = occluder
+        return True
+
     def color_at(self, object_hit: Object3D, hit_pos: Point, normal: Vector3, scene: Scene) -> Color:
+        """Returns a new color for the hit point, with ambient, diffuse and specular lighting"""
         material = object_hit.material
         obj_color = material.color_at(hit_pos)
-        color: Color = material.ambient * (obj_color.kron_product(scene.ambient_color))
+        color: Color = obj_color.kron_product(scene.ambient_color).imul(material.ambient)
         phong_coefficient = material.phong
-        to_camera = (scene.camera.eye - hit_pos).normalize()
+        to_camera = (scene.camera.eye - hit_pos).inormalize()
         
         # Calculating lights
         for light in scene.lights:
-            to_light = Ray(hit_pos, light.position - hit_pos)
-            distance_hit, _, object_hit = self.find_nearest(to_light, scene)
-
-            if distance_hit is not None and 0 < distance_hit < to_light.direction ^ (light.position - hit_pos):
+            light_vector = light.position - hit_pos
+            to_light = Ray(hit_pos, light_vector)
+            # In shadow if anything is hit before reaching the light
+            if self.occluded(to_light, scene, to_light.direction ^ light_vector, light):
                 continue
 
             # Diffuse shading (lambert)
-            color += (
-                (obj_color.kron_product(light.color))
-                * material.diffuse
-                * max(normal ^ to_light.direction, 0)
+            normal_dot_light = normal ^ to_light.direction
+            color.imul_add(
+                obj_color.kron_product(light.color).imul(material.diffuse),
+                max(normal_dot_light, 0)
             )
             # Specular shading (Phong)
-            half_vector = 2 * (normal ^ to_light.direction) * normal - to_light.direction
-            color += (
-                light.color
-                * material.specular
-                * max(half_vector ^ to_camera, 0) ** phong_coefficient
+            half_vector = (normal * (2 * normal_dot_light)).isub(to_light.direction)
+            color.imul_add(
+                light.color * material.specular,
+                max(half_vector ^ to_camera, 0) ** phong_coefficient
             )
 
         return color
-        
\ No newline at end of file
+
+
+# State of each process of the render pool, set once by the pool initializer
+_worker_engine: "RenderEngine | None" = None
+_worker_scene: "Scene | None" = None
+
+def _init_worker(engine: RenderEngine, scene: Scene) -> None:
+    global _worker_engine, _worker_scene
+    _worker_engine = engine
+    _worker_scene = scene
+
+def _render_tile_in_worker(
+        tile: "tuple[int, int, int, int]", anti_aliasing: int, seed: int, first_sample: int) -> "tuple[list[Color], int]":
+    """Renders a tile in a pool process, returns its colors and the number of rays pruned while rendering it"""
+    pruned_rays = _worker_engine.pruned_rays
+    colors = _worker_engine.render_tile(_worker_scene, tile, anti_aliasing, seed, first_sample)
+    return colors, _worker_engine.pruned_rays - pruned_rays
+
+def default_engine(
+        sampler: "AdaptiveSampler | None" = None, min_weight: float = 0.0, russian_roulette: bool = False
+        ) -> RenderEngine:
+    """Returns the NumPy vectorized engine when NumPy is installed, the pure Python engine otherwise"""
+    try:
+        from vectorized_engine import VectorizedRenderEngine
+    except ImportError:
+        return RenderEngine(sampler, min_weight, russian_roulette)
+    return VectorizedRenderEngine(sampler, min_weight, russian_roulette)
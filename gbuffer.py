@@ -0,0 +1,272 @@
+"""G-buffer of the primary hits of a render, to re-shade the image after editing lights or materials
+
+Capturing a render keeps, for every pixel, the object hit by its camera ray with the distance, position and normal
+of the hit, which lights were blocked at that point, and the colors traced by the reflected and transmitted rays
+with the objects they reached. Re-shading after an edit of the lights (colors or positions) or of the materials
+only runs the lighting of the hits again: shadow rays are only cast towards lights that moved, and reflected or
+transmitted rays are only traced again when they reached a changed object, or any object after a light changed.
+The geometry and the camera must not change, the result is the same image a full render of the edited scene gives.
+
+    python main.py scene.json image.ppm --gbuffer scene.rtgb
+    # edit the lights or materials of scene.json, then
+    python gbuffer.py scene.json scene.rtgb image.ppm
+
+Renders are serial and use the Python engine, without anti-aliasing.
+"""
+from __future__ import annotations
+from array import array
+from components import Color, Image, Material, Ray, Scene, Vector3
+from engine import RenderEngine
+from utils import build_scene, load_scene_infos
+import argparse
+import json
+import struct
+
+MAGIC = b"RTGB"
+VERSION = 1
+# magic, version, width, height, number of lights, size of the scene state and number of secondary objects
+HEADER = struct.Struct("<4sHxxIIIII")
+# distance, position and normal of every hit
+GEOMETRY_FIELDS = 7
+# reflected and transmitted rays of every hit
+SECONDARY_RAYS = 2
+
+
+def _aligned(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+def _material_state(material: Material) -> list:
+    return [type(material).__name__] + [
+        [name, list(value) if isinstance(value, Vector3) else value] for name, value in sorted(vars(material).items())]
+
+
+def scene_state(scene: Scene) -> dict:
+    """What re-shading compares to find the changes of a scene, as json values"""
+    camera = scene.camera
+    return {
+        "camera": [list(camera.eye), list(camera.look_at), list(camera.up), camera.pixel_size, camera.focal_distance],
+        "lights": [[list(light.position), list(light.color)] for light in scene.lights],
+        "materials": [_material_state(obj.material) for obj in scene.objects],
+        "settings": [list(scene.ambient_color), list(scene.bg_color), scene.max_depth],
+    }
+
+
+class GBuffer:
+    """Primary hits of a render of the scene, see the module documentation
+
+    Every array has a fixed number of values per pixel, row by row: the index of the object hit (-1 for none),
+    GEOMETRY_FIELDS doubles of geometry, a byte per light, set when the light is blocked, and for each of the
+    SECONDARY_RAYS rays a flag telling if it was traced, its color and the sorted indices of the objects it reached.
+    """
+    def __init__(self, width: int, height: int, light_count: int) -> None:
+        pixels = width * height
+        self.width = width
+        self.height = height
+        self.light_count = light_count
+        self.objects = array('i', [-1]) * pixels
+        self.geometry = array('d', bytes(8 * GEOMETRY_FIELDS * pixels))
+        self.shadows = array('B', bytes(light_count * pixels))
+        self.secondary_traced = array('B', bytes(SECONDARY_RAYS * pixels))
+        self.secondary_colors = array('d', bytes(8 * 3 * SECONDARY_RAYS * pixels))
+        self.secondary_objects: list[tuple[int, ...]] = [()] * (SECONDARY_RAYS * pixels)
+        # State of the scene the buffer was last shaded with, None before the capture
+        self.state: "dict | None" = None
+        # Shadow and secondary rays cast by the last capture or re-shade
+        self.rays = {"shadow": 0, "secondary": 0}
+        self._engine = RenderEngine()
+
+    @classmethod
+    def capture(cls, scene: Scene) -> "tuple[GBuffer, Image]":
+        """Renders the scene, returns its G-buffer and the image, the same render_tile gives without anti-aliasing"""
+        gbuffer = cls(scene.width, scene.height, len(scene.lights))
+        return gbuffer, gbuffer._shade(scene)
+
+    def reshade(self, scene: Scene) -> Image:
+        """Renders the scene again after its lights or materials were edited, reusing everything that didn't change
+        scene must have the same objects, camera and resolution of the captured one
+        """
+        state = scene_state(scene)
+        if (scene.width, scene.height) != (self.width, self.height) or state["camera"] != self.state["camera"] \
+                or len(state["materials"]) != len(self.state["materials"]):
+            raise ValueError("The camera or the objects of the scene changed, capture a new G-buffer")
+        return self._shade(scene, state)
+
+    def _shade(self, scene: Scene, state: "dict | None" = None) -> Image:
+        """Shades every pixel, tracing the camera rays when capturing (state is None)"""
+        engine = self._engine
+        capturing = state is None
+        if capturing:
+            state = scene_state(scene)
+            old_state = {"lights": [], "materials": state["materials"], "settings": None}
+        else:
+            old_state = self.state
+
+        lights = state["lights"]
+        if len(lights) != self.light_count:
+            self.light_count = len(lights)
+            self.shadows = array('B', bytes(self.light_count * self.width * self.height))
+        old_lights = old_state["lights"] if len(old_state["lights"]) == len(lights) else [None] * len(lights)
+        # Shadow rays are only cast towards lights that moved, any change to a light changes the traced colors
+        recast = [old is None or old[0] != new[0] for old, new in zip(old_lights, lights)]
+        lights_changed = old_lights != lights
+        settings_changed = old_state["settings"] != state["settings"]
+        changed_objects = set()
+        # Changing the index of refraction changes the direction of the transmitted rays
+        refraction_changed = set()
+        for index, (old, new) in enumerate(zip(old_state["materials"], state["materials"])):
+            if old != new:
+                changed_objects.add(index)
+                if dict(old[1:]).get("refraction") != dict(new[1:]).get("refraction"):
+                    refraction_changed.add(index)
+
+        light_indices = {id(light): index for index, light in enumerate(scene.lights)}
+        object_indices = {id(obj): index for index, obj in enumerate(scene.objects)}
+        shadows = self.shadows
+        light_count = self.light_count
+        rays = self.rays = {"shadow": 0, "secondary": 0}
+        occluded = engine.occluded
+        find_nearest = engine.find_nearest
+        pixel = 0
+        hits: list[int] = []
+
+        def replayed_occluded(ray, scene, max_distance, light=None):
+            light_index = light_indices[id(light)]
+            index = pixel * light_count + light_index
+            if recast[light_index]:
+                rays["shadow"] += 1
+                shadows[index] = occluded(ray, scene, max_distance, light)
+            return bool(shadows[index])
+
+        def recording_find_nearest(ray, scene):
+            result = find_nearest(ray, scene)
+            if result[2] is not None:
+                hits.append(object_indices[id(result[2])])
+            return result
+
+        cam_focus, image_center, u, v, pixel_size = engine.view_plane(scene)
+        engine.shadow_cache.clear()
+        colors = []
+        geometry = self.geometry
+        try:
+            for y in range(self.height):
+                for x in range(self.width):
+                    pixel = y * self.width + x
+                    # Same camera ray as render_tile
+                    ray_direction = u * x
+                    ray_direction.imul_add(v, -y).imul(pixel_size).iadd(image_center).isub(cam_focus)
+                    ray = Ray(cam_focus, ray_direction.inormalize())
+                    direction = ray.direction
+                    if capturing:
+                        distance_hit, hit_normal, object_hit = engine.find_nearest(ray, scene)
+                        if object_hit is None:
+                            colors.append(scene.bg_color)
+                            continue
+                        hit_pos = (direction * distance_hit).iadd(ray.origin)
+                        self.objects[pixel] = object_indices[id(object_hit)]
+                        geometry[pixel * GEOMETRY_FIELDS:(pixel + 1) * GEOMETRY_FIELDS] = array(
+                            'd', (distance_hit, *hit_pos, *hit_normal))
+                    else:
+                        object_index = self.objects[pixel]
+                        if object_index < 0:
+                            colors.append(scene.bg_color)
+                            continue
+                        object_hit = scene.objects[object_index]
+                        first = pixel * GEOMETRY_FIELDS
+                        hit_pos = Vector3(*geometry[first + 1:first + 4])
+                        hit_normal = Vector3(*geometry[first + 4:first + 7])
+
+                    engine.occluded = replayed_occluded
+                    color = engine.color_at(object_hit, hit_pos, hit_normal, scene)
+                    del engine.occluded
+                    if scene.max_depth > 0:
+                        # Added in the order rayTrace adds them
+                        material = object_hit.material
+                        secondary_rays = engine.secondary_rays(direction, hit_pos, hit_normal, material)
+                        for slot, (secondary_ray, weight) in enumerate(
+                                zip(secondary_rays, (material.reflection, material.transmission))):
+                            if secondary_ray is None:
+                                continue
+                            index = pixel * SECONDARY_RAYS + slot
+                            objects = self.secondary_objects[index]
+                            if not self.secondary_traced[index] or settings_changed or (lights_changed and objects) \
+                                    or not changed_objects.isdisjoint(objects) \
+                                    or (slot == 1 and self.objects[pixel] in refraction_changed):
+                                self._trace_secondary(scene, index, secondary_ray, recording_find_nearest, hits)
+                            color.imul_add(Color(*self.secondary_colors[index * 3:index * 3 + 3]), weight)
+                    colors.append(color)
+        finally:
+            engine.__dict__.pop("occluded", None)
+            engine.__dict__.pop("find_nearest", None)
+
+        self.state = state
+        image = Image(self.width, self.height)
+        image.set_tile((0, 0, self.width, self.height), colors)
+        return image
+
+    def _trace_secondary(self, scene: Scene, index: int, ray: Ray, recording_find_nearest, hits: "list[int]") -> None:
+        """Traces a reflected or transmitted ray, keeping its color and the objects it reached"""
+        engine = self._engine
+        hits.clear()
+        engine.find_nearest = recording_find_nearest
+        color = engine.rayTrace(ray, scene, 1)
+        del engine.find_nearest
+        self.rays["secondary"] += 1
+        self.secondary_traced[index] = 1
+        self.secondary_colors[index * 3:index * 3 + 3] = array('d', color)
+        self.secondary_objects[index] = tuple(sorted(set(hits)))
+
+    def save(self, path: str) -> None:
+        """Writes the G-buffer and the state of the scene it was shaded with to a file"""
+        state = json.dumps(self.state).encode()
+        offsets = array('I', [0])
+        objects = array('I')
+        for secondary in self.secondary_objects:
+            objects.extend(secondary)
+            offsets.append(len(objects))
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, self.width, self.height, self.light_count, len(state), len(objects)))
+            for section in (state, self.objects, self.geometry, self.shadows, self.secondary_traced,
+                            self.secondary_colors, offsets, objects):
+                file.write(bytes(_aligned(file.tell()) - file.tell()))
+                file.write(section if isinstance(section, bytes) else section.tobytes())
+
+    @classmethod
+    def load(cls, path: str) -> GBuffer:
+        with open(path, "rb") as file:
+            data = file.read()
+        magic, version, width, height, light_count, state_size, object_count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a G-buffer")
+        gbuffer = cls(width, height, light_count)
+        pixels = width * height
+        offsets = array('I')
+        objects = array('I')
+        offset = _aligned(HEADER.size)
+        gbuffer.state = json.loads(data[offset:offset + state_size])
+        offset += state_size
+        for section, count in (
+                (gbuffer.objects, pixels), (gbuffer.geometry, GEOMETRY_FIELDS * pixels),
+                (gbuffer.shadows, light_count * pixels), (gbuffer.secondary_traced, SECONDARY_RAYS * pixels),
+                (gbuffer.secondary_colors, 3 * SECONDARY_RAYS * pixels), (offsets, SECONDARY_RAYS * pixels + 1),
+                (objects, object_count)):
+            offset = _aligned(offset)
+            size = count * section.itemsize
+            del section[:]
+            section.frombytes(data[offset:offset + size])
+            offset += size
+        gbuffer.secondary_objects = [
+            tuple(objects[start:end]) for start, end in zip(offsets, offsets[1:])]
+        return gbuffer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-shades a scene whose lights or materials changed from its G-buffer")
+    parser.add_argument("scene", help="Path of the edited scene")
+    parser.add_argument("gbuffer", help="G-buffer written by main.py --gbuffer, updated with the new shading")
+    parser.add_argument("imageout", help="Path of the image")
+    args = parser.parse_args()
+    gbuffer = GBuffer.load(args.gbuffer)
+    gbuffer.reshade(build_scene(load_scene_infos(args.scene))).save(args.imageout)
+    gbuffer.save(args.gbuffer)
+    print(f"shadow rays {gbuffer.rays['shadow']}, secondary rays {gbuffer.rays['secondary']}")
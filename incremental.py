@@ -0,0 +1,302 @@
+"""Incremental rendering: after an edit of the scene only the tiles the edit can change are rendered again
+
+While rendering a tile, every ray it traces is recorded: the objects hit by camera, reflected and transmitted rays
+or blocking shadow rays go in the tile's set of touched objects, and the rays that weren't stopped by an object
+are bounded by bundles, one per depth (and one per light for shadow rays), each a box of origins,
+a box of directions and the longest distance travelled.
+
+An edited object changes the tiles that touched it and, when it moved or changed shape, the tiles with a bundle
+that may reach its new bounding box. Editing a material changes the tiles that touched its object and editing
+lights changes every tile that hit anything. Editing the camera, the ambient light, the background or the depth,
+adding or removing lights and editing unbounded objects (planes) renders everything again.
+
+    python incremental.py scene.json image.ppm
+
+renders the scene and then renders it again, incrementally, every time scene.json is saved.
+"""
+from __future__ import annotations
+from components import Image, Ray, Scene
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from engine import RenderEngine
+from utils import build_scene, load_scene_infos
+import argparse
+import hashlib
+import os
+import pickle
+import time
+
+INFINITY = float('inf')
+
+
+def _digest(value) -> bytes:
+    return hashlib.sha256(pickle.dumps(value)).digest()
+
+
+def scene_snapshot(scene: Scene) -> dict:
+    """What incremental renders compare to find the edits of a scene
+    Objects are compared by the digests of their pickles, with and without their material, and their bounding boxes
+    """
+    camera = scene.camera
+    objects = []
+    for obj in scene.objects:
+        box = obj.bounding_box()
+        shape = {name: value for name, value in vars(obj).items() if name != "material"}
+        objects.append((_digest(obj), _digest(shape), None if box is None else (*box.minimum, *box.maximum)))
+    return {
+        "settings": _digest((
+            camera.eye, camera.look_at, camera.up, camera.pixel_size, camera.focal_distance,
+            scene.width, scene.height, scene.ambient_color, scene.bg_color, scene.max_depth)),
+        "lights": [_digest(light) for light in scene.lights],
+        "objects": objects,
+    }
+
+
+def may_reach(bundle: "list[float]", box: "tuple[float, ...]") -> bool:
+    """Checks if any ray of the bundle may get into the box (minimum x, y, z, maximum x, y, z)
+    Conservative: for each axis the rays are between the one leaving the lowest origin in the lowest direction and
+    the one leaving the highest origin in the highest direction, so a False is certain but a True may be wrong
+    """
+    low, high = 0.0, bundle[12]
+    for axis in range(3):
+        origin_min, origin_max = bundle[axis], bundle[axis + 3]
+        direction_min, direction_max = bundle[axis + 6], bundle[axis + 9]
+        box_min, box_max = box[axis], box[axis + 3]
+        # origin_min + t * direction_min <= box_max
+        if direction_min > 0:
+            high = min(high, (box_max - origin_min) / direction_min)
+        elif direction_min < 0:
+            low = max(low, (box_max - origin_min) / direction_min)
+        elif origin_min > box_max:
+            return False
+        # origin_max + t * direction_max >= box_min
+        if direction_max > 0:
+            low = max(low, (box_min - origin_max) / direction_max)
+        elif direction_max < 0:
+            high = min(high, (box_min - origin_max) / direction_max)
+        elif origin_max < box_min:
+            return False
+        if low > high:
+            return False
+    return True
+
+
+def may_reach_light(bundle: "list[float]", box: "tuple[float, ...]") -> bool:
+    """Checks if any segment between the box of origins of a shadow bundle and its light may get into the box
+    The segments are inside the boxes between the origins and the light, which grow like a bundle of rays
+    from the origins towards the light, over a distance of 1
+    """
+    light = bundle[6:9]
+    return may_reach([
+        *bundle[:6], *(light[axis] - bundle[axis] for axis in range(3)),
+        *(light[axis] - bundle[axis + 3] for axis in range(3)), 1.0], box)
+
+
+def render_recorded_tile(
+        engine: RenderEngine, scene: Scene, tile: "tuple[int, int, int, int]", anti_aliasing: int = 0, seed: int = 0
+        ) -> "tuple[list, set[int], dict]":
+    """Renders a tile with the scalar engine, returns its colors, the indices of the objects it touched
+    and the bundles of its rays, keyed by their depth, and of its shadow rays, keyed by ("shadow", light index, depth)
+    """
+    object_indices = {id(obj): index for index, obj in enumerate(scene.objects)}
+    light_indices = {id(light): index for index, light in enumerate(scene.lights)}
+    touched: set[int] = set()
+    bundles: dict = {}
+    depth = 0
+    # Rays weighted by 0, like the transmitted rays of opaque materials, and the rays they spawn can't change
+    # the tile, muted is set while one of them is traced. They are kept until they are traced, or until the end
+    # of the tile if they are pruned, so their ids can't be reused by other rays
+    muted = False
+    muted_rays: dict[int, Ray] = {}
+    trace_ray = engine.trace_ray
+    find_nearest = engine.find_nearest
+    occluded = engine.occluded
+
+    def add(key, ray: Ray, distance: float) -> None:
+        origin, direction = ray.origin, ray.direction
+        bundle = bundles.get(key)
+        if bundle is None:
+            bundles[key] = [*origin, *origin, *direction, *direction, distance]
+            return
+        for axis, value in enumerate((origin.x, origin.y, origin.z, direction.x, direction.y, direction.z)):
+            low = axis + axis // 3 * 3
+            if value < bundle[low]:
+                bundle[low] = value
+            if value > bundle[low + 3]:
+                bundle[low + 3] = value
+        if distance > bundle[12]:
+            bundle[12] = distance
+
+    def recording_trace_ray(ray: Ray, scene: Scene, ray_depth=0):
+        nonlocal depth, muted
+        # find_nearest is the first thing trace_ray calls
+        depth = ray_depth
+        muted = muted_rays.pop(id(ray), None) is not None
+        color, secondary = trace_ray(ray, scene, ray_depth)
+        for secondary_ray, weight in secondary:
+            if muted or weight == 0:
+                muted_rays[id(secondary_ray)] = secondary_ray
+        return color, secondary
+
+    def recording_find_nearest(ray: Ray, scene: Scene):
+        result = find_nearest(ray, scene)
+        if muted:
+            return result
+        if result[2] is None:
+            add(depth, ray, INFINITY)
+        else:
+            touched.add(object_indices[id(result[2])])
+            add(depth, ray, result[0])
+        return result
+
+    def recording_occluded(ray: Ray, scene: Scene, max_distance: float, light=None) -> bool:
+        blocked = occluded(ray, scene, max_distance, light)
+        if muted:
+            return blocked
+        if light is None:
+            add(depth, ray, max_distance)
+        elif blocked:
+            # The engine keeps the object that blocked the light
+            touched.add(object_indices[id(engine.shadow_cache[light])])
+        else:
+            # Shadow rays reach the light, so they are bounded by the segments between their origins and the light
+            key = ("shadow", light_indices[id(light)], depth)
+            bundle = bundles.get(key)
+            origin = ray.origin
+            if bundle is None:
+                bundles[key] = [*origin, *origin, *light.position]
+                return blocked
+            for axis, value in enumerate(origin):
+                if value < bundle[axis]:
+                    bundle[axis] = value
+                if value > bundle[axis + 3]:
+                    bundle[axis + 3] = value
+        return blocked
+
+    engine.trace_ray = recording_trace_ray
+    engine.find_nearest = recording_find_nearest
+    engine.occluded = recording_occluded
+    try:
+        colors = engine.render_tile(scene, tile, anti_aliasing, seed)
+    finally:
+        for name in ("trace_ray", "find_nearest", "occluded"):
+            engine.__dict__.pop(name, None)
+    return colors, touched, bundles
+
+
+class IncrementalRenderer:
+    """Renders a scene again and again after edits, rendering only the tiles the edits can change
+
+    Uses the scalar engine, with workers > 1 the tiles are rendered by a pool of processes started for each render.
+    """
+    def __init__(self, engine: "RenderEngine | None" = None, anti_aliasing: int = 0, seed: int = 0,
+                 workers: int = 1, tile_size: "int | None" = None) -> None:
+        self.engine = engine or RenderEngine()
+        # Objects are recorded from the rays of the scalar engine, other engines would leave the records empty
+        if type(self.engine) is not RenderEngine:
+            raise ValueError(f"Incremental renders need a RenderEngine, not a {type(self.engine).__name__}")
+        self.anti_aliasing = anti_aliasing
+        self.seed = seed
+        self.workers = workers
+        self.tile_size = tile_size or RenderEngine.TILE_SIZE
+        self.image: "Image | None" = None
+        self.snapshot: "dict | None" = None
+        # Objects touched and ray bundles of every tile
+        self.records: "dict[tuple[int, int, int, int], tuple[set[int], dict]]" = {}
+        # Tiles rendered by the last render
+        self.rendered_tiles: "list[tuple[int, int, int, int]]" = []
+
+    def render(self, scene: Scene) -> Image:
+        """Renders the scene, only the tiles changed since the previous render when there was one"""
+        snapshot = scene_snapshot(scene)
+        tiles = self.changed_tiles(snapshot)
+        if tiles is None:
+            self.image = Image(scene.width, scene.height)
+            self.records = {}
+            tiles = self.engine.split_tiles(scene.width, scene.height, self.tile_size)
+        self.rendered_tiles = tiles
+        for tile, (colors, touched, bundles) in self._render_tiles(scene, tiles):
+            self.image.set_tile(tile, colors)
+            self.records[tile] = touched, bundles
+        self.snapshot = snapshot
+        return self.image
+
+    def changed_tiles(self, snapshot: dict) -> "list[tuple[int, int, int, int]] | None":
+        """Returns the tiles the edits since the last render can change, None if every tile must be rendered"""
+        old = self.snapshot
+        if old is None or old["settings"] != snapshot["settings"] or len(old["lights"]) != len(snapshot["lights"]):
+            return None
+
+        touched_objects: set[int] = set()
+        new_boxes = []
+        for index in range(max(len(old["objects"]), len(snapshot["objects"]))):
+            before = old["objects"][index] if index < len(old["objects"]) else None
+            after = snapshot["objects"][index] if index < len(snapshot["objects"]) else None
+            if before == after:
+                continue
+            if (before is not None and before[2] is None) or (after is not None and after[2] is None):
+                return None
+            touched_objects.add(index)
+            if after is not None and (before is None or before[1] != after[1]):
+                new_boxes.append(after[2])
+        lights_changed = old["lights"] != snapshot["lights"]
+
+        tiles = []
+        for tile, (touched, bundles) in self.records.items():
+            if (lights_changed and touched) or not touched_objects.isdisjoint(touched) or any(
+                    (may_reach_light if isinstance(key, tuple) else may_reach)(bundle, box)
+                    for box in new_boxes for key, bundle in bundles.items()):
+                tiles.append(tile)
+        return tiles
+
+    def _render_tiles(self, scene: Scene, tiles: "list[tuple[int, int, int, int]]"):
+        scene.bvh
+        if self.workers <= 1 or len(tiles) <= 1:
+            for tile in tiles:
+                yield tile, render_recorded_tile(self.engine, scene, tile, self.anti_aliasing, self.seed)
+            return
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.engine, scene)) as executor:
+            futures = {executor.submit(_render_tile_in_worker, tile, self.anti_aliasing, self.seed): tile
+                       for tile in tiles}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+# State of each process of the render pool, set once by the pool initializer
+_worker_engine: "RenderEngine | None" = None
+_worker_scene: "Scene | None" = None
+
+def _init_worker(engine: RenderEngine, scene: Scene) -> None:
+    global _worker_engine, _worker_scene
+    _worker_engine = engine
+    _worker_scene = scene
+
+def _render_tile_in_worker(tile: "tuple[int, int, int, int]", anti_aliasing: int, seed: int):
+    return render_recorded_tile(_worker_engine, _worker_scene, tile, anti_aliasing, seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Renders a scene again every time its file changes, incrementally")
+    parser.add_argument("scene", help="Path of the json or binary scene")
+    parser.add_argument("imageout", help="Path of the image")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes rendering tiles in parallel")
+    parser.add_argument("--anti-aliasing", type=int, default=0, help="Number of random samples per pixel")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the anti-aliasing samples")
+    args = parser.parse_args()
+
+    renderer = IncrementalRenderer(anti_aliasing=args.anti_aliasing, seed=args.seed, workers=args.workers)
+    modified = None
+    try:
+        while True:
+            if os.path.getmtime(args.scene) != modified:
+                modified = os.path.getmtime(args.scene)
+                start = time.perf_counter()
+                try:
+                    scene = build_scene(load_scene_infos(args.scene))
+                except (ValueError, KeyError) as error:
+                    print(f"Can't load {args.scene}: {error}")
+                    continue
+                renderer.render(scene).save(args.imageout)
+                print(f"{len(renderer.rendered_tiles)} tiles rendered in {time.perf_counter() - start:.3f}s", flush=True)
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
@@ -1,22 +1,100 @@
-from utils import build_scene, load_from_json
-from components.image import Image
-from engine import RenderEngine
+from utils import build_scene, load_scene_infos, optimize_scene, RenderCheckpoint, RenderCache
+from components.image import Image, PPMStreamWriter
+from engine import RenderEngine, default_engine
+from sampler import AdaptiveSampler
+from stats import InstrumentedRenderEngine, RenderStats
+from gbuffer import GBuffer
+from contextlib import nullcontext
 import argparse
+import hashlib
 
 def generate_3d_image(json_path: str = "", image_out: str = "out.ppm", 
                       return_image: bool = False) -> Image:
     """
     Receives two arguments:
-    - The path to the json file containing the scene information.
+    - The path to the json (or binary scene) file containing the scene information.
     - The path to the output image file.
     Writes the image specified on json to the output file.
+    Optional flags choose how many processes render the tiles of the image.
+    The image is written as PNG if the output ends with .png, binary PPM (P6) otherwise,
+    or ASCII PPM (P3) with --ascii.
+    With --stream, tiles are written to the binary PPM as soon as they are rendered.
+    With --gbuffer, the primary hits are saved too, so gbuffer.py can re-shade the image after editing
+    the lights or materials of the scene without tracing it again.
+    With --min-weight or --prune, secondary rays that can barely change their pixel aren't traced,
+    --russian-roulette traces some of them at random instead so the image stays right on average.
+    With --cache, rendered tiles are kept in a directory and renders of the same scene and settings
+    only render the tiles missing from it, --crop renders part of the image from the same tiles.
+    With --checkpoint, the accumulated samples are kept in a file (output + .checkpoint or --checkpoint-file)
+    and --resume continues a render from it, skipping finished tiles.
+    Resuming with more --anti-aliasing samples adds the new samples to the ones already rendered.
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("jsonpath", default = json_path, nargs='?',
                 const=1, help="Path to config file to be loaded")
     parser.add_argument("imageout", default = image_out, nargs='?',
                 const=1, help="Path to output the rendered image")
+    parser.add_argument("--ascii", action="store_true",
+                help="Write the image as ASCII PPM (P3) instead of binary")
+    parser.add_argument("--workers", type=int, default=1,
+                help="Number of processes rendering tiles in parallel")
+    parser.add_argument("--tile-size", type=int, default=None,
+                help="Side in pixels of the square tiles the image is split into")
+    parser.add_argument("--stream", action="store_true",
+                help="Write each tile to the (binary PPM) output as soon as it is rendered")
+    parser.add_argument("--optimize", action="store_true",
+                help="Merge triangles into meshes, drop degenerate faces and share materials before rendering")
+    parser.add_argument("--anti-aliasing", type=int, default=0,
+                help="Number of random samples per pixel, 0 traces a single ray through the pixel's corner")
+    parser.add_argument("--adaptive", action="store_true",
+                help="Spend anti-aliasing samples only on noisy pixels and edges, up to --anti-aliasing per pixel")
+    parser.add_argument("--seed", type=int, default=0,
+                help="Seed of the anti-aliasing samples")
+    parser.add_argument("--checkpoint", action="store_true",
+                help="Keep the accumulated samples in a checkpoint file, output + .checkpoint by default")
+    parser.add_argument("--checkpoint-file", default=None,
+                help="Path of the checkpoint file, implies --checkpoint")
+    parser.add_argument("--resume", action="store_true",
+                help="Continue the render from its checkpoint file")
+    pruning = parser.add_mutually_exclusive_group()
+    pruning.add_argument("--min-weight", type=float, default=0.0,
+                help="Stop tracing secondary rays weighing less than this in their pixel")
+    pruning.add_argument("--prune", action="store_true",
+                help="Stop tracing secondary rays weighing less than half an 8 bit step (--min-weight 1/510)")
+    parser.add_argument("--russian-roulette", action="store_true",
+                help="Keep some of the rays under --min-weight at random, weighted up so the image stays unbiased")
+    parser.add_argument("--stats", action="store_true",
+                help="Count rays and intersection tests and time each phase, renders serially with the Python engine")
+    parser.add_argument("--heatmap", default=None,
+                help="Write an image of the intersection tests of each pixel to this path, implies --stats")
+    parser.add_argument("--gbuffer", default=None,
+                help="Also write the primary hits to this path, to re-shade edits of lights and materials with gbuffer.py")
+    parser.add_argument("--cache", default=None,
+                help="Directory of rendered tiles, tiles of previous renders of the same scene and settings are reused")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                help="Size in MB the cache directory is kept under, removing the least recently used tiles")
+    parser.add_argument("--crop", type=int, nargs=4, default=None, metavar=("X0", "Y0", "X1", "Y1"),
+                help="Render only the pixels from (X0, Y0) to (X1, Y1) exclusive, needs --cache")
     args = parser.parse_args()
+    args.checkpoint = args.checkpoint or args.checkpoint_file is not None
+    if args.prune:
+        args.min_weight = RenderEngine.PRUNE_WEIGHT
+    if args.stream and (args.ascii or args.imageout.lower().endswith(".png")):
+        parser.error("--stream only writes binary PPM files")
+    if args.stream and (args.checkpoint or args.resume):
+        parser.error("--stream can't be used with checkpoints")
+    if args.gbuffer and (args.stream or args.anti_aliasing or args.checkpoint or args.resume
+                         or args.min_weight or args.russian_roulette):
+        parser.error("--gbuffer renders without anti-aliasing, streaming, checkpoints or pruning")
+    if args.adaptive and (args.checkpoint or args.resume):
+        # Checkpoints weight each pixel by its samples, adaptive sampling stops flat pixels early
+        parser.error("--adaptive can't be used with checkpoints")
+    if args.russian_roulette and not args.min_weight:
+        parser.error("--russian-roulette needs --min-weight or --prune")
+    if args.crop and not args.cache:
+        parser.error("--crop needs --cache")
+    if args.cache and (args.stream or args.gbuffer or args.checkpoint or args.resume or args.stats or args.heatmap):
+        parser.error("--cache can't be used with streaming, checkpoints, --gbuffer or --stats")
 
     infos_path = args.jsonpath
     image_path = args.imageout
@@ -25,15 +103,96 @@ def generate_3d_image(json_path: str = "", image_out: str = "out.ppm",
         print("No json file specified. Run with -h for help.")
         return
 
-    infos = load_from_json(infos_path)
-    scene = build_scene(infos)
+    stats = RenderStats() if args.stats or args.heatmap else None
+    phase = stats.phase if stats else lambda name: nullcontext()
 
-    engine = RenderEngine()
-    image = engine.render(scene, True, 0)
-    if return_image: return image
+    with phase("load"):
+        infos = load_scene_infos(infos_path)
+    with phase("build"):
+        if args.optimize:
+            infos, report = optimize_scene(infos)
+            for name, value in report.items():
+                print(f"{name}: {value[0]} -> {value[1]}" if isinstance(value, tuple) else f"{name}: {value}")
 
-    with open(image_path, 'w') as img_file:
-        image.write_ppm(img_file)
+    sampler = AdaptiveSampler() if args.adaptive else None
+    if stats:
+        engine = InstrumentedRenderEngine(stats, sampler, args.min_weight, args.russian_roulette)
+    else:
+        engine = default_engine(sampler, args.min_weight, args.russian_roulette)
+    if args.cache:
+        # The scene is only built if some tile is missing from the cache
+        cache = RenderCache(args.cache, args.cache_size << 20)
+        image = cache.render(engine, infos, args.anti_aliasing, args.seed, args.workers, args.tile_size,
+                             crop=args.crop, show_progress=True)
+        print(f"cache: {cache.hits} tiles reused, {cache.misses} rendered")
+        write_pruned_rays(engine)
+        return image if return_image else write_image(image, image_path, args.ascii)
+
+    with phase("build"):
+        scene = build_scene(infos)
+        # The Python engine finds hits faster in the flat arrays of a compiled scene,
+        # the vectorized engine has its own and --stats counts the tests of each object
+        if type(engine) is RenderEngine:
+            scene = scene.compile()
+        scene.bvh
+
+    if args.stream:
+        image = Image(scene.width, scene.height)
+        tiles = engine.split_tiles(scene.width, scene.height, args.tile_size or engine.TILE_SIZE)
+        with PPMStreamWriter(image_path, scene.width, scene.height) as writer:
+            for done, (tile, colors) in enumerate(
+                    engine.render_iter(scene, args.anti_aliasing, args.workers, seed=args.seed, tiles=tiles), 1):
+                writer.write_tile(tile, colors)
+                image.set_tile(tile, colors)
+                print(f"{(done / len(tiles)) * 100:.2f}%", end='\r')
+        write_stats(engine, stats, args.heatmap)
+        write_pruned_rays(engine)
+        return image if return_image else None
+
+    if args.gbuffer:
+        gbuffer, image = GBuffer.capture(scene)
+        gbuffer.save(args.gbuffer)
+    elif args.checkpoint or args.resume:
+        checkpoint_path = args.checkpoint_file or image_path + ".checkpoint"
+        # Identifies the scene and the sample sequence, the number of samples may grow between runs
+        with open(infos_path, 'rb') as infos_file:
+            fingerprint = hashlib.sha256(infos_file.read() + b"seed:%d adaptive:%d" % (args.seed, args.adaptive)).digest()
+        with RenderCheckpoint(checkpoint_path, scene.width, scene.height, fingerprint, resume=args.resume) as checkpoint:
+            image = engine.render(scene, True, args.anti_aliasing, workers=args.workers,
+                                  tile_size=args.tile_size, seed=args.seed, checkpoint=checkpoint)
+    else:
+        image = engine.render(scene, True, args.anti_aliasing, workers=args.workers,
+                              tile_size=args.tile_size, seed=args.seed)
+    if return_image:
+        write_stats(engine, stats, args.heatmap)
+        write_pruned_rays(engine)
+        return image
+
+    with phase("write"):
+        write_image(image, image_path, args.ascii)
+    write_stats(engine, stats, args.heatmap)
+    write_pruned_rays(engine)
+
+def write_image(image: Image, image_path: str, ascii: bool) -> None:
+    """Writes the image as ASCII PPM, or as PNG or binary PPM depending on the extension of the path"""
+    if ascii:
+        with open(image_path, 'w') as img_file:
+            image.write_ppm(img_file)
+    else:
+        image.save(image_path)
+
+def write_pruned_rays(engine: RenderEngine) -> None:
+    """Prints how many secondary rays the render didn't trace, if it pruned them"""
+    if engine.min_weight:
+        print(f"pruned rays: {engine.pruned_rays}")
+
+def write_stats(engine: InstrumentedRenderEngine, stats: "RenderStats | None", heatmap_path: "str | None") -> None:
+    """Prints the statistics of the render and writes its heatmap, if they were collected"""
+    if stats is None:
+        return
+    print(stats.report())
+    if heatmap_path:
+        engine.heatmap().save(heatmap_path)
 
 if __name__ == "__main__":
     generate_3d_image()
\ No newline at end of file
@@ -0,0 +1,108 @@
+from __future__ import annotations
+from components import Color, Scene
+from math import sqrt
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from engine import RenderEngine
+
+
+def halton(index: int, base: int) -> float:
+    """index-th element of the Halton (radical inverse) sequence of base, in [0, 1)"""
+    result = 0.0
+    fraction = 1 / base
+    while index:
+        index, digit = divmod(index, base)
+        result += digit * fraction
+        fraction /= base
+    return result
+
+
+class AdaptiveSampler:
+    """Anti-aliasing that spends samples only where the pixels need them
+
+    Every pixel starts with initial_samples samples, then pixels get batches of batch_size more samples
+    while the standard error of their mean color is over tolerance, until they reach the budget.
+    After the first pass, pixels whose color differs from a neighbour by more than contrast are refined too,
+    which catches thin edges all the initial samples of a pixel missed.
+    Sample positions follow the Halton sequence in bases 2 and 3, which stays well spread for any number
+    of samples, shifted by a random offset per pixel so neighbouring pixels don't share the same pattern.
+    Flat areas, like the background, stop after the initial samples.
+    """
+    def __init__(self, initial_samples: int = 4, batch_size: int = 4,
+                 tolerance: float = 0.005, contrast: float = 0.05) -> None:
+        self.initial_samples = initial_samples
+        self.batch_size = batch_size
+        self.tolerance = tolerance
+        self.contrast = contrast
+
+    def render_tile(
+            self, engine: RenderEngine, scene: Scene, tile: "tuple[int, int, int, int]",
+            max_samples: int, seed: int = 0, first_sample: int = 0) -> "list[Color]":
+        """Renders the pixels of a tile with at most max_samples - first_sample samples each,
+        returns their colors row by row
+        """
+        x_start, y_start, x_end, y_end = tile
+        width = x_end - x_start
+        pixels = [(x, y) for y in range(y_start, y_end) for x in range(x_start, x_end)]
+        budget = max_samples - first_sample
+        random = engine.sample_random(seed, tile, first_sample).random
+        offsets = [(random(), random()) for _ in pixels]
+
+        # Per pixel: number of samples, sum and sum of squares of each channel
+        counts = [0] * len(pixels)
+        sums = [[0.0, 0.0, 0.0] for _ in pixels]
+        squares = [[0.0, 0.0, 0.0] for _ in pixels]
+
+        def sample(indices: "list[int]", samples: int) -> None:
+            xs = []
+            ys = []
+            owners = []
+            for index in indices:
+                x, y = pixels[index]
+                offset_x, offset_y = offsets[index]
+                count = counts[index]
+                for sample_index in range(count, min(count + samples, budget)):
+                    xs.append(x + (halton(sample_index, 2) + offset_x) % 1)
+                    ys.append(y + (halton(sample_index, 3) + offset_y) % 1)
+                    owners.append(index)
+            for index, color in zip(owners, engine.trace_points(scene, xs, ys)):
+                counts[index] += 1
+                total = sums[index]
+                square = squares[index]
+                for channel in range(3):
+                    total[channel] += color[channel]
+                    square[channel] += color[channel] * color[channel]
+
+        def noisy(index: int) -> bool:
+            count = counts[index]
+            if count < 2:
+                return count < budget
+            for channel in range(3):
+                mean = sums[index][channel] / count
+                variance = max(squares[index][channel] / count - mean * mean, 0)
+                if sqrt(variance / (count - 1)) > self.tolerance:
+                    return True
+            return False
+
+        sample(list(range(len(pixels))), self.initial_samples)
+
+        # Edge contrast against the right and bottom neighbours, both pixels of an edge are refined
+        means = [[channel / counts[index] for channel in sums[index]] for index in range(len(pixels))]
+        refine = [False] * len(pixels)
+        for index in range(len(pixels)):
+            neighbours = []
+            if (index + 1) % width:
+                neighbours.append(index + 1)
+            if index + width < len(pixels):
+                neighbours.append(index + width)
+            for neighbour in neighbours:
+                if max(abs(a - b) for a, b in zip(means[index], means[neighbour])) > self.contrast:
+                    refine[index] = refine[neighbour] = True
+
+        pending = [index for index in range(len(pixels)) if counts[index] < budget and (refine[index] or noisy(index))]
+        while pending:
+            sample(pending, self.batch_size)
+            pending = [index for index in pending if counts[index] < budget and noisy(index)]
+
+        return [Color(*(channel / counts[index] for channel in sums[index])) for index in range(len(pixels))]
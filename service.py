@@ -0,0 +1,450 @@
+"""Long running render service: renders the scenes sent to it over HTTP on a shared pool of processes
+
+    python service.py [--host 127.0.0.1] [--port 8080 | --unix /tmp/render.sock] [--workers 4]
+
+Requests and answers are JSON, scenes use the format of the json scene files (utils.load_from_json):
+- POST /jobs?priority=0&anti_aliasing=0&seed=0 with a scene as body: queues a job, answers 202 and its id
+- GET /jobs: the jobs the service knows about
+- GET /jobs/<id>: state, tiles done and timings of a job
+- GET /jobs/<id>/tiles: streams the tiles of the job as they are finished, one json object per line,
+  with their 8 bit RGB pixels in base64 (tiles already finished come first). ?progress=1 streams only the counts
+- GET /jobs/<id>/image: the finished image as PNG, or binary PPM with ?format=ppm
+- DELETE /jobs/<id>: cancels the job, tiles being rendered are finished but thrown away
+- GET /metrics: queued and running jobs, tiles waiting and in flight, tiles and pixels rendered per second
+
+Jobs are split in tiles and tiles are handed to the pool a few at a time, so a job with a higher priority
+gets its tiles rendered right after the tiles in flight, jobs of the same priority go in order of arrival.
+Scenes are written once to a temporary directory and each process of the pool builds a scene the first time
+it renders one of its tiles. Everything runs in this process and its pool, without any broker.
+If a process of the pool dies, a new pool is started and the tiles it was rendering are queued again,
+a job whose tiles were in the pool when it died twice fails.
+"""
+from __future__ import annotations
+from array import array
+from collections import OrderedDict, deque
+from components import Image, Scene
+from components.image import color_array, rgb_bytes
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from engine import RenderEngine, default_engine
+from urllib.parse import parse_qs, urlsplit
+from utils import build_scene, load_from_json, scene_infos
+import argparse
+import asyncio
+import base64
+import heapq
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import secrets
+import shutil
+import tempfile
+import time
+
+QUEUED, RUNNING, DONE, CANCELLED, FAILED = "queued", "running", "done", "cancelled", "failed"
+FINISHED_STATES = (DONE, CANCELLED, FAILED)
+REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    """Answers the request with status and a json error message"""
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class RenderJob:
+    """A scene being rendered by the service, with its finished tiles and the image they are assembled into"""
+    def __init__(self, job_id: str, sequence: int, infos: dict, scene_path: str, tiles: "list[tuple[int, int, int, int]]",
+                 priority: int = 0, anti_aliasing: int = 0, seed: int = 0) -> None:
+        self.id = job_id
+        self.sequence = sequence
+        self.scene_path = scene_path
+        self.priority = priority
+        self.anti_aliasing = anti_aliasing
+        self.seed = seed
+        self.width = infos["cam_width"]
+        self.height = infos["cam_height"]
+        self.tiles = tiles
+        self.pending = deque(tiles)
+        self.in_flight: set = set()
+        # Pools that died while rendering tiles of the job
+        self.crashed_pools: "set[int]" = set()
+        self.image = Image(self.width, self.height)
+        self.state = QUEUED
+        self.error: "str | None" = None
+        self.created = time.time()
+        self.started: "float | None" = None
+        self.finished: "float | None" = None
+        # Finished tiles with their pixels in order of completion, streams replay them to late clients
+        self.events: "list[dict]" = []
+        self.changed = asyncio.Condition()
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id, "state": self.state, "priority": self.priority, "error": self.error,
+            "width": self.width, "height": self.height, "anti_aliasing": self.anti_aliasing, "seed": self.seed,
+            "tiles": len(self.tiles), "tiles_done": len(self.events),
+            "created": self.created, "started": self.started, "finished": self.finished,
+        }
+
+    async def notify(self) -> None:
+        async with self.changed:
+            self.changed.notify_all()
+
+
+class RenderService:
+    """Queue of render jobs sharing one pool of processes, see the module documentation
+
+    Keeps up to tiles_in_flight tiles (two per worker by default) in the pool and the last keep_jobs finished jobs.
+    """
+    def __init__(self, workers: int = 1, tile_size: "int | None" = None, tiles_in_flight: "int | None" = None,
+                 keep_jobs: int = 64) -> None:
+        self.workers = workers
+        self.tile_size = tile_size or default_engine().TILE_SIZE
+        self.tiles_in_flight = tiles_in_flight or 2 * workers
+        self.keep_jobs = keep_jobs
+        self.jobs: "dict[str, RenderJob]" = {}
+        self.directory = tempfile.mkdtemp(prefix="render-service-")
+        # Forked processes would inherit the sockets of the connections open at the time,
+        # keeping them open after the service closes them
+        methods = multiprocessing.get_all_start_methods()
+        self._context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self._executor = ProcessPoolExecutor(workers, mp_context=self._context)
+        # Number of pools started after one died, tiles remember the one they were handed to
+        self._pool = 0
+        # Jobs with tiles to hand out as (-priority, sequence, job), the first one gets the next free slot
+        self._queue: list = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._started = time.monotonic()
+        self.counts = {"tiles": 0, "pixels": 0, DONE: 0, CANCELLED: 0, FAILED: 0}
+        # (time, pixels) of the tiles finished in the last THROUGHPUT_WINDOW seconds
+        self._recent: deque = deque()
+
+    THROUGHPUT_WINDOW = 60.0
+    # A job fails when its tiles were in the pool when it died this many times
+    MAX_CRASHES = 2
+
+    def submit(self, data: dict, priority: int = 0, anti_aliasing: int = 0, seed: int = 0) -> RenderJob:
+        """Queues the render of a scene given as the contents of a json scene file"""
+        try:
+            infos = scene_infos(data)
+            width, height = infos["cam_width"], infos["cam_height"]
+        except (KeyError, TypeError, ValueError) as error:
+            raise HTTPError(400, f"Invalid scene: {type(error).__name__}: {error}") from None
+        if not (isinstance(width, int) and isinstance(height, int) and width > 0 and height > 0):
+            raise HTTPError(400, "Invalid scene: h_res and v_res must be positive integers")
+
+        job_id = secrets.token_hex(8)
+        scene_path = os.path.join(self.directory, job_id + ".json")
+        with open(scene_path, "w") as file:
+            json.dump(data, file)
+        tiles = RenderEngine.split_tiles(width, height, self.tile_size)
+        job = RenderJob(job_id, next(self._sequence), infos, scene_path, tiles, priority, anti_aliasing, seed)
+        self.jobs[job_id] = job
+        heapq.heappush(self._queue, (-priority, job.sequence, job))
+        self._forget_old_jobs()
+        self._fill()
+        return job
+
+    async def cancel(self, job: RenderJob) -> None:
+        """Drops the tiles of the job that weren't handed to the pool yet, the others are thrown away when done"""
+        if job.state not in FINISHED_STATES:
+            await self._finish(job, CANCELLED)
+
+    async def wait(self, job: RenderJob) -> RenderJob:
+        async with job.changed:
+            await job.changed.wait_for(lambda: job.state in FINISHED_STATES)
+        return job
+
+    async def stream(self, job: RenderJob, progress_only: bool = False):
+        """Yields the finished tiles of the job, then an event with its final state"""
+        sent = 0
+        while True:
+            async with job.changed:
+                await job.changed.wait_for(lambda: len(job.events) > sent or job.state in FINISHED_STATES)
+                events = job.events[sent:]
+            for event in events:
+                sent += 1
+                yield {"done": event["done"], "total": event["total"]} if progress_only else event
+            if job.state in FINISHED_STATES and sent == len(job.events):
+                yield {"state": job.state, "error": job.error}
+                return
+
+    def metrics(self) -> dict:
+        now = time.monotonic()
+        recent = self._recent
+        while recent and recent[0][0] < now - self.THROUGHPUT_WINDOW:
+            recent.popleft()
+        window = min(self.THROUGHPUT_WINDOW, now - self._started) or 1
+        states = [job.state for job in self.jobs.values()]
+        return {
+            "workers": self.workers,
+            "queued_jobs": states.count(QUEUED),
+            "running_jobs": states.count(RUNNING),
+            "queue_depth": sum(len(job.pending) for job in self.jobs.values()),
+            "tiles_in_flight": self._in_flight,
+            "jobs_done": self.counts[DONE],
+            "jobs_cancelled": self.counts[CANCELLED],
+            "jobs_failed": self.counts[FAILED],
+            "pool_restarts": self._pool,
+            "tiles_rendered": self.counts["tiles"],
+            "pixels_rendered": self.counts["pixels"],
+            "tiles_per_second": len(recent) / window,
+            "pixels_per_second": sum(pixels for _, pixels in recent) / window,
+            "uptime_seconds": now - self._started,
+        }
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _fill(self) -> None:
+        """Hands tiles to the pool, from the most urgent jobs, until tiles_in_flight are being rendered"""
+        queue = self._queue
+        while self._in_flight < self.tiles_in_flight and queue:
+            job = queue[0][2]
+            if not job.pending:
+                heapq.heappop(queue)
+                continue
+            tile = job.pending.popleft()
+            if job.state == QUEUED:
+                job.state = RUNNING
+                job.started = time.time()
+            try:
+                future = self._executor.submit(_render_job_tile, job.scene_path, tile, job.anti_aliasing, job.seed)
+            except BrokenProcessPool:
+                self._restart_pool(self._pool)
+                future = self._executor.submit(_render_job_tile, job.scene_path, tile, job.anti_aliasing, job.seed)
+            job.in_flight.add(future)
+            self._in_flight += 1
+            asyncio.ensure_future(self._collect(job, tile, future, self._pool))
+
+    def _restart_pool(self, pool: int) -> None:
+        """Replaces the pool if it is still the one that died, the futures of its tiles fail with BrokenProcessPool"""
+        if pool != self._pool:
+            return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=self._context)
+        self._pool += 1
+
+    async def _collect(self, job: RenderJob, tile: "tuple[int, int, int, int]", future, pool: int) -> None:
+        try:
+            values = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            values = None
+        except BrokenProcessPool:
+            values = None
+            self._restart_pool(pool)
+            if job.state == RUNNING:
+                job.crashed_pools.add(pool)
+                if len(job.crashed_pools) >= self.MAX_CRASHES:
+                    job.error = "A process of the pool died rendering the job"
+                    await self._finish(job, FAILED)
+                else:
+                    self._requeue(job, tile)
+        except Exception as error:
+            values = None
+            if job.state == RUNNING:
+                job.error = f"{type(error).__name__}: {error}"
+                await self._finish(job, FAILED)
+        finally:
+            job.in_flight.discard(future)
+            self._in_flight -= 1
+            self._fill()
+        if values is None or job.state != RUNNING:
+            return
+
+        colors = array(Image.TYPECODE)
+        colors.frombytes(values)
+        job.image.set_tile_values(tile, colors)
+        pixels = (tile[2] - tile[0]) * (tile[3] - tile[1])
+        self.counts["tiles"] += 1
+        self.counts["pixels"] += pixels
+        self._recent.append((time.monotonic(), pixels))
+        job.events.append({"tile": list(tile), "rgb": base64.b64encode(rgb_bytes(colors)).decode("ascii"),
+                           "done": len(job.events) + 1, "total": len(job.tiles)})
+        if len(job.events) == len(job.tiles):
+            await self._finish(job, DONE)
+        else:
+            await job.notify()
+
+    async def _finish(self, job: RenderJob, state: str) -> None:
+        job.pending.clear()
+        # Only cancels the tiles still waiting in the pool, running ones are thrown away when they are done
+        for future in job.in_flight:
+            future.cancel()
+        job.state = state
+        job.finished = time.time()
+        self.counts[state] += 1
+        try:
+            os.remove(job.scene_path)
+        except FileNotFoundError:
+            pass
+        await job.notify()
+
+    def _requeue(self, job: RenderJob, tile: "tuple[int, int, int, int]") -> None:
+        """Hands the tile out again before the other pending tiles of the job"""
+        job.pending.appendleft(tile)
+        if all(entry[2] is not job for entry in self._queue):
+            heapq.heappush(self._queue, (-job.priority, job.sequence, job))
+
+    def _forget_old_jobs(self) -> None:
+        finished = [job for job in self.jobs.values() if job.state in FINISHED_STATES]
+        for job in finished[:max(len(finished) - self.keep_jobs, 0)]:
+            del self.jobs[job.id]
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080, unix: "str | None" = None) -> asyncio.AbstractServer:
+        """Starts answering HTTP requests on host and port, or on a unix socket"""
+        if unix is not None:
+            return await asyncio.start_unix_server(self.handle, unix)
+        return await asyncio.start_server(self.handle, host, port)
+
+    MAX_BODY = 256 << 20
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answers one HTTP request and closes the connection"""
+        try:
+            try:
+                method, path, query, body = await self._read_request(reader)
+                await self._route(writer, method, path, query, body)
+            except HTTPError as error:
+                self._respond(writer, error.status, {"error": str(error)})
+            except (ConnectionError, asyncio.IncompleteReadError):
+                return
+            except Exception as error:
+                self._respond(writer, 500, {"error": f"{type(error).__name__}: {error}"})
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> "tuple[str, str, dict, bytes]":
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise HTTPError(400, "Malformed request line")
+        method, target, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0) or 0)
+        if length > self.MAX_BODY:
+            raise HTTPError(413, f"Bodies are limited to {self.MAX_BODY} bytes")
+        body = await reader.readexactly(length) if length else b""
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        return method.upper(), url.path.rstrip("/") or "/", query, body
+
+    async def _route(self, writer: asyncio.StreamWriter, method: str, path: str, query: dict, body: bytes) -> None:
+        parts = path.strip("/").split("/")
+        if parts == ["metrics"] and method == "GET":
+            return self._respond(writer, 200, self.metrics())
+        if parts == ["jobs"]:
+            if method == "GET":
+                return self._respond(writer, 200, [job.summary() for job in self.jobs.values()])
+            if method == "POST":
+                try:
+                    data = json.loads(body)
+                    options = {name: int(query.get(name, 0)) for name in ("priority", "anti_aliasing", "seed")}
+                except ValueError as error:
+                    raise HTTPError(400, str(error)) from None
+                job = self.submit(data, **options)
+                return self._respond(writer, 202, job.summary())
+            raise HTTPError(405, f"{method} not allowed on /jobs")
+        if len(parts) not in (2, 3) or parts[0] != "jobs":
+            raise HTTPError(404, f"No such resource {path}")
+        job = self.jobs.get(parts[1])
+        if job is None:
+            raise HTTPError(404, f"No such job {parts[1]}")
+
+        resource = parts[2] if len(parts) == 3 else None
+        if resource is None and method == "GET":
+            return self._respond(writer, 200, job.summary())
+        if resource is None and method == "DELETE":
+            await self.cancel(job)
+            return self._respond(writer, 200, job.summary())
+        if resource == "tiles" and method == "GET":
+            return await self._stream(writer, job, query.get("progress", "0") not in ("0", ""))
+        if resource == "image" and method == "GET":
+            if job.state != DONE:
+                raise HTTPError(409, f"Job {job.id} is {job.state}")
+            image_file = io.BytesIO()
+            if query.get("format") == "ppm":
+                job.image.write_ppm_binary(image_file)
+                return self._respond(writer, 200, image_file.getvalue(), "image/x-portable-pixmap")
+            job.image.write_png(image_file)
+            return self._respond(writer, 200, image_file.getvalue(), "image/png")
+        raise HTTPError(405 if resource in (None, "tiles", "image") else 404, f"{method} not allowed on {path}")
+
+    @staticmethod
+    def _respond(writer: asyncio.StreamWriter, status: int, content, content_type: str = "application/json") -> None:
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode()
+        writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(content)}\r\nConnection: close\r\n\r\n".encode("latin-1") + content)
+
+    async def _stream(self, writer: asyncio.StreamWriter, job: RenderJob, progress_only: bool) -> None:
+        """Writes the events of the job as json lines in a chunked response, until the job is finished"""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        async for event in self.stream(job, progress_only):
+            line = json.dumps(event).encode() + b"\n"
+            writer.write(b"%x\r\n%s\r\n" % (len(line), line))
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+
+
+# Engine and scenes of each process of the pool, scenes are kept by the path of their file
+_worker_engine: "RenderEngine | None" = None
+_worker_scenes: "OrderedDict[str, Scene]" = OrderedDict()
+WORKER_SCENES = 4
+
+def _render_job_tile(scene_path: str, tile: "tuple[int, int, int, int]", anti_aliasing: int, seed: int) -> bytes:
+    """Renders a tile of the scene in the file, returns its colors as the bytes of an array of doubles"""
+    global _worker_engine
+    if _worker_engine is None:
+        _worker_engine = default_engine()
+    scene = _worker_scenes.get(scene_path)
+    if scene is None:
+        scene = build_scene(load_from_json(scene_path))
+        if type(_worker_engine) is RenderEngine:
+            scene = scene.compile()
+        _worker_scenes[scene_path] = scene
+        if len(_worker_scenes) > WORKER_SCENES:
+            _worker_scenes.popitem(last=False)
+    _worker_scenes.move_to_end(scene_path)
+    return color_array(_worker_engine.render_tile(scene, tile, anti_aliasing, seed), Image.TYPECODE).tobytes()
+
+
+async def serve(host: str, port: int, unix: "str | None", workers: int, tile_size: "int | None") -> None:
+    service = RenderService(workers, tile_size)
+    server = await service.start(host, port, unix)
+    print(f"Rendering on {unix or f'http://{host}:{port}'} with {workers} workers", flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Renders the scenes sent to it over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--unix", default=None, help="Listen on this unix socket instead of a TCP port")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of processes rendering tiles")
+    parser.add_argument("--tile-size", type=int, default=None, help="Side in pixels of the square tiles jobs are split into")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.tile_size))
+    except KeyboardInterrupt:
+        pass
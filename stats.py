@@ -0,0 +1,179 @@
+"""Opt-in render statistics
+
+RenderEngine has no instrumentation at all, so it pays nothing for it.
+InstrumentedRenderEngine is a drop in replacement that counts rays, intersection tests and
+recursion depths, times the tracing and shading phases and keeps the cost of every pixel,
+which heatmap turns into an image.
+"""
+from __future__ import annotations
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from components import Color, Image, Object3D, Ray, Scene, TriangleMesh
+from engine import RenderEngine
+from math import floor
+from typing import Iterator
+import time
+
+
+class RenderStats:
+    """Counters and phase timings of a render"""
+    def __init__(self) -> None:
+        self.rays: Counter = Counter()
+        self.intersection_tests: Counter = Counter()
+        self.depths: Counter = Counter()
+        self.phases: dict[str, float] = {}
+        self.pixel_costs = array('d')
+        self.width = 0
+        self.height = 0
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Times the block as the phase name, like load, build or write"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def to_dict(self) -> dict:
+        return {
+            "rays": dict(self.rays),
+            "intersection_tests": dict(self.intersection_tests),
+            "depths": {str(depth): count for depth, count in sorted(self.depths.items())},
+            "phases": dict(self.phases),
+        }
+
+    def report(self) -> str:
+        lines = ["rays: " + ", ".join(f"{kind} {count}" for kind, count in self.rays.most_common())]
+        lines.append("intersection tests: " + ", ".join(
+            f"{kind} {count}" for kind, count in self.intersection_tests.most_common()))
+        lines.append("rays per depth: " + ", ".join(
+            f"{depth}: {count}" for depth, count in sorted(self.depths.items())))
+        lines.append("phases: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.phases.items()))
+        return "\n".join(lines)
+
+
+def heatmap(costs: array, width: int, height: int) -> Image:
+    """Image of the per pixel costs, from black (cheapest) through red and yellow to white (most expensive)"""
+    image = Image(width, height)
+    highest = max(costs, default=0) or 1
+    values = array(Image.TYPECODE)
+    for cost in costs:
+        level = 3 * cost / highest
+        values.extend((min(level, 1), min(max(level - 1, 0), 1), min(max(level - 2, 0), 1)))
+    image.buffer = values
+    return image
+
+
+class InstrumentedRenderEngine(RenderEngine):
+    """RenderEngine that collects RenderStats while rendering
+
+    Intersection tests are counted by wrapping the methods of the scene's objects during the render,
+    the costs of a primary ray and of all the rays it spawns go to the pixel it goes through.
+    Statistics are collected in the rendering process, so the tiles are always rendered serially.
+    """
+    def __init__(self, stats: "RenderStats | None" = None, sampler=None, min_weight: float = 0.0,
+                 russian_roulette: bool = False) -> None:
+        super().__init__(sampler, min_weight, russian_roulette)
+        self.stats = stats or RenderStats()
+        self._pixel = 0
+        self._view = None
+        self._shadow_seconds = 0.0
+
+    def render_iter(self, scene: Scene, anti_aliasing: int = 0, workers: int = 1, *args, **kwargs):
+        self.stats.width, self.stats.height = scene.width, scene.height
+        if len(self.stats.pixel_costs) != scene.width * scene.height:
+            self.stats.pixel_costs = array('d', bytes(8 * scene.width * scene.height))
+        self._view = self.view_plane(scene)
+        wrapped = self._wrap_objects(scene)
+        start = time.perf_counter()
+        pruned_rays = self.pruned_rays
+        try:
+            yield from super().render_iter(scene, anti_aliasing, 1, *args, **kwargs)
+        finally:
+            self.stats.add_time("render", time.perf_counter() - start)
+            if self.pruned_rays > pruned_rays:
+                self.stats.rays["pruned"] += self.pruned_rays - pruned_rays
+            for obj in wrapped:
+                obj.__dict__.pop("intersects", None)
+                obj.__dict__.pop("occluded", None)
+                obj.__dict__.pop("_intersect_face", None)
+
+    def _wrap_objects(self, scene: Scene) -> "list[Object3D]":
+        """Counts the intersection tests of every object by shadowing its methods with counting ones"""
+        wrapped = []
+        for obj in scene.objects:
+            objects = [obj]
+            # Surfaces of revolution delegate to their mesh
+            if isinstance(getattr(obj, "triangle_mesh", None), TriangleMesh):
+                objects.append(obj.triangle_mesh)
+            for target in objects:
+                for name in ("intersects", "occluded", "_intersect_face"):
+                    method = getattr(target, name, None)
+                    if method is not None:
+                        label = type(target).__name__ + (" faces" if name == "_intersect_face" else "")
+                        setattr(target, name, self._counting(method, label))
+                wrapped.append(target)
+        return wrapped
+
+    def _counting(self, method, label: str):
+        tests = self.stats.intersection_tests
+        costs = self.stats.pixel_costs
+
+        def counting_method(*args):
+            tests[label] += 1
+            costs[self._pixel] += 1
+            return method(*args)
+        return counting_method
+
+    def _pixel_of(self, ray: Ray) -> int:
+        """Index of the pixel a primary ray goes through, projecting its direction on the view plane"""
+        cam_focus, image_center, u, v, pixel_size = self._view
+        direction = ray.direction
+        w = u.cross_product(v)
+        scale = ((image_center - cam_focus) ^ w) / (direction ^ w)
+        offset = direction * scale - (image_center - cam_focus)
+        # The small offset keeps rays through pixel corners in the pixel they belong to
+        x = min(max(floor((offset ^ u) / pixel_size + 1e-6), 0), self.stats.width - 1)
+        y = min(max(floor(-(offset ^ v) / pixel_size + 1e-6), 0), self.stats.height - 1)
+        return y * self.stats.width + x
+
+    def trace_ray(self, ray: Ray, scene: Scene, depth=0):
+        if depth == 0:
+            self._pixel = self._pixel_of(ray)
+            self.stats.rays["primary"] += 1
+        else:
+            self.stats.rays["secondary"] += 1
+        self.stats.depths[depth] += 1
+        return super().trace_ray(ray, scene, depth)
+
+    def find_nearest(self, ray: Ray, scene: Scene):
+        start = time.perf_counter()
+        result = super().find_nearest(ray, scene)
+        self.stats.add_time("trace", time.perf_counter() - start)
+        return result
+
+    def occluded(self, ray: Ray, scene: Scene, max_distance: float, light=None) -> bool:
+        self.stats.rays["shadow"] += 1
+        start = time.perf_counter()
+        result = super().occluded(ray, scene, max_distance, light)
+        seconds = time.perf_counter() - start
+        self._shadow_seconds += seconds
+        self.stats.add_time("shadow", seconds)
+        return result
+
+    def color_at(self, object_hit, hit_pos, normal, scene: Scene) -> Color:
+        """Shading time doesn't include the shadow rays, timed apart"""
+        start = time.perf_counter()
+        shadow_seconds = self._shadow_seconds
+        color = super().color_at(object_hit, hit_pos, normal, scene)
+        self.stats.add_time("shade", time.perf_counter() - start - (self._shadow_seconds - shadow_seconds))
+        return color
+
+    def heatmap(self) -> Image:
+        """Intersection tests per pixel of the last render as an image"""
+        return heatmap(self.stats.pixel_costs, self.stats.width, self.stats.height)
@@ -1,6 +1,36 @@
 
-from components import Vector3
+from components import Image, PPMStreamWriter, Vector3, Point, Ray, Sphere, Triangle, TriangleMesh, RevolutionSurface, Plane, Material, Camera, Scene, Light, Color, Instance
+from engine import RenderEngine
+from sampler import AdaptiveSampler, halton
+from stats import InstrumentedRenderEngine
+from utils import RenderCache, RenderCheckpoint, build_scene, load_from_binary, load_from_json, load_obj, optimize_scene, scene_infos, write_binary_scene
+from benchmarks.scenes import compare_images, compare_with_baseline, count_rays, run_case
+from batch import find_scenes, render_batch, render_scene_file
+from animation import interpolate_cameras, render_animation, turntable
+from gbuffer import GBuffer
+from incremental import IncrementalRenderer, may_reach
+from service import RenderService
+from distributed import Coordinator, run_worker
+from multiprocessing.connection import Client
+from random import Random
+import asyncio
+import base64
+import batch
+import io
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
 import unittest
+import zlib
+
+try:
+    from vectorized_engine import VectorizedRenderEngine
+except ImportError:
+    VectorizedRenderEngine = None
 
 class TestVector(unittest.TestCase):
     def setUp(self) -> None:
@@ -43,6 +73,935 @@ class TestVector(unittest.TestCase):
         result = self.v1.normalize()
         self.assertEqual(result, Vector3(1/3, -2/3, -2/3))
 
+    def testInPlace(self):
+        result = Vector3(1., -2., -2.)
+        self.assertIs(result.imul_add(self.v2, 2), result)
+        self.assertEqual(result, self.v1 + self.v2 * 2)
+        self.assertEqual(Vector3(1., -2., -2.).iadd(self.v2).isub(self.v1).imul(3), self.v2 * 3)
+        self.assertEqual(Vector3(1., -2., -2.).inormalize(), self.v1.normalize())
+
+    def testNoInstanceDict(self):
+        self.assertFalse(hasattr(self.v1, '__dict__'))
+
+    def testTransformKeepsMatrix(self):
+        matrix = [[0, -1, 0], [1, 0, 0], [0, 0, 2]]
+        self.assertEqual(self.v1.transform(matrix), Vector3(2, 1, -4))
+        self.assertEqual(matrix, [[0, -1, 0], [1, 0, 0], [0, 0, 2]])
+
+class TestBVH(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = Random(42)
+        material = Material()
+        objects = [Plane(Point(0, -60, 0), Vector3(0, 1, 0), material)]
+        for _ in range(40):
+            center = Point(rng.uniform(-50, 50), rng.uniform(-50, 50), rng.uniform(-50, 50))
+            objects.append(Sphere(center, rng.uniform(1, 8), material))
+            objects.append(Triangle(
+                center, center + Vector3(rng.uniform(1, 9), 0, 0),
+                center + Vector3(0, rng.uniform(1, 9), rng.uniform(-3, 3)), material))
+        camera = Camera(10, 10, 1, 10, Point(0, 0, 100), Point(0, 0, 0))
+        self.scene = Scene(camera, objects, [])
+        self.rays = [
+            Ray(Point(rng.uniform(-60, 60), rng.uniform(-60, 60), 100), Vector3(rng.uniform(-.5, .5), rng.uniform(-.5, .5), -1))
+            for _ in range(300)]
+
+    def linear_nearest(self, ray):
+        distance_min, object_hit = None, None
+        for obj in self.scene.objects:
+            distance, _ = obj.intersects(ray)
+            if distance is not None and (object_hit is None or distance < distance_min):
+                distance_min, object_hit = distance, obj
+        return distance_min, object_hit
+
+    def testPlanesStayUnbounded(self):
+        self.scene.build_bvh()
+        self.assertEqual([obj for _, obj in self.scene.unbounded_objects], self.scene.objects[:1])
+        self.assertEqual(self.scene.bvh.size, 80)
+
+    def testMatchesLinearSearch(self):
+        for ray in self.rays:
+            distance, _, object_hit = self.scene.find_nearest(ray)
+            self.assertEqual((distance, object_hit), self.linear_nearest(ray))
+
+    def testOccluderMatchesNearest(self):
+        blocked = 0
+        for ray in self.rays:
+            distance, _ = self.linear_nearest(ray)
+            for max_distance in (30, 90, 150):
+                occluder = self.scene.occluder(ray, max_distance)
+                self.assertEqual(occluder is not None, distance is not None and distance < max_distance)
+                if occluder is not None:
+                    blocked += 1
+                    self.assertTrue(occluder.occluded(ray, max_distance))
+                    others = [obj for obj in self.scene.objects if obj is not occluder and obj.occluded(ray, max_distance)]
+                    self.assertEqual(self.scene.occluder(ray, max_distance, skip=occluder) is not None, bool(others))
+        self.assertGreater(blocked, 0)
+
+class TestTriangleMesh(unittest.TestCase):
+    def setUp(self) -> None:
+        control_points = [Point(0, 0, 0), Point(20, 0, 10), Point(5, 0, 30), Point(12, 0, 40)]
+        self.mesh = RevolutionSurface(control_points, 12, Point(0, 0, 0), Vector3(0, 0, 1), Material()).triangle_mesh
+        rng = Random(7)
+        self.rays = [
+            Ray(Point(rng.uniform(-30, 30), -100, rng.uniform(-5, 45)), Vector3(rng.uniform(-.2, .2), 1, rng.uniform(-.2, .2)))
+            for _ in range(200)]
+
+    def testMatchesTriangles(self):
+        triangles = [
+            Triangle(*(self.mesh.list_vertices[i] for i in face), self.mesh.material)
+            for face in self.mesh.list_triangles]
+        hits = 0
+        for ray in self.rays:
+            expected_distance, expected_normal = None, None
+            for triangle in triangles:
+                distance, normal = triangle.intersects(ray)
+                if distance is not None and (expected_distance is None or distance < expected_distance):
+                    expected_distance, expected_normal = distance, normal
+            distance, normal = self.mesh.intersects(ray)
+            self.assertEqual(distance, expected_distance)
+            self.assertEqual(self.mesh.occluded(ray, 150), distance is not None and distance < 150)
+            if distance is not None:
+                hits += 1
+                self.assertEqual(normal, expected_normal)
+        self.assertGreater(hits, 0)
+
+    def testRevolutionSurface(self):
+        control_points = [Point(1, 2, 0), Point(8, 3, 10), Point(5, -2, 20)]
+        surface = RevolutionSurface(control_points, 9, Point(1, 1, 1), Vector3(1, 2, .5), Material())
+        vertices = surface.triangle_mesh.list_vertices
+        self.assertEqual(vertices[2 * 9 + 3], surface.evaluate_point(2 / 8, 3 / 8))
+        same = RevolutionSurface(control_points, 9, Point(1, 1, 1), Vector3(1, 2, .5), Material(Color(1, 0, 0)))
+        self.assertIs(same.triangle_mesh.face_data, surface.triangle_mesh.face_data)
+        self.assertIsNot(same.triangle_mesh.material, surface.triangle_mesh.material)
+
+        rng = Random(3)
+        skipped = 0
+        for _ in range(300):
+            ray = Ray(Point(rng.uniform(-40, 40), rng.uniform(-40, 40), rng.uniform(-40, 40)),
+                      Vector3(rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1)))
+            self.assertEqual(surface.intersects(ray), surface.triangle_mesh.intersects(ray))
+            self.assertEqual(surface.occluded(ray, 30), surface.triangle_mesh.occluded(ray, 30))
+            skipped += not surface._may_hit(ray, math.inf)
+        self.assertGreater(skipped, 0)
+
+class TestInstance(unittest.TestCase):
+    def setUp(self) -> None:
+        control_points = [Point(0, 0, 0), Point(20, 0, 10), Point(5, 0, 30), Point(12, 0, 40)]
+        self.mesh = RevolutionSurface(control_points, 12, Point(0, 0, 0), Vector3(0, 0, 1), Material()).triangle_mesh
+        rng = Random(11)
+        self.rays = [
+            Ray(Point(rng.uniform(-40, 40), -100, rng.uniform(-20, 60)), Vector3(rng.uniform(-.2, .2), 1, rng.uniform(-.2, .2)))
+            for _ in range(200)]
+
+    def assertSameHits(self, obj, other):
+        hits = 0
+        for ray in self.rays:
+            distance, normal = obj.intersects(ray)
+            expected_distance, expected_normal = other.intersects(ray)
+            self.assertEqual(distance is None, expected_distance is None)
+            self.assertEqual(obj.occluded(ray, 100), other.occluded(ray, 100))
+            if distance is not None:
+                hits += 1
+                self.assertAlmostEqual(distance, expected_distance)
+                for value, expected in zip(normal, expected_normal):
+                    self.assertAlmostEqual(value, expected)
+        self.assertGreater(hits, 0)
+
+    def testMatchesTransformedCopy(self):
+        axis_point, axis = Point(5, 0, 10), Vector3(1, 0, 1)
+        copy = self.mesh.rotate(axis_point, axis, 40).translate(Vector3(10, 0, 5))
+        instance = Instance(self.mesh).rotate(axis_point, axis, 40).translate(Vector3(10, 0, 5))
+        self.assertIs(instance.object, self.mesh)
+        self.assertSameHits(instance, copy)
+        box, copy_box = instance.bounding_box(), copy.bounding_box()
+        self.assertTrue(all(a <= b for a, b in zip(box.minimum, copy_box.minimum)))
+        self.assertTrue(all(a >= b for a, b in zip(box.maximum, copy_box.maximum)))
+
+    def testScaledAndNested(self):
+        sphere = Sphere(Point(0, 0, 20), 10, Material())
+        instance = Instance(Instance(sphere, [[2, 0, 0], [0, 2, 0], [0, 0, 2]]), [[1, 0, 0, 5], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+        self.assertIs(instance.object, sphere)
+        self.assertSameHits(instance, Sphere(Point(5, 0, 40), 20, Material()))
+
+class TestBinaryScene(unittest.TestCase):
+    def setUp(self) -> None:
+        self.infos = {
+            "cam_width": 12, "cam_height": 9, "cam_square_size": 0.5, "cam_focal_distance": 20,
+            "cam_eye": (0, -60, 10), "cam_look_at": (0, 0, 10), "cam_up": (0, 0, 1),
+            "bg_color": (10, 20, 30), "ambient_light": (255, 255, 255), "max_depth": 2,
+            "lights": [{"position": [30, -40, 50], "intensity": [255, 255, 255]}],
+            "objects": [
+                {"color": [200, 40, 40], "sphere": {"center": [5, 0, 10], "radius": 4.1}},
+                {"color": [40, 200, 40], "kr": 0, "plane": {"sample": [0, 0, 0], "normal": [0, 0.3, 1]}},
+                {"color": [200, 40, 40], "triangle": [[-10, 5, 0], [-2, 5, 0], [-6, 5, 8]]},
+                {"color": [40, 40, 200], "triangle_mesh": {
+                    "verteces": [[0, 2, 15], [4, 2, 15], [4, 6, 19], [0, 6, 19]],
+                    "triangle_indexes": [[1, 2, 3], [1, 3, 4]]}},
+            ]}
+
+    def testRoundTrip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "scene.rtscene")
+            write_binary_scene(self.infos, path)
+            loaded = load_from_binary(path)
+        self.assertIs(loaded["objects"][0].material, loaded["objects"][2].material)
+        mesh = loaded["objects"][3]
+        self.assertEqual(mesh.list_triangles, [(0, 1, 2), (0, 2, 3)])
+        self.assertEqual(mesh.bvh.nodes, build_scene(self.infos).objects[3].bvh.nodes)
+        engine = RenderEngine()
+        self.assertEqual(engine.render(build_scene(loaded)).buffer, engine.render(build_scene(self.infos)).buffer)
+
+    def testObj(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "quad.obj")
+            with open(path, "w") as obj_file:
+                obj_file.write("# quad\nv 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nvn 0 0 1\nf 1//1 2//1 3//1 -1//1\n")
+            mesh = load_obj(path)
+        self.assertEqual(mesh.list_triangles, [(0, 1, 2), (0, 2, 3)])
+        self.assertEqual(mesh.list_vertices[2], Point(1, 1, 0))
+
+class TestOptimizeScene(unittest.TestCase):
+    def setUp(self) -> None:
+        red = {"color": [200, 40, 40]}
+        self.infos = {
+            "cam_width": 12, "cam_height": 9, "cam_square_size": 0.5, "cam_focal_distance": 20,
+            "cam_eye": (0, -60, 10), "cam_look_at": (0, 0, 10), "cam_up": (0, 0, 1),
+            "bg_color": (10, 20, 30), "ambient_light": (255, 255, 255), "max_depth": 2, "lights": [],
+            "objects": [
+                {**red, "triangle": [[-10, 5, 0], [10, 5, 0], [0, 5, 20]]},
+                {**red, "sphere": {"center": [5, 0, 10], "radius": 4}},
+                {**red, "triangle": [[-10, 5, 0], [0, 5, 20], [-20, 5, 20]]},
+                {**red, "triangle": [[0, 0, 0], [1, 1, 1], [2, 2, 2]]},
+                {"color": [40, 40, 200], "triangle": [[10, 5, 0], [20, 5, 20], [0, 5, 20]]},
+            ]}
+
+    def testMergesTriangles(self):
+        optimized, report = optimize_scene(self.infos)
+        mesh, sphere, other = optimized["objects"]
+        self.assertIsInstance(mesh, TriangleMesh)
+        self.assertEqual(mesh.list_triangles, [(0, 1, 2), (0, 2, 3)])
+        self.assertIs(mesh.material, sphere.material)
+        self.assertEqual(report, {
+            "objects": (5, 3), "vertices": (12, 7), "materials": (5, 2), "degenerate_faces": 1})
+        engine = RenderEngine()
+        self.assertEqual(engine.render(build_scene(optimized)).buffer, engine.render(build_scene(self.infos)).buffer)
+
+class TestSceneBenchmark(unittest.TestCase):
+    def testCompareImages(self):
+        self.assertEqual(compare_images(bytes([1, 2, 3, 4, 5, 6]), bytes([1, 2, 3, 4, 9, 6])), (1, 4))
+        self.assertEqual(compare_images(bytes(6), bytes(6)), (0, 0))
+
+    def testRegressions(self):
+        case = {"scene": "a", "width": 4, "height": 3, "anti_aliasing": 0, "engine": "RenderEngine",
+                "load_seconds": 0.5, "render_seconds": 1.0}
+        self.assertEqual(compare_with_baseline([{**case, "render_seconds": 1.05}], [case], 0.1), [])
+        self.assertEqual(len(compare_with_baseline([{**case, "render_seconds": 1.2}], [case], 0.1)), 1)
+        self.assertEqual(compare_with_baseline([{**case, "scene": "b", "render_seconds": 9}], [case], 0.1), [])
+
+    def testMissingGolden(self):
+        with tempfile.TemporaryDirectory() as directory:
+            scene = os.path.join(directory, "scene.json")
+            with open(scene, "w") as scene_file:
+                json.dump({
+                    "h_res": 4, "v_res": 3, "square_side": 1, "dist": 20,
+                    "eye": [0, -60, 10], "look_at": [0, 0, 10], "up": [0, 0, 1], "background_color": [10, 20, 30],
+                    "objects": [{"color": [200, 40, 40], "sphere": {"center": [0, 0, 10], "radius": 4}}]}, scene_file)
+            golden = os.path.join(directory, "golden")
+            self.assertEqual(run_case(scene, 4, 3, 0, "scalar", golden)["golden"], "missing")
+            self.assertFalse(os.path.exists(golden))
+            self.assertEqual(run_case(scene, 4, 3, 0, "scalar", golden, update_golden=True)["golden"], "written")
+            self.assertEqual(run_case(scene, 4, 3, 0, "scalar", golden)["golden"],
+                             {"differing_pixels": 0, "largest_difference": 0})
+
+    @unittest.skipIf(VectorizedRenderEngine is None, "NumPy is not installed")
+    def testCountRaysOfPackets(self):
+        scene = make_test_scene()
+        engine = VectorizedRenderEngine()
+        rays = count_rays(engine)
+        self.assertEqual(engine.render(scene).buffer, RenderEngine().render(scene).buffer)
+        self.assertEqual(rays["primary"], scene.width * scene.height)
+        self.assertGreater(rays["secondary"], 0)
+        self.assertGreater(rays["shadow"], 0)
+
+def render_or_die(scene_path: str, *args, **kwargs) -> dict:
+    """render_scene_file killing its process on scenes named crash.json"""
+    if os.path.basename(scene_path) == "crash.json":
+        os._exit(1)
+    return render_scene_file(scene_path, *args, **kwargs)
+
+class TestBatch(unittest.TestCase):
+    def writeScene(self, name: str, width: int, height: int) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as scene_file:
+            json.dump({
+                "h_res": width, "v_res": height, "square_side": 4 / width, "dist": 20,
+                "eye": [0, -60, 10], "look_at": [0, 0, 10], "up": [0, 0, 1], "background_color": [10, 20, 30],
+                "lights": [{"position": [30, -40, 50], "intensity": [255, 255, 255]}],
+                "objects": [{"color": [200, 40, 40], "sphere": {"center": [0, 0, 10], "radius": 4}}]}, scene_file)
+        return path
+
+    def setUp(self) -> None:
+        self.temporary = tempfile.TemporaryDirectory()
+        self.directory = self.temporary.name
+        self.small = self.writeScene("small.json", 4, 3)
+        self.big = self.writeScene("big.json", 8, 6)
+        self.broken = os.path.join(self.directory, "broken.json")
+        with open(self.broken, "w") as scene_file:
+            scene_file.write("{")
+
+    def tearDown(self) -> None:
+        self.temporary.cleanup()
+
+    def testFindScenes(self):
+        manifest = os.path.join(self.directory, "manifest.txt")
+        with open(manifest, "w") as manifest_file:
+            manifest_file.write("# scenes\nsmall.json small.png\nsub/small.json\n")
+        jobs = find_scenes([manifest, self.directory], "out")
+        self.assertEqual(jobs, [
+            (self.small, os.path.join(self.directory, "small.png")),
+            (os.path.join(self.directory, "sub", "small.json"), os.path.join("out", "small.ppm")),
+            (self.big, os.path.join("out", "big.ppm")),
+            (self.broken, os.path.join("out", "broken.ppm"))])
+
+    def testBiggestFirstAndFailuresDontStop(self):
+        jobs = find_scenes([self.directory], os.path.join(self.directory, "out"))
+        results = list(render_batch(jobs))
+        self.assertEqual([result["scene"] for result in results], [self.big, self.small, self.broken])
+        self.assertIn("error", results[2])
+        expected = RenderEngine().render(build_scene(load_from_json(self.big)))
+        with open(results[0]["output"], "rb") as image_file:
+            self.assertEqual(image_file.read(), b"P6 8 6\n255\n" + expected.to_bytes())
+
+    def testDeadWorker(self):
+        crash = self.writeScene("crash.json", 4, 3)
+        self.addCleanup(setattr, batch, "render_scene_file", render_scene_file)
+        batch.render_scene_file = render_or_die
+        jobs = find_scenes([self.big, crash, self.small], os.path.join(self.directory, "out"))
+        results = {result["scene"]: result for result in render_batch(jobs, workers=2)}
+        self.assertEqual(sorted(results), sorted([self.big, crash, self.small]))
+        self.assertIn("BrokenProcessPool", results[crash]["error"])
+        self.assertNotIn("error", results[self.big])
+        self.assertNotIn("error", results[self.small])
+
+    def testWarmPool(self):
+        jobs = find_scenes([self.big, self.small], os.path.join(self.directory, "out"))
+        results = list(render_batch(jobs, workers=2))
+        self.assertEqual(sorted(result["scene"] for result in results), [self.big, self.small])
+        self.assertTrue(all("error" not in result and os.path.exists(result["output"]) for result in results))
+
+class TestRenderService(unittest.IsolatedAsyncioTestCase):
+    scene = {
+        "h_res": 12, "v_res": 9, "square_side": 4 / 12, "dist": 20,
+        "eye": [0, -60, 10], "look_at": [0, 0, 10], "up": [0, 0, 1], "background_color": [10, 20, 30],
+        "lights": [{"position": [30, -40, 50], "intensity": [255, 255, 255]}],
+        "objects": [{"color": [200, 40, 40], "sphere": {"center": [0, 0, 10], "radius": 4}},
+                    {"color": [40, 200, 40], "kr": .8, "plane": {"sample": [0, 0, 0], "normal": [0, 0, 1]}}]}
+
+    async def asyncSetUp(self) -> None:
+        self.service = RenderService(workers=1, tile_size=4)
+        self.server = await self.service.start("127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+        self.service.close()
+
+    async def request(self, method: str, path: str, body: bytes = b"") -> "tuple[int, bytes]":
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        response = await reader.read()
+        writer.close()
+        head, _, content = response.partition(b"\r\n\r\n")
+        if b"chunked" in head:
+            chunks = []
+            while True:
+                size, _, content = content.partition(b"\r\n")
+                if not int(size, 16):
+                    break
+                chunks.append(content[:int(size, 16)])
+                content = content[int(size, 16) + 2:]
+            content = b"".join(chunks)
+        return int(head.split()[1]), content
+
+    async def testRenderAndStreamTiles(self):
+        status, content = await self.request("POST", "/jobs", json.dumps(self.scene).encode())
+        self.assertEqual(status, 202)
+        job_id = json.loads(content)["id"]
+        status, content = await self.request("GET", f"/jobs/{job_id}/tiles")
+        self.assertEqual(status, 200)
+        events = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(events[-1], {"state": "done", "error": None})
+        self.assertEqual(len(events), 10)
+
+        expected = RenderEngine().render(build_scene(scene_infos(self.scene)))
+        pixels = expected.to_bytes()
+        for event in events[:-1]:
+            x_start, y_start, x_end, y_end = event["tile"]
+            rows = b"".join(pixels[(y * 12 + x_start) * 3:(y * 12 + x_end) * 3] for y in range(y_start, y_end))
+            self.assertEqual(base64.b64decode(event["rgb"]), rows)
+        status, content = await self.request("GET", f"/jobs/{job_id}/image?format=ppm")
+        ppm = io.BytesIO()
+        expected.write_ppm_binary(ppm)
+        self.assertEqual((status, content), (200, ppm.getvalue()))
+
+        status, content = await self.request("GET", f"/jobs/{job_id}/tiles?progress=1")
+        self.assertEqual(json.loads(content.splitlines()[-2]), {"done": 9, "total": 9})
+        metrics = json.loads((await self.request("GET", "/metrics"))[1])
+        self.assertEqual((metrics["jobs_done"], metrics["tiles_rendered"], metrics["queue_depth"]), (1, 9, 0))
+        self.assertGreater(metrics["pixels_per_second"], 0)
+
+    async def testPriorityAndCancel(self):
+        low = self.service.submit(self.scene)
+        cancelled = self.service.submit(self.scene)
+        high = self.service.submit(self.scene, priority=5)
+        self.assertEqual(self.service.metrics()["queue_depth"], 25)
+        status, _ = await self.request("DELETE", f"/jobs/{cancelled.id}")
+        self.assertEqual((status, cancelled.state), (200, "cancelled"))
+        self.assertFalse(os.path.exists(cancelled.scene_path))
+
+        await self.service.wait(high)
+        self.assertLess(len(low.events), len(low.tiles))
+        await self.service.wait(low)
+        self.assertEqual((low.state, high.state), ("done", "done"))
+        self.assertEqual(low.image.buffer, high.image.buffer)
+        self.assertEqual(self.service.metrics()["jobs_cancelled"], 1)
+        self.assertEqual((await self.request("GET", f"/jobs/{cancelled.id}/image"))[0], 409)
+
+    async def testErrors(self):
+        self.assertEqual((await self.request("POST", "/jobs", b"{"))[0], 400)
+        self.assertEqual((await self.request("POST", "/jobs", b'{"h_res": 4}'))[0], 400)
+        self.assertEqual((await self.request("GET", "/jobs/missing"))[0], 404)
+        broken = dict(self.scene, objects=[{"color": [1, 2, 3], "sphere": {}}])
+        job = self.service.submit(broken)
+        await self.service.wait(job)
+        self.assertEqual(job.state, "failed")
+        self.assertIn("KeyError", job.error)
+
+    async def testDeadPoolProcess(self):
+        job = self.service.submit(self.scene)
+        for process in list(self.service._executor._processes.values()):
+            process.kill()
+        await self.service.wait(job)
+        self.assertEqual(job.state, "done")
+        self.assertEqual(job.image.buffer, RenderEngine().render(build_scene(scene_infos(self.scene))).buffer)
+        self.assertEqual(self.service.metrics()["pool_restarts"], 1)
+        status, _ = await self.request("POST", "/jobs", json.dumps(self.scene).encode())
+        self.assertEqual(status, 202)
+
+class TestImage(unittest.TestCase):
+    def setUp(self) -> None:
+        self.image = Image(3, 2)
+        self.image.set_pixel(0, 0, Color(1, 0, 0))
+        self.image.set_pixel(2, 1, Color(2, 1, .5))
+        self.image.set_tile((1, 0, 3, 1), [Color(0, .5, 0), Color(0, 0, 1)])
+
+    def testPixels(self):
+        self.assertEqual(self.image.get_pixel(2, 1), Color(2, 1, .5))
+        self.assertEqual(self.image.get_pixel(1, 0), Color(0, .5, 0))
+        self.assertEqual(self.image.get_pixel(0, 1), Color())
+
+    def testBytesMatchToRGB(self):
+        expected = [int(value) for row in self.image.pixels for color in row for value in color.to_RGB()]
+        self.assertEqual(list(self.image.to_bytes()), expected)
+
+    def testBinaryFormats(self):
+        ppm = io.BytesIO()
+        self.image.write_ppm_binary(ppm)
+        self.assertEqual(ppm.getvalue(), b"P6 3 2\n255\n" + self.image.to_bytes())
+        png = io.BytesIO()
+        self.image.write_png(png)
+        data = png.getvalue()
+        self.assertTrue(data.startswith(b"\x89PNG\r\n\x1a\n"))
+        idat = data.index(b"IDAT")
+        length = int.from_bytes(data[idat - 4:idat], "big")
+        scanlines = zlib.decompress(data[idat + 4:idat + 4 + length])
+        self.assertEqual(scanlines, b"\x00" + self.image.to_bytes()[:9] + b"\x00" + self.image.to_bytes()[9:])
+
+def make_test_scene() -> Scene:
+    objects = [
+        Plane(Point(0, -20, 0), Vector3(0, 1, 0), Material(Color(.2, .8, .2))),
+        Sphere(Point(0, 0, 0), 15, Material(Color(.9, .1, .1), transmission=.5, refraction=1.3)),
+        Sphere(Point(25, 5, -10), 10, Material(Color(.1, .1, .9))),
+        Triangle(Point(-40, -20, -30), Point(-10, -20, -30), Point(-25, 20, -30), Material(Color(.8, .8, .1))),
+    ]
+    camera = Camera(12, 17, 4, 60, Point(0, 10, 100), Point(0, 0, 0))
+    return Scene(camera, objects, [Light(Point(50, 80, 60)), Light(Point(-60, 40, 80))], max_depth=3)
+
+class RenderTestCase(unittest.TestCase):
+    def assertSameImage(self, image, other):
+        self.assertEqual((image.width, image.height), (other.width, other.height))
+        self.assertEqual(image.buffer, other.buffer)
+
+class TestCompiledScene(RenderTestCase):
+    def setUp(self) -> None:
+        rng = Random(5)
+        material = Material()
+        objects = [Plane(Point(0, -60, 0), Vector3(0, 1, 0), Material(Color(.2, .8, .2)))]
+        for _ in range(20):
+            center = Point(rng.uniform(-50, 50), rng.uniform(-50, 50), rng.uniform(-50, 50))
+            objects.append(Sphere(center, rng.uniform(1, 8), material))
+            objects.append(Triangle(
+                center, center + Vector3(rng.uniform(1, 9), 0, 0),
+                center + Vector3(0, rng.uniform(1, 9), rng.uniform(-3, 3)), material))
+        control_points = [Point(0, 0, 0), Point(20, 0, 10), Point(5, 0, 30), Point(12, 0, 40)]
+        surface = RevolutionSurface(control_points, 8, Point(0, 0, 0), Vector3(0, 0, 1), Material(Color(.9, .1, .1)))
+        objects += [surface, surface.triangle_mesh, Instance(surface.triangle_mesh).translate(Vector3(30, 0, -20))]
+        camera = Camera(12, 16, 6, 60, Point(0, 10, 150), Point(0, 0, 0))
+        self.scene = Scene(camera, objects, [Light(Point(50, 80, 60))], max_depth=2)
+        self.compiled = self.scene.compile()
+        self.rays = [
+            Ray(Point(rng.uniform(-60, 60), rng.uniform(-60, 60), 100), Vector3(rng.uniform(-.5, .5), rng.uniform(-.5, .5), -1))
+            for _ in range(300)]
+
+    def testSameHits(self):
+        blocked = 0
+        for ray in self.rays:
+            self.assertEqual(self.compiled.find_nearest(ray), self.scene.find_nearest(ray))
+            for max_distance in (40, 120):
+                occluder = self.compiled.occluder(ray, max_distance)
+                self.assertEqual(occluder is not None, self.scene.occluder(ray, max_distance) is not None)
+                if occluder is not None:
+                    blocked += 1
+                    self.assertTrue(occluder.occluded(ray, max_distance))
+                    others = [obj for obj in self.scene.objects if obj is not occluder and obj.occluded(ray, max_distance)]
+                    self.assertEqual(self.compiled.occluder(ray, max_distance, skip=occluder) is not None, bool(others))
+        self.assertGreater(blocked, 0)
+
+    def testRenderAndPickle(self):
+        expected = RenderEngine().render(self.scene)
+        self.assertSameImage(RenderEngine().render(self.compiled), expected)
+        self.assertSameImage(RenderEngine().render(pickle.loads(pickle.dumps(self.compiled))), expected)
+
+class TestRender(RenderTestCase):
+    def setUp(self) -> None:
+        self.scene = make_test_scene()
+        self.engine = RenderEngine()
+
+    def testParallelMatchesSerial(self):
+        serial = self.engine.render(self.scene, tile_size=5)
+        self.assertSameImage(self.engine.render(self.scene, workers=2, tile_size=5), serial)
+
+    def testStreamedScanlines(self):
+        image = self.engine.render(self.scene)
+        expected = io.BytesIO()
+        image.write_ppm_binary(expected)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "stream.ppm")
+            with PPMStreamWriter(path, self.scene.width, self.scene.height) as writer:
+                for tile, colors in self.engine.render_iter(self.scene, tile_size=(self.scene.width, 1)):
+                    self.assertEqual(tile[3] - tile[1], 1)
+                    writer.write_tile(tile, colors)
+            with open(path, "rb") as streamed:
+                self.assertEqual(streamed.read(), expected.getvalue())
+
+    def testAntiAliasingIsReproducible(self):
+        serial = self.engine.render(self.scene, anti_aliasing=2, tile_size=8, seed=3)
+        self.assertSameImage(self.engine.render(self.scene, anti_aliasing=2, workers=2, tile_size=8, seed=3), serial)
+
+    def testPruning(self):
+        expected = self.engine.render(self.scene)
+        self.assertSameImage(RenderEngine(min_weight=RenderEngine.PRUNE_WEIGHT).render(self.scene), expected)
+        engine = RenderEngine(min_weight=.2)
+        pruned = engine.render(self.scene, tile_size=5)
+        self.assertGreater(engine.pruned_rays, 0)
+        self.assertNotEqual(pruned.buffer, expected.buffer)
+        parallel = RenderEngine(min_weight=.2)
+        self.assertSameImage(parallel.render(self.scene, workers=2, tile_size=5), pruned)
+        self.assertEqual(parallel.pruned_rays, engine.pruned_rays)
+
+    def testRussianRouletteIsReproducible(self):
+        engine = RenderEngine(min_weight=.2, russian_roulette=True)
+        serial = engine.render(self.scene, tile_size=5)
+        self.assertGreater(engine.pruned_rays, 0)
+        self.assertSameImage(RenderEngine(min_weight=.2, russian_roulette=True).render(self.scene, workers=2, tile_size=5), serial)
+
+    def testDeepPathsDontRecurse(self):
+        mirror = Material(Color(.5, .5, .5), reflection=1, refraction=0)
+        objects = [Plane(Point(0, 0, -10), Vector3(0, 0, 1), mirror), Plane(Point(0, 0, 10), Vector3(0, 0, -1), mirror)]
+        scene = Scene(Camera(1, 1, 1, 1, Point(0, 0, 0), Point(0, 0, -1)), objects, [Light(Point(0, 0, 0))], max_depth=3000)
+        engine = RenderEngine()
+        depths = []
+        trace_ray = engine.trace_ray
+        engine.trace_ray = lambda ray, scene, depth=0: depths.append(depth) or trace_ray(ray, scene, depth)
+        engine.rayTrace(Ray(Point(0, 0, 0), Vector3(0, .01, -1)), scene)
+        self.assertEqual(depths, list(range(3001)))
+
+class TestDistributedRender(RenderTestCase):
+    authkey = b"test"
+
+    def setUp(self) -> None:
+        self.scene = make_test_scene()
+        self.coordinator = Coordinator(authkey=self.authkey, engine=RenderEngine(), dead_after=60)
+        self.processes = []
+        self.release = threading.Event()
+
+    def tearDown(self) -> None:
+        self.release.set()
+        self.coordinator.close()
+        for process in self.processes:
+            process.join(10)
+
+    def startWorkers(self, count: int) -> None:
+        for index in range(count):
+            process = multiprocessing.Process(target=run_worker, args=(self.coordinator.address, self.authkey, f"worker{index}"))
+            process.start()
+            self.processes.append(process)
+
+    def fakeWorker(self, hang: bool) -> None:
+        """Takes two tiles and disconnects, or keeps them without answering until the test ends"""
+        connection = Client(self.coordinator.address, authkey=self.authkey)
+        connection.send(("hello", "fake"))
+
+        def take_tiles():
+            tiles = 0
+            while tiles < 2:
+                tiles += connection.recv()[0] == "tile"
+            if hang:
+                self.release.wait()
+            connection.close()
+        threading.Thread(target=take_tiles, daemon=True).start()
+
+    def testMatchesLocalRender(self):
+        self.startWorkers(3)
+        self.assertTrue(self.coordinator.wait_for_workers(3, 30))
+        self.assertSameImage(self.coordinator.render(self.scene, tile_size=4, timeout=60), RenderEngine().render(self.scene))
+        self.assertGreater(len(self.coordinator.last_stats["tiles_by_worker"]), 1)
+        # The workers stay connected for the next render, which ships them the new settings
+        self.assertSameImage(self.coordinator.render(self.scene, 2, 3, tile_size=8, timeout=60),
+                             RenderEngine().render(self.scene, anti_aliasing=2, seed=3, tile_size=8))
+
+    def testDeadWorkerTilesAreReassigned(self):
+        # Only reassigned, not rendered again because the worker is late
+        self.coordinator.straggler_factor = float("inf")
+        # Forked after the fake connects, the workers would keep its connection open
+        self.startWorkers(2)
+        self.fakeWorker(hang=False)
+        self.assertTrue(self.coordinator.wait_for_workers(3, 30))
+        self.assertSameImage(self.coordinator.render(self.scene, tile_size=4, timeout=60), RenderEngine().render(self.scene))
+        self.assertGreaterEqual(self.coordinator.last_stats["reassigned"], 2)
+        self.assertNotIn("fake", self.coordinator.last_stats["tiles_by_worker"])
+
+    def testSlowWorkerTilesAreDuplicated(self):
+        # Forked after the fake connects, the workers would keep its connection open
+        self.startWorkers(2)
+        self.fakeWorker(hang=True)
+        self.assertTrue(self.coordinator.wait_for_workers(3, 30))
+        self.assertSameImage(self.coordinator.render(self.scene, tile_size=4, timeout=60), RenderEngine().render(self.scene))
+        self.assertGreaterEqual(self.coordinator.last_stats["duplicated"], 2)
+        self.assertGreater(self.coordinator.last_stats["steals"], 0)
+
+class TestAnimation(RenderTestCase):
+    def setUp(self) -> None:
+        self.scene = make_test_scene()
+        self.engine = RenderEngine()
+
+    def testInterpolateCameras(self):
+        cameras = interpolate_cameras(self.scene.camera, [
+            {"frame": 1, "eye": [0, 10, 100]}, {"frame": 3, "eye": [20, 10, 60], "look_at": [10, 0, 0]}], 5)
+        self.assertEqual([tuple(camera.eye) for camera in cameras],
+                         [(0, 10, 100), (0, 10, 100), (10, 10, 80), (20, 10, 60), (20, 10, 60)])
+        self.assertEqual(tuple(cameras[2].look_at), (5, 0, 0))
+        self.assertEqual(tuple(cameras[2].up), tuple(self.scene.camera.up))
+
+    def testFramesShareTheScene(self):
+        cameras = turntable(self.scene.camera, 3)
+        frames = dict(render_animation(self.scene, cameras, self.engine))
+        self.assertSameImage(frames[0], self.engine.render(self.scene))
+        moved = self.scene.with_camera(cameras[1])
+        self.assertIs(moved.bvh, self.scene.bvh)
+        self.assertIs(moved.objects, self.scene.objects)
+        fresh = make_test_scene()
+        fresh.camera = cameras[1]
+        self.assertSameImage(frames[1], self.engine.render(fresh))
+        self.assertSameImage(dict(render_animation(self.scene, cameras, self.engine, workers=2))[2], frames[2])
+
+    @unittest.skipIf(VectorizedRenderEngine is None, "NumPy is not installed")
+    def testFramesSharePacketScene(self):
+        import vectorized_engine
+        builds = []
+
+        class CountingPacketScene(vectorized_engine.PacketScene):
+            def __init__(self, scene: Scene) -> None:
+                builds.append(scene)
+                super().__init__(scene)
+        self.addCleanup(setattr, vectorized_engine, "PacketScene", vectorized_engine.PacketScene)
+        vectorized_engine.PacketScene = CountingPacketScene
+        engine = VectorizedRenderEngine()
+        frames = dict(render_animation(self.scene, turntable(self.scene.camera, 4), engine))
+        self.assertEqual(len(builds), 1)
+        self.assertSameImage(frames[0], self.engine.render(self.scene))
+
+class TestGBuffer(RenderTestCase):
+    def setUp(self) -> None:
+        self.scene = make_test_scene()
+        self.engine = RenderEngine()
+        self.gbuffer, self.image = GBuffer.capture(self.scene)
+
+    def testCaptureMatchesRender(self):
+        self.assertSameImage(self.image, self.engine.render(self.scene))
+
+    def testReshade(self):
+        self.scene.lights[0].color = Color(.2, .9, .4)
+        self.assertSameImage(self.gbuffer.reshade(self.scene), self.engine.render(self.scene))
+        self.assertEqual(self.gbuffer.rays["shadow"], 0)
+        self.scene.lights[1].position = Point(-50, 40, 90)
+        self.assertSameImage(self.gbuffer.reshade(self.scene), self.engine.render(self.scene))
+        self.assertEqual(self.gbuffer.rays["shadow"], sum(index >= 0 for index in self.gbuffer.objects))
+        self.scene.objects[1].material.diffuse = .3
+        self.scene.objects[1].material.refraction = 1.1
+        self.scene.objects[2].material.reflection = 0
+        self.assertSameImage(self.gbuffer.reshade(self.scene), self.engine.render(self.scene))
+        self.assertEqual(self.gbuffer.rays["shadow"], 0)
+        self.gbuffer.reshade(self.scene)
+        self.assertEqual(self.gbuffer.rays, {"shadow": 0, "secondary": 0})
+
+    def testSaveAndLoad(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "scene.rtgb")
+            self.gbuffer.save(path)
+            loaded = GBuffer.load(path)
+        self.assertEqual(loaded.secondary_objects, self.gbuffer.secondary_objects)
+        self.scene.objects[0].material.specular = .2
+        self.assertSameImage(loaded.reshade(self.scene), self.engine.render(self.scene))
+        self.scene.camera = turntable(self.scene.camera, 4)[1]
+        self.assertRaises(ValueError, loaded.reshade, self.scene)
+
+class TestIncrementalRender(RenderTestCase):
+    def setUp(self) -> None:
+        self.scene = make_test_scene()
+        self.engine = RenderEngine()
+        self.renderer = IncrementalRenderer(tile_size=4)
+        self.renderer.render(self.scene)
+        self.tiles = self.engine.split_tiles(self.scene.width, self.scene.height, 4)
+
+    def testMayReach(self):
+        # Rays from the origin going along x, up to a distance of 10
+        bundle = [0, 0, 0, 0, 0, 0, 1, 0, 0, 1, 0, 0, 10]
+        self.assertTrue(may_reach(bundle, (5, -1, -1, 6, 1, 1)))
+        self.assertFalse(may_reach(bundle, (11, -1, -1, 12, 1, 1)))
+        self.assertFalse(may_reach(bundle, (-6, -1, -1, -5, 1, 1)))
+        self.assertFalse(may_reach(bundle, (5, 2, -1, 6, 3, 1)))
+
+    def testEdits(self):
+        self.scene.objects[2].center = Point(20, 8, -10)
+        self.scene.build_bvh()
+        self.assertSameImage(self.renderer.render(self.scene), self.engine.render(self.scene))
+        self.assertLess(len(self.renderer.rendered_tiles), len(self.tiles))
+        self.scene.objects[3].material.diffuse = .2
+        self.assertSameImage(self.renderer.render(self.scene), self.engine.render(self.scene))
+        self.assertLess(len(self.renderer.rendered_tiles), len(self.tiles))
+        self.scene.lights[0].color = Color(.5, .5, 1)
+        self.assertSameImage(self.renderer.render(self.scene), self.engine.render(self.scene))
+        self.renderer.render(self.scene)
+        self.assertEqual(self.renderer.rendered_tiles, [])
+
+    def testScalarEngineOnly(self):
+        self.assertRaises(ValueError, IncrementalRenderer, InstrumentedRenderEngine())
+        if VectorizedRenderEngine is not None:
+            self.assertRaises(ValueError, IncrementalRenderer, VectorizedRenderEngine())
+
+    def testGlobalEdits(self):
+        self.scene.ambient_color = Color(.5, .5, .5)
+        self.assertSameImage(self.renderer.render(self.scene), self.engine.render(self.scene))
+        self.assertEqual(self.renderer.rendered_tiles, self.tiles)
+        self.scene.objects[0].point = Point(0, -25, 0)
+        self.assertSameImage(self.renderer.render(self.scene), self.engine.render(self.scene))
+        self.assertEqual(self.renderer.rendered_tiles, self.tiles)
+
+class TestRenderCache(RenderTestCase):
+    def setUp(self) -> None:
+        self.temporary = tempfile.TemporaryDirectory()
+        path = os.path.join(self.temporary.name, "scene.json")
+        with open(path, "w") as scene_file:
+            json.dump({
+                "h_res": 12, "v_res": 9, "square_side": .4, "dist": 20,
+                "eye": [0, -60, 10], "look_at": [0, 0, 10], "up": [0, 0, 1], "background_color": [10, 20, 30],
+                "lights": [{"position": [30, -40, 50], "intensity": [255, 255, 255]}],
+                "objects": [{"color": [200, 40, 40], "sphere": {"center": [0, 0, 10], "radius": 4}}]}, scene_file)
+        self.infos = load_from_json(path)
+        self.engine = RenderEngine()
+        self.cache = RenderCache(os.path.join(self.temporary.name, "cache"))
+
+    def tearDown(self) -> None:
+        self.temporary.cleanup()
+
+    def testHitsMatchRender(self):
+        expected = self.engine.render(build_scene(self.infos), anti_aliasing=2, tile_size=4, seed=1)
+        self.assertSameImage(self.cache.render(self.engine, self.infos, 2, 1, tile_size=4), expected)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 9))
+        self.assertSameImage(self.cache.render(self.engine, self.infos, 2, 1, tile_size=4), expected)
+        self.assertEqual((self.cache.hits, self.cache.misses), (9, 0))
+        # Other samples or scenes are other tiles
+        self.cache.render(self.engine, self.infos, 3, 1, tile_size=4)
+        self.assertEqual(self.cache.misses, 9)
+        self.infos["bg_color"] = [0, 0, 0]
+        self.cache.render(self.engine, self.infos, 2, 1, tile_size=4)
+        self.assertEqual(self.cache.misses, 9)
+
+    def testCrop(self):
+        full = self.cache.render(self.engine, self.infos, tile_size=4)
+        crop = self.cache.render(self.engine, self.infos, tile_size=4, crop=(3, 2, 10, 7))
+        self.assertEqual((self.cache.hits, self.cache.misses), (6, 0))
+        self.assertEqual((crop.width, crop.height), (7, 5))
+        for y in range(5):
+            for x in range(7):
+                self.assertEqual(crop.get_pixel(x, y), full.get_pixel(x + 3, y + 2))
+        self.assertRaises(ValueError, self.cache.render, self.engine, self.infos, crop=(0, 0, 13, 9))
+
+    def testEviction(self):
+        tile_bytes = 4 * 4 * 3 * 8
+        cache = RenderCache(self.cache.directory, tile_bytes * 4)
+        cache.render(self.engine, self.infos, tile_size=4)
+        files = [os.path.join(root, name) for root, _, names in os.walk(cache.directory) for name in names]
+        self.assertLessEqual(sum(os.path.getsize(path) for path in files), tile_bytes * 4)
+        cache.render(self.engine, self.infos, tile_size=4)
+        self.assertGreater(cache.misses, 0)
+
+class TestAdaptiveSampler(RenderTestCase):
+    def setUp(self) -> None:
+        self.scene = make_test_scene()
+
+    def testHalton(self):
+        self.assertEqual([halton(i, 2) for i in range(4)], [0, 0.5, 0.25, 0.75])
+        self.assertAlmostEqual(halton(5, 3), 7 / 9)
+
+    def testFlatPixelsStopEarly(self):
+        engine = RenderEngine(AdaptiveSampler(initial_samples=2))
+        rays = []
+        trace_points = engine.trace_points
+        engine.trace_points = lambda scene, xs, ys: rays.append(len(xs)) or trace_points(scene, xs, ys)
+        self.scene.objects = []
+        image = engine.render(self.scene, anti_aliasing=8)
+        self.assertEqual(sum(rays), 2 * self.scene.width * self.scene.height)
+        self.assertEqual(image.get_pixel(0, 0), self.scene.bg_color)
+
+    def testParallelMatchesSerial(self):
+        engine = RenderEngine(AdaptiveSampler())
+        serial = engine.render(self.scene, anti_aliasing=8, tile_size=8, seed=2)
+        self.assertSameImage(engine.render(self.scene, anti_aliasing=8, workers=2, tile_size=8, seed=2), serial)
+
+class TestInstrumentedRender(RenderTestCase):
+    def setUp(self) -> None:
+        self.scene = make_test_scene()
+
+    def testMatchesRenderEngine(self):
+        engine = InstrumentedRenderEngine()
+        self.assertSameImage(engine.render(self.scene, workers=2), RenderEngine().render(self.scene))
+        stats = engine.stats
+        pixels = self.scene.width * self.scene.height
+        self.assertEqual(stats.rays["primary"], pixels)
+        self.assertEqual(stats.depths[0], pixels)
+        self.assertEqual(stats.depths[1], stats.rays["secondary"] - sum(
+            count for depth, count in stats.depths.items() if depth > 1))
+        self.assertEqual(sum(stats.intersection_tests.values()), sum(stats.pixel_costs))
+        self.assertEqual({"render", "trace", "shade", "shadow"}, set(stats.phases))
+        # Objects get their own methods back after rendering
+        self.assertTrue(all("intersects" not in vars(obj) for obj in self.scene.objects))
+
+    def testHeatmap(self):
+        engine = InstrumentedRenderEngine()
+        engine.render(self.scene)
+        heatmap = engine.heatmap()
+        self.assertEqual((heatmap.width, heatmap.height), (self.scene.width, self.scene.height))
+        self.assertEqual(max(heatmap.buffer), 1)
+
+class TestCheckpoint(RenderTestCase):
+    def setUp(self) -> None:
+        self.scene = make_test_scene()
+        self.engine = RenderEngine()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "render.checkpoint")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def open(self, resume=False, fingerprint=b"scene"):
+        return RenderCheckpoint(self.path, self.scene.width, self.scene.height, fingerprint, resume=resume)
+
+    def testMatchesRender(self):
+        expected = self.engine.render(self.scene, anti_aliasing=2, tile_size=8)
+        with self.open() as checkpoint:
+            self.assertSameImage(self.engine.render(self.scene, anti_aliasing=2, tile_size=8, checkpoint=checkpoint), expected)
+
+    def testResumeInterrupted(self):
+        expected = self.engine.render(self.scene, anti_aliasing=2, tile_size=8)
+        with self.open() as checkpoint:
+            for tile, colors in self.engine.render_iter(self.scene, 2, tile_size=8):
+                checkpoint.add_tile(tile, colors, 2)
+                break
+        with self.open(resume=True) as checkpoint:
+            self.assertEqual(checkpoint.tile_samples(tile), 2)
+            self.assertSameImage(self.engine.render(self.scene, anti_aliasing=2, tile_size=8, checkpoint=checkpoint), expected)
+
+    def testNoSampler(self):
+        with self.open() as checkpoint:
+            self.assertRaises(ValueError, RenderEngine(AdaptiveSampler()).render, self.scene, anti_aliasing=4, checkpoint=checkpoint)
+
+    def testResumeAddsSamples(self):
+        with self.open() as checkpoint:
+            self.engine.render(self.scene, anti_aliasing=1, checkpoint=checkpoint)
+        with self.open(resume=True) as checkpoint:
+            self.engine.render(self.scene, anti_aliasing=3, checkpoint=checkpoint)
+            self.assertEqual(min(checkpoint.counts), 3)
+            self.assertEqual(max(checkpoint.counts), 3)
+
+    def testRejectsOtherRender(self):
+        self.open().close()
+        with self.assertRaises(ValueError):
+            self.open(resume=True, fingerprint=b"other scene")
+
+@unittest.skipIf(VectorizedRenderEngine is None, "NumPy is not installed")
+class TestVectorizedRender(RenderTestCase):
+    def setUp(self) -> None:
+        self.scene = make_test_scene()
+
+    def testMatchesScalarEngine(self):
+        expected = RenderEngine().render(self.scene)
+        self.assertSameImage(VectorizedRenderEngine().render(self.scene), expected)
+
+    def testMatchesScalarAntiAliasing(self):
+        expected = RenderEngine().render(self.scene, anti_aliasing=3, tile_size=8, seed=1)
+        self.assertSameImage(VectorizedRenderEngine().render(self.scene, anti_aliasing=3, tile_size=8, seed=1), expected)
+
+    def testMatchesScalarPruning(self):
+        scalar = RenderEngine(min_weight=.2)
+        expected = scalar.render(self.scene)
+        engine = VectorizedRenderEngine(min_weight=.2)
+        self.assertSameImage(engine.render(self.scene), expected)
+        self.assertEqual(engine.pruned_rays, scalar.pruned_rays)
+
+    def testInstances(self):
+        sphere = Sphere(Point(0, 0, 0), 4, Material(Color(.8, .3, .1), reflection=.5))
+        self.scene.objects += [Instance(sphere).translate(Vector3(-30 + 6 * i, 20, -5)) for i in range(12)]
+        self.scene.objects.append(Instance(self.scene.objects[0]).translate(Vector3(0, -5, 0)))
+        self.scene.build_bvh()
+        self.assertSameImage(VectorizedRenderEngine().render(self.scene), RenderEngine().render(self.scene))
+
+    def testOccludedMatchesScalar(self):
+        import numpy as np
+        rng = Random(3)
+        engine = VectorizedRenderEngine()
+        origins = [Point(rng.uniform(-40, 40), rng.uniform(-10, 40), rng.uniform(-40, 40)) for _ in range(200)]
+        targets = [Point(rng.uniform(-40, 40), rng.uniform(-10, 40), rng.uniform(-40, 40)) for _ in range(200)]
+        rays = [Ray(origin, target - origin) for origin, target in zip(origins, targets)]
+        distances = [ray.direction ^ (target - ray.origin) for ray, target in zip(rays, targets)]
+        with np.errstate(all='ignore'):
+            blocked = engine.occluded_packet(
+                engine.packet_scene(self.scene), np.array([tuple(ray.origin) for ray in rays]),
+                np.array([tuple(ray.direction) for ray in rays]), np.array(distances))
+        expected = [RenderEngine().occluded(ray, self.scene, distance) for ray, distance in zip(rays, distances)]
+        self.assertEqual(blocked.tolist(), expected)
+        self.assertTrue(any(expected) and not all(expected))
+
+    def testEditsAfterBuildBVH(self):
+        engine = VectorizedRenderEngine()
+        engine.render(self.scene)
+        self.scene.objects[2].center = Point(20, 8, -10)
+        self.scene.objects[3].material.diffuse = .2
+        self.scene.build_bvh()
+        self.assertSameImage(engine.render(self.scene), RenderEngine().render(self.scene))
+
 if __name__ == '__main__':
     unittest.main()
     
\ No newline at end of file
@@ -1 +1,5 @@
-from .load import *
\ No newline at end of file
+from .load import *
+from .checkpoint import RenderCheckpoint
+from .binary_scene import write_binary_scene, load_from_binary, load_scene_infos, load_obj, read_settings
+from .optimize import optimize_scene
+from .render_cache import RenderCache, scene_digest, engine_version
@@ -0,0 +1,235 @@
+"""Compact binary scene format
+
+Layout, little endian, every section starts aligned to 8 bytes:
+- header: magic, version, real typecode ('f' or 'd'), size of the settings and length of each other section
+- settings: camera, lights and the rest of the scene information as JSON, with no objects
+- materials: MATERIAL_FIELDS doubles per material, each distinct material is stored once
+- objects: one OBJECT record per object, in scene order
+- reals: every coordinate of every object, packed as float32 when it represents them exactly, float64 otherwise
+- indices: uint32 vertex indices of the meshes, starting at 0
+- mesh data: the face data (TriangleMesh.FACE_STRIDE doubles per face) and BVH node bounds of every mesh
+- links and primitives: the rest of the BVH of every mesh, as returned by BVH.to_arrays
+
+Meshes are stored with everything TriangleMesh computes when it is built, so big meshes load
+without recomputing their faces or rebuilding their trees. The sections are parsed through memoryviews
+of the memory mapped file, but the objects copy what they use into their own arrays, points and BVH nodes:
+loading saves the parsing and building, not the memory, and the file is unmapped once the scene is built
+so scenes can still be pickled to worker processes.
+"""
+from __future__ import annotations
+from components import Color, Material, Point, Vector3, Sphere, Plane, Triangle, TriangleMesh, BVH
+from array import array
+from .load import load_from_json, identify_object, material_options
+import argparse
+import json
+import mmap
+import struct
+
+MAGIC = b"RTSC"
+VERSION = 1
+# magic, version, real typecode, then the sizes of settings (bytes), materials, objects, reals,
+# indices, mesh data, links and primitives (items)
+HEADER = struct.Struct("<4sHcxIIIIIIII")
+# kind, material, first real and number of reals, first index and number of indices,
+# first mesh data double, first link and number of BVH nodes, first primitive
+OBJECT = struct.Struct("<B3xIIIIIIIII")
+# r, g, b (0 to 255), ambient, diffuse, specular, reflection, phong, transmission, refraction
+MATERIAL_FIELDS = 10
+BOUNDS_FIELDS = 6
+LINK_FIELDS = 5
+
+SPHERE, PLANE, TRIANGLE, TRIANGLE_MESH = range(4)
+
+
+def _aligned(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+def write_binary_scene(infos: dict, path: str, typecode: "str | None" = None) -> None:
+    """Writes a scene, as returned by load_from_json, on the binary format
+    typecode chooses the precision of the coordinates, by default float32 if it doesn't lose precision
+    """
+    materials: dict[tuple, int] = {}
+    records = []
+    reals = []
+    indices = array("I")
+    mesh_data = array("d")
+    links = array("i")
+    primitives = array("I")
+    for object_opt in infos["objects"]:
+        material = material_options(object_opt)
+        material_index = materials.setdefault(material, len(materials))
+        first_real = len(reals)
+        first_index = len(indices)
+        first_data = len(mesh_data)
+        first_link = len(links)
+        first_primitive = len(primitives)
+        node_count = 0
+        if "sphere" in object_opt:
+            kind = SPHERE
+            reals.extend(object_opt["sphere"]["center"])
+            reals.append(object_opt["sphere"]["radius"])
+        elif "plane" in object_opt:
+            kind = PLANE
+            reals.extend(object_opt["plane"]["sample"])
+            reals.extend(object_opt["plane"]["normal"])
+        elif "triangle" in object_opt:
+            kind = TRIANGLE
+            for vertex in object_opt["triangle"]:
+                reals.extend(vertex)
+        elif "triangle_mesh" in object_opt:
+            kind = TRIANGLE_MESH
+            for vertex in object_opt["triangle_mesh"]["verteces"]:
+                reals.extend(vertex)
+            for triangle in object_opt["triangle_mesh"]["triangle_indexes"]:
+                indices.extend(index - 1 for index in triangle)
+            mesh = identify_object(object_opt)
+            bounds, mesh_links, mesh_primitives = mesh.bvh.to_arrays()
+            node_count = len(mesh.bvh.nodes)
+            mesh_data.extend(mesh.face_data)
+            mesh_data.extend(bounds)
+            links.extend(mesh_links)
+            primitives.extend(mesh_primitives)
+        else:
+            raise ValueError(f"Unknown object: {object_opt}")
+        records.append(OBJECT.pack(
+            kind, material_index, first_real, len(reals) - first_real, first_index, len(indices) - first_index,
+            first_data, first_link, node_count, first_primitive))
+
+    reals = [float(real) for real in reals]
+    if typecode is None:
+        typecode = "f" if array("f", reals).tolist() == reals else "d"
+    reals = array(typecode, reals)
+
+    settings = json.dumps({key: value for key, value in infos.items() if key != "objects"}).encode()
+    material_table = array("d", [value for material in materials for value in material])
+    sections = [settings, material_table, b"".join(records), reals, indices, mesh_data, links, primitives]
+
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(
+            MAGIC, VERSION, typecode.encode(), len(settings), len(materials), len(records),
+            len(reals), len(indices), len(mesh_data), len(links), len(primitives)))
+        for section in sections:
+            file.write(bytes(_aligned(file.tell()) - file.tell()))
+            file.write(section if isinstance(section, bytes) else section.tobytes())
+
+
+def load_from_binary(file_path: str) -> dict:
+    """Loads a binary scene, returns the same dictionary of load_from_json
+    but with the objects already built, objects with the same material share it
+    """
+    with open(file_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        magic, version, typecode, settings_size, material_count, object_count, real_count, index_count, \
+            data_count, link_count, primitive_count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{file_path} is not a binary scene")
+        typecode = typecode.decode()
+
+        offset = HEADER.size
+        sections = []
+        for count, format in (
+                (settings_size, "B"), (material_count * MATERIAL_FIELDS, "d"), (object_count * OBJECT.size, "B"),
+                (real_count, typecode), (index_count, "I"), (data_count, "d"), (link_count, "i"), (primitive_count, "I")):
+            offset = _aligned(offset)
+            size = count * struct.calcsize(format)
+            sections.append(view[offset:offset + size].cast(format))
+            offset += size
+        settings, material_table, records, reals, indices, mesh_data, links, primitives = sections
+
+        infos = json.loads(bytes(settings))
+        materials = []
+        for first in range(0, len(material_table), MATERIAL_FIELDS):
+            r, g, b, *coefficients = material_table[first:first + MATERIAL_FIELDS]
+            materials.append(Material(Color.from_RGB(r, g, b), *coefficients))
+
+        objects = []
+        for kind, material_index, first_real, real_count, first_index, index_count, \
+                first_data, first_link, node_count, first_primitive in OBJECT.iter_unpack(records):
+            values = reals[first_real:first_real + real_count].tolist()
+            material = materials[material_index]
+            if kind == SPHERE:
+                objects.append(Sphere(Point(*values[:3]), values[3], material))
+            elif kind == PLANE:
+                objects.append(Plane(Point(*values[:3]), Vector3(*values[3:]), material))
+            elif kind == TRIANGLE:
+                objects.append(Triangle(Point(*values[:3]), Point(*values[3:6]), Point(*values[6:]), material))
+            elif kind == TRIANGLE_MESH:
+                vertices = [Point(*values[i:i + 3]) for i in range(0, len(values), 3)]
+                mesh_indices = indices[first_index:first_index + index_count].tolist()
+                triangles = list(zip(mesh_indices[0::3], mesh_indices[1::3], mesh_indices[2::3]))
+                face_count = len(triangles)
+                bounds_start = first_data + face_count * TriangleMesh.FACE_STRIDE
+                face_data = array("d", mesh_data[first_data:bounds_start])
+                # Every face is in exactly one leaf
+                bvh = BVH.from_arrays(
+                    mesh_data[bounds_start:bounds_start + node_count * BOUNDS_FIELDS],
+                    links[first_link:first_link + node_count * LINK_FIELDS],
+                    primitives[first_primitive:first_primitive + face_count],
+                    face_count)
+                objects.append(TriangleMesh.from_face_data(vertices, triangles, face_data, bvh, material))
+            else:
+                raise ValueError(f"Unknown object kind {kind} in {file_path}")
+
+        # Views must be released before the file is unmapped
+        for section in sections:
+            section.release()
+        view.release()
+
+    infos["objects"] = objects
+    for key in ("cam_eye", "cam_look_at", "cam_up", "bg_color", "ambient_light"):
+        infos[key] = tuple(infos[key])
+    return infos
+
+
+def read_settings(file_path: str) -> dict:
+    """Reads only the settings of a binary scene, like its resolution, without its objects"""
+    with open(file_path, "rb") as file:
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{file_path} is not a binary scene")
+        settings_size = HEADER.unpack(header)[3]
+        file.seek(_aligned(HEADER.size))
+        return json.loads(file.read(settings_size))
+
+
+def load_scene_infos(file_path: str) -> dict:
+    """Loads a scene from a binary scene or a json file, whichever the file is"""
+    with open(file_path, "rb") as file:
+        is_binary = file.read(len(MAGIC)) == MAGIC
+    return load_from_binary(file_path) if is_binary else load_from_json(file_path)
+
+
+def load_obj(file_path: str, material: "Material | None" = None) -> TriangleMesh:
+    """Imports the vertices and faces of a Wavefront OBJ file as a single TriangleMesh
+    Polygons are split in triangle fans, texture coordinates, normals and groups are ignored
+    """
+    vertices = []
+    triangles = []
+    with open(file_path) as file:
+        for line in file:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "v":
+                vertices.append(Point(float(fields[1]), float(fields[2]), float(fields[3])))
+            elif fields[0] == "f":
+                # Each vertex is index, index/texture, index//normal or index/texture/normal,
+                # indices start at 1 and negative ones count back from the last vertex
+                face = []
+                for vertex in fields[1:]:
+                    index = int(vertex.split("/")[0])
+                    face.append(index - 1 if index > 0 else len(vertices) + index)
+                for i in range(1, len(face) - 1):
+                    triangles.append((face[0], face[i], face[i + 1]))
+    return TriangleMesh(vertices, triangles, material or Material())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts a json scene to the binary scene format")
+    parser.add_argument("jsonpath", help="Path of the json scene")
+    parser.add_argument("binarypath", help="Path of the binary scene to write")
+    parser.add_argument("--double", action="store_true",
+                        help="Always store coordinates as float64, by default float32 is used when it is exact")
+    args = parser.parse_args()
+    write_binary_scene(load_from_json(args.jsonpath), args.binarypath, "d" if args.double else None)
@@ -0,0 +1,111 @@
+from components import Color, Image
+from array import array
+from typing import Iterable
+import mmap
+import os
+import struct
+import time
+
+
+class RenderCheckpoint:
+    """Memory mapped file with the accumulated color and sample count of every pixel
+
+    Layout: a fixed size header, then the mean color of each pixel as three doubles
+    and finally the number of samples of each pixel as unsigned 32 bit integers.
+    Storing the mean instead of the sum keeps single pass renders bit for bit equal
+    to renders without a checkpoint.
+    The fingerprint identifies what is being rendered, so a checkpoint is never
+    resumed with a different scene or different settings.
+    """
+    MAGIC = b"RTCK"
+    VERSION = 1
+    HEADER = struct.Struct("<4sIII32s")
+
+    def __init__(self, path: str, width: int, height: int, fingerprint: bytes = b"",
+                 resume: bool = False, flush_interval: float = 10.0) -> None:
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fingerprint = fingerprint[:32].ljust(32, b"\0")
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+        pixels = width * height
+        self.colors_offset = self.HEADER.size
+        self.counts_offset = self.colors_offset + pixels * 3 * 8
+        size = self.counts_offset + pixels * 4
+
+        resume = resume and os.path.exists(path)
+        self.file = open(path, "r+b" if resume else "w+b")
+        if resume:
+            magic, version, file_width, file_height, file_fingerprint = self.HEADER.unpack(self.file.read(self.HEADER.size))
+            if magic != self.MAGIC or version != self.VERSION:
+                self.file.close()
+                raise ValueError(f"{path} is not a render checkpoint")
+            if (file_width, file_height, file_fingerprint) != (width, height, self.fingerprint):
+                self.file.close()
+                raise ValueError(f"{path} is a checkpoint of a different render")
+        else:
+            self.file.truncate(size)
+            self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION, width, height, self.fingerprint))
+            self.file.flush()
+
+        self.data = mmap.mmap(self.file.fileno(), size)
+        view = memoryview(self.data)
+        self.colors = view[self.colors_offset:self.counts_offset].cast("d")
+        self.counts = view[self.counts_offset:size].cast("I")
+
+    def tile_samples(self, tile: "tuple[int, int, int, int]") -> int:
+        """Number of samples every pixel of the tile already has"""
+        x_start, y_start, x_end, y_end = tile
+        return min(
+            min(self.counts[y * self.width + x_start:y * self.width + x_end])
+            for y in range(y_start, y_end))
+
+    def add_tile(self, tile: "tuple[int, int, int, int]", colors: "Iterable[Color]", samples: int) -> None:
+        """Accumulates the mean colors of new samples of a tile, given row by row"""
+        x_start, y_start, x_end, y_end = tile
+        colors = iter(colors)
+        for y in range(y_start, y_end):
+            for x in range(x_start, x_end):
+                color = next(colors)
+                index = y * self.width + x
+                count = self.counts[index]
+                offset = index * 3
+                if count == 0:
+                    self.colors[offset] = color.x
+                    self.colors[offset + 1] = color.y
+                    self.colors[offset + 2] = color.z
+                else:
+                    total = count + samples
+                    self.colors[offset] = (self.colors[offset] * count + color.x * samples) / total
+                    self.colors[offset + 1] = (self.colors[offset + 1] * count + color.y * samples) / total
+                    self.colors[offset + 2] = (self.colors[offset + 2] * count + color.z * samples) / total
+                self.counts[index] = count + samples
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the changes to disk"""
+        self.data.flush()
+        self.last_flush = time.monotonic()
+
+    def to_image(self) -> Image:
+        """Image with the accumulated colors, pixels without samples are black"""
+        image = Image(self.width, self.height)
+        image.buffer = array(Image.TYPECODE, self.colors.tobytes())
+        return image
+
+    def close(self) -> None:
+        if not self.data.closed:
+            self.flush()
+            self.colors.release()
+            self.counts.release()
+            self.data.close()
+            self.file.close()
+
+    def __enter__(self) -> "RenderCheckpoint":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
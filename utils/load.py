@@ -8,8 +8,12 @@ def load_from_json(file_path: str) -> dict:
     """
 
     with open(file_path) as file:
-        infos = json.load(file)
-    
+        return scene_infos(json.load(file))
+
+def scene_infos(infos: dict) -> dict:
+    """
+    Returns the dictionary build_scene takes from the contents of a json scene file.
+    """
     return {
         "cam_width": infos["h_res"],
         "cam_height": infos["v_res"],
@@ -25,9 +29,12 @@ def load_from_json(file_path: str) -> dict:
         "max_depth": infos.get("max_depth", 5)
     }
 
-def identify_object(object_opt: dict) -> "Object3D | None":
-    new_object = None
-    
+def material_options(object_opt: dict) -> tuple:
+    """
+    Returns the material of an object as the tuple
+    (r, g, b, ambient, diffuse, specular, reflection, phong, transmission, index_of_refraction)
+    with the defaults for missing values.
+    """
     ambient: float = object_opt.get("ka", 0.05)
     diffuse: float = object_opt.get("kd", 1)
     specular: float = object_opt.get("ks", 1)
@@ -35,11 +42,19 @@ def identify_object(object_opt: dict) -> "Object3D | None":
     reflection: float = object_opt.get("kr", 0.5)
     transmission: float = object_opt.get("kt", 0)
     index_of_refraction: float = object_opt.get("index_of_refraction", 1)
+    return (*object_opt["color"], ambient, diffuse, specular,
+            reflection, phong, transmission, index_of_refraction)
+
+def identify_object(object_opt: dict, material: "Material | None" = None) -> "Object3D | None":
+    """
+    Builds the object described by a dictionary,
+    with the given material or a new one built from the dictionary.
+    """
+    new_object = None
 
-    color = Color.from_RGB(*object_opt["color"])
-    material = Material(color, ambient, diffuse, 
-                        specular, reflection, phong, 
-                        transmission, index_of_refraction)
+    if material is None:
+        r, g, b, *coefficients = material_options(object_opt)
+        material = Material(Color.from_RGB(r, g, b), *coefficients)
 
     if "sphere" in object_opt:
         sphere_options = object_opt["sphere"]
@@ -85,7 +100,11 @@ def build_scene(infos: dict) -> Scene:
 
     CAMERA = Camera(CAM_HEIGHT, CAM_WIDTH, CAM_SQUARE_SIZE, 
             CAM_FOCAL_DISTANCE, CAM_EYE, CAM_LOOK_AT, CAM_UP)
-    OBJECTS = [identify_object(object_opt) for object_opt in infos["objects"]]
+    # Objects of binary scenes are already built
+    OBJECTS = [
+        identify_object(object_opt) if isinstance(object_opt, dict) else object_opt
+        for object_opt in infos["objects"]
+    ]
     
     AMBIENT_COLOR = Color.from_RGB(*infos["ambient_light"])
 
@@ -0,0 +1,84 @@
+from components import Color, Material, Point, TriangleMesh
+from .load import identify_object, material_options
+import math
+
+# Faces with less area can't be hit by any ray
+DEGENERATE_AREA = 1e-12
+
+
+def triangle_area(vertex_0: "list[float]", vertex_1: "list[float]", vertex_2: "list[float]") -> float:
+    """Area of the triangle, 0 when its vertices are repeated or aligned"""
+    e1 = [b - a for a, b in zip(vertex_0, vertex_1)]
+    e2 = [b - a for a, b in zip(vertex_0, vertex_2)]
+    cross = (e1[1] * e2[2] - e1[2] * e2[1], e1[2] * e2[0] - e1[0] * e2[2], e1[0] * e2[1] - e1[1] * e2[0])
+    return math.sqrt(sum(c * c for c in cross)) / 2
+
+
+def optimize_scene(infos: dict) -> "tuple[dict, dict]":
+    """
+    Optimizes the objects of a scene, as returned by load_from_json, before build_scene:
+    - Standalone triangles with the same material are merged into a single TriangleMesh,
+      in their original order, with vertices at the same position stored once.
+      The mesh takes the place of the first of its triangles in the objects list.
+    - Degenerate faces, with no area, are dropped from triangles and meshes.
+    - Objects with the same material share a single Material.
+    Returns a new dictionary with the objects already built and a report of the
+    number of objects, vertices (of triangles and meshes) and materials before and after,
+    plus the number of faces dropped.
+    Binary scenes are loaded with their objects already built and can't be optimized.
+    """
+    if any(not isinstance(object_opt, dict) for object_opt in infos["objects"]):
+        raise ValueError("Only scenes loaded from json can be optimized")
+    materials: dict[tuple, Material] = {}
+    # Per material: the position of the mesh in the objects list, its vertices and faces
+    groups: dict[tuple, tuple[int, dict, list]] = {}
+    objects = []
+    vertices_before = 0
+    dropped = 0
+
+    for object_opt in infos["objects"]:
+        key = material_options(object_opt)
+        if key not in materials:
+            r, g, b, *coefficients = key
+            materials[key] = Material(Color.from_RGB(r, g, b), *coefficients)
+        material = materials[key]
+
+        if "triangle" in object_opt:
+            vertices_before += 3
+            if triangle_area(*object_opt["triangle"]) <= DEGENERATE_AREA:
+                dropped += 1
+                continue
+            if key not in groups:
+                groups[key] = (len(objects), {}, [])
+                objects.append(None)
+            _, positions, faces = groups[key]
+            face = []
+            for vertex in object_opt["triangle"]:
+                face.append(positions.setdefault(tuple(float(value) for value in vertex), len(positions)))
+            faces.append(tuple(face))
+        elif "triangle_mesh" in object_opt:
+            mesh_options = object_opt["triangle_mesh"]
+            vertices = mesh_options["verteces"]
+            vertices_before += len(vertices)
+            triangles = []
+            for a, b, c in mesh_options["triangle_indexes"]:
+                if triangle_area(vertices[a - 1], vertices[b - 1], vertices[c - 1]) <= DEGENERATE_AREA:
+                    dropped += 1
+                else:
+                    triangles.append([a, b, c])
+            objects.append(identify_object(
+                {"triangle_mesh": {"verteces": vertices, "triangle_indexes": triangles}}, material))
+        else:
+            objects.append(identify_object(object_opt, material))
+
+    for key, (position, vertices, faces) in groups.items():
+        objects[position] = TriangleMesh([Point(*vertex) for vertex in vertices], faces, materials[key])
+
+    vertices_after = sum(len(obj.list_vertices) for obj in objects if isinstance(obj, TriangleMesh))
+    report = {
+        "objects": (len(infos["objects"]), len(objects)),
+        "vertices": (vertices_before, vertices_after),
+        "materials": (len(infos["objects"]), len(materials)),
+        "degenerate_faces": dropped,
+    }
+    return {**infos, "objects": objects}, report
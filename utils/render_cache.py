@@ -0,0 +1,192 @@
+"""Content addressed cache of rendered tiles on disk
+
+Every tile of a render is stored in its own file, named by the digest of everything its pixels depend on:
+the scene as loaded (load_from_json's dictionary), the resolution, the anti-aliasing samples, seed and sampler,
+the position of the tile and the version of the engine (a digest of the source of the modules that compute pixels).
+Rendering the same scene again reads every tile back and renders nothing, and a crop of a render only needs
+the tiles it overlaps, so crops of a rendered scene are hits too.
+
+Files are written to a temporary name and renamed, so processes sharing the directory never read a partial tile.
+Reading a tile refreshes its modification time, and when the directory grows over its size cap
+the least recently used tiles are removed.
+"""
+from __future__ import annotations
+from components import Image
+from components.image import color_array
+from array import array
+from typing import TYPE_CHECKING
+import glob
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+if TYPE_CHECKING:
+    from engine import RenderEngine
+
+_engine_version: "str | None" = None
+
+
+def engine_version() -> str:
+    """Digest of the source of the modules that compute the pixels, changing the renderer invalidates the cache"""
+    global _engine_version
+    if _engine_version is None:
+        import components
+        import engine
+        root = os.path.dirname(os.path.abspath(engine.__file__))
+        paths = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(components.__file__)), "*.py")))
+        paths += [os.path.join(root, name) for name in ("engine.py", "vectorized_engine.py", "sampler.py")]
+        digest = hashlib.sha256()
+        for path in paths:
+            if os.path.exists(path):
+                with open(path, "rb") as source:
+                    digest.update(source.read())
+        _engine_version = digest.hexdigest()
+    return _engine_version
+
+
+def scene_digest(infos: dict) -> str:
+    """Canonical digest of a scene as returned by load_from_json, keys in any order
+    Objects already built, like the ones of binary scenes, are hashed by their pickle
+    """
+    digest = hashlib.sha256()
+    for key in sorted(infos):
+        digest.update(json.dumps(key).encode())
+        if key == "objects":
+            for obj in infos[key]:
+                digest.update(json.dumps(obj, sort_keys=True).encode() if isinstance(obj, dict) else pickle.dumps(obj))
+        else:
+            digest.update(json.dumps(infos[key], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """Directory of rendered tiles shared by any number of processes, holding at most max_bytes"""
+    def __init__(self, directory: str, max_bytes: int = 1 << 30) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Tiles read from and rendered into the cache by the last render
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def render(self, engine: RenderEngine, infos: dict, anti_aliasing: int = 0, seed: int = 0,
+               workers: int = 1, tile_size: "int | None" = None,
+               crop: "tuple[int, int, int, int] | None" = None, show_progress: bool = False) -> Image:
+        """Renders the scene of infos like engine.render, rendering only the tiles missing from the cache
+        crop (x_start, y_start, x_end, y_end) renders only that part of the image, the scene is built only on misses
+        """
+        width, height = infos["cam_width"], infos["cam_height"]
+        x_start, y_start, x_end, y_end = crop or (0, 0, width, height)
+        if not (0 <= x_start < x_end <= width and 0 <= y_start < y_end <= height):
+            raise ValueError(f"Crop {crop} is outside of the {width}x{height} image")
+        sampler = engine.sampler
+        render_key = hashlib.sha256(json.dumps([
+            scene_digest(infos), anti_aliasing, seed,
+            None if sampler is None or not anti_aliasing else [type(sampler).__name__, vars(sampler)],
+            [engine.min_weight, engine.russian_roulette] if engine.min_weight else None,
+            engine_version()], sort_keys=True).encode()).hexdigest()
+
+        tiles = [
+            tile for tile in engine.split_tiles(width, height, tile_size or engine.TILE_SIZE)
+            if tile[0] < x_end and x_start < tile[2] and tile[1] < y_end and y_start < tile[3]]
+        image = Image(x_end - x_start, y_end - y_start)
+        missing = []
+        for tile in tiles:
+            values = self.get(self.tile_key(render_key, tile), tile)
+            if values is None:
+                missing.append(tile)
+            else:
+                self._copy_tile(image, (x_start, y_start), tile, values)
+        self.hits = len(tiles) - len(missing)
+        self.misses = len(missing)
+
+        if missing:
+            from utils.load import build_scene
+            scene = build_scene(infos)
+            for done, (tile, colors) in enumerate(
+                    engine.render_iter(scene, anti_aliasing, workers, seed=seed, tiles=missing), 1):
+                values = color_array(colors, Image.TYPECODE)
+                self.put(self.tile_key(render_key, tile), values)
+                self._copy_tile(image, (x_start, y_start), tile, values)
+                if show_progress:
+                    print(f"{(done / len(missing)) * 100:.2f}%", end='\r')
+            self.evict()
+        return image
+
+    @staticmethod
+    def tile_key(render_key: str, tile: "tuple[int, int, int, int]") -> str:
+        return hashlib.sha256(f"{render_key}:{tile}".encode()).hexdigest()
+
+    @staticmethod
+    def _copy_tile(image: Image, origin: "tuple[int, int]", tile: "tuple[int, int, int, int]", values: array) -> None:
+        """Copies the part of a tile inside the image, which starts at origin of the full image"""
+        x_origin, y_origin = origin
+        x_start, y_start, x_end, y_end = tile
+        tile_width = x_end - x_start
+        left = max(x_start, x_origin)
+        right = min(x_end, x_origin + image.width)
+        for y in range(max(y_start, y_origin), min(y_end, y_origin + image.height)):
+            source = ((y - y_start) * tile_width + left - x_start) * 3
+            target = ((y - y_origin) * image.width + left - x_origin) * 3
+            image.buffer[target:target + (right - left) * 3] = values[source:source + (right - left) * 3]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key: str, tile: "tuple[int, int, int, int]") -> "array | None":
+        """Colors of a cached tile as r, g, b doubles, None if it isn't cached"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)
+        except OSError:
+            return None
+        values = array(Image.TYPECODE)
+        if len(data) != (tile[2] - tile[0]) * (tile[3] - tile[1]) * 3 * values.itemsize:
+            return None
+        values.frombytes(data)
+        return values
+
+    def put(self, key: str, values: array) -> None:
+        """Stores a tile, writing it to a temporary file renamed into place"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(values.tobytes())
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def evict(self) -> None:
+        """Removes the least recently used tiles until the cache holds at most max_bytes"""
+        files = []
+        total = 0
+        for directory in os.scandir(self.directory):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(files):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # Another process removed it first
+                pass
+            total -= size
+            if total <= self.max_bytes:
+                break
@@ -0,0 +1,597 @@
+from __future__ import annotations
+from components import (Color, Point, Vector3, Ray, Scene, BVH, AABB,
+    Sphere, Plane, Triangle, TriangleMesh, RevolutionSurface, Material, ChequeredMaterial)
+from engine import RenderEngine
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from sampler import AdaptiveSampler
+
+# Used instead of infinity for the inverse of a zero direction component, like the scalar BVH
+BIG_INVERSE = 1e30
+NO_KEY = np.iinfo(np.int64).max
+
+
+class PacketScene:
+    """Scene flattened into NumPy arrays for the vectorized engine
+
+    Every primitive gets a global id: spheres first, then triangles (loose ones and mesh faces),
+    planes and finally objects of unknown types (like Instance), which are intersected one ray at a time.
+    Each primitive keeps the index of the object that owns it and a sort key
+    (object index, face index) used to break ties the same way the scalar engine does.
+    Spheres, triangles and bounded objects of unknown types are indexed by a BVH
+    that is traversed with whole ray packets.
+    """
+    LEAF_SIZE = 8
+
+    def __init__(self, scene: Scene) -> None:
+        self.objects = scene.objects
+        spheres, triangles, planes, others = [], [], [], []
+        for index, obj in enumerate(scene.objects):
+            key = index << 32
+            if isinstance(obj, Sphere):
+                spheres.append((key, index, obj))
+            elif isinstance(obj, Plane):
+                planes.append((key, index, obj))
+            elif isinstance(obj, Triangle):
+                triangles.append((key, index, obj.vertex_0, obj.vertex_1 - obj.vertex_0, obj.vertex_2 - obj.vertex_0, obj.normal))
+            elif isinstance(obj, (TriangleMesh, RevolutionSurface)):
+                mesh = obj.triangle_mesh if isinstance(obj, RevolutionSurface) else obj
+                data = mesh.face_data
+                stride = TriangleMesh.FACE_STRIDE
+                for face in range(len(data) // stride):
+                    offset = face * stride
+                    triangles.append((
+                        key + face, index,
+                        Point(*data[offset:offset + 3]), Point(*data[offset + 3:offset + 6]),
+                        Point(*data[offset + 6:offset + 9]), Point(*data[offset + 9:offset + 12])))
+            else:
+                others.append((key, index, obj))
+
+        self.sphere_count = len(spheres)
+        self.triangle_count = len(triangles)
+        self.plane_count = len(planes)
+        self.sphere_center = np.array([tuple(obj.center) for _, _, obj in spheres], dtype=float).reshape(-1, 3)
+        self.sphere_radius2 = np.array([obj.radius ** 2 for _, _, obj in spheres], dtype=float)
+        self.triangle_vertex = np.array([tuple(t[2]) for t in triangles], dtype=float).reshape(-1, 3)
+        self.triangle_edge1 = np.array([tuple(t[3]) for t in triangles], dtype=float).reshape(-1, 3)
+        self.triangle_edge2 = np.array([tuple(t[4]) for t in triangles], dtype=float).reshape(-1, 3)
+        self.triangle_normal = np.array([tuple(t[5]) for t in triangles], dtype=float).reshape(-1, 3)
+        self.plane_point = np.array([tuple(obj.point) for _, _, obj in planes], dtype=float).reshape(-1, 3)
+        self.plane_normal = np.array([tuple(obj.normal) for _, _, obj in planes], dtype=float).reshape(-1, 3)
+        self.others = [(self.sphere_count + self.triangle_count + self.plane_count + i, obj) for i, (_, _, obj) in enumerate(others)]
+        self.other_objects = dict(self.others)
+
+        self.key = np.array([p[0] for p in spheres + triangles + planes + others], dtype=np.int64)
+        self.owner = np.array([p[1] for p in spheres + triangles + planes + others], dtype=np.int64)
+        self.materials = MaterialTable([obj.material for obj in scene.objects])
+
+        boxes = [obj.bounding_box() for _, _, obj in spheres]
+        for t in triangles:
+            boxes.append(AABB.from_points([t[2], t[2] + t[3], t[2] + t[4]]))
+        # Global id of the primitive of each box
+        box_ids = list(range(len(boxes)))
+        # Objects of unknown types without a box are tested against every ray
+        self.unbounded_others = []
+        for global_id, obj in self.others:
+            box = obj.bounding_box()
+            if box is None:
+                self.unbounded_others.append(global_id)
+            else:
+                boxes.append(box)
+                box_ids.append(global_id)
+        box_ids = np.array(box_ids, dtype=np.int64)
+        self.bvh = BVH(boxes, self.LEAF_SIZE)
+        # Leaves split by primitive type, each sorted by key so argmin picks the first object on ties
+        self.leaves = {}
+        first_other = self.sphere_count + self.triangle_count + self.plane_count
+        for node_index, node in enumerate(self.bvh.nodes):
+            primitives = node[9]
+            if primitives is not None:
+                ids = np.array(sorted(box_ids[list(primitives)], key=lambda i: self.key[i]), dtype=np.int64)
+                self.leaves[node_index] = (
+                    ids[ids < self.sphere_count], ids[(ids >= self.sphere_count) & (ids < first_other)],
+                    ids[ids >= first_other].tolist())
+
+
+class MaterialTable:
+    """Material coefficients of every object, indexed by object index"""
+    def __init__(self, materials: "list[Material]") -> None:
+        self.materials = materials
+        self.ambient = np.array([m.ambient for m in materials], dtype=float)
+        self.diffuse = np.array([m.diffuse for m in materials], dtype=float)
+        self.specular = np.array([m.specular for m in materials], dtype=float)
+        self.reflection = np.array([m.reflection for m in materials], dtype=float)
+        self.phong = np.array([m.phong for m in materials], dtype=float)
+        self.transmission = np.array([m.transmission for m in materials], dtype=float)
+        self.refraction = np.array([m.refraction for m in materials], dtype=float)
+        self.color = np.array([
+            tuple(m.color) if type(m) is Material else (0., 0., 0.) for m in materials], dtype=float).reshape(-1, 3)
+        self.patterned = [i for i, m in enumerate(materials) if type(m) is not Material]
+
+    def color_at(self, owner: np.ndarray, position: np.ndarray) -> np.ndarray:
+        """Colors of the materials of the owners at the given positions"""
+        color = self.color[owner]
+        for index in self.patterned:
+            mask = owner == index
+            if not mask.any():
+                continue
+            material = self.materials[index]
+            if isinstance(material, ChequeredMaterial):
+                color[mask] = chequered_color(material, position[mask])
+            else:
+                color[mask] = [tuple(material.color_at(Point(*p))) for p in position[mask]]
+        return color
+
+
+def chequered_color(material: ChequeredMaterial, position: np.ndarray) -> np.ndarray:
+    """Vectorized ChequeredMaterial.color_at"""
+    cell_x = np.trunc((position[:, 0] + 5.0) * 3.0).astype(np.int64) % 2
+    cell_y = np.trunc((position[:, 1] + 5.0) * 3.0).astype(np.int64) % 2
+    cell_z = np.trunc((position[:, 2] + 5.0) * 3.0).astype(np.int64) % 2
+    first = (cell_y == 1) == (cell_x == cell_z)
+    return np.where(first[:, None], np.array(tuple(material.color1)), np.array(tuple(material.color2)))
+
+
+_python_pow = np.frompyfunc(pow, 2, 1)
+
+def power(base: np.ndarray, exponent) -> np.ndarray:
+    """Element-wise ** computed by Python's float pow, NumPy's own power can differ in the last bit"""
+    return _python_pow(base, exponent).astype(float)
+
+
+def dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Row-wise dot product, summed in the same order as Vector3.dot_product"""
+    return (a[..., 0] * b[..., 0]) + (a[..., 1] * b[..., 1]) + (a[..., 2] * b[..., 2])
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Row-wise Vector3.normalize"""
+    magnitude = np.sqrt(dot(vectors, vectors))
+    magnitude[magnitude == 0] = 1
+    return vectors / magnitude[:, None]
+
+
+class VectorizedRenderEngine(RenderEngine):
+    """Renders with whole packets of rays as NumPy arrays
+
+    Produces the same images as RenderEngine, mirroring its arithmetic operation by operation,
+    but intersects, shades and bounces every ray of a tile at once with masked array operations.
+    """
+
+    TILE_SIZE = 64
+
+    def __init__(
+            self, sampler: "AdaptiveSampler | None" = None, min_weight: float = 0.0,
+            russian_roulette: bool = False) -> None:
+        super().__init__(sampler, min_weight, russian_roulette)
+        self._packet_source: "tuple[list, int] | None" = None
+        self._packet_scene: "PacketScene | None" = None
+
+    def packet_scene(self, scene: Scene) -> PacketScene:
+        """Flattened arrays of the scene, built once per list of objects and build of its BVH
+        so the frames of Scene.with_camera share them and Scene.build_bvh picks up edits
+        """
+        scene.bvh
+        source = self._packet_source
+        if source is None or source[0] is not scene.objects or source[1] != scene.version:
+            self._packet_scene = PacketScene(scene)
+            self._packet_source = (scene.objects, scene.version)
+        return self._packet_scene
+
+    def render_tile(
+            self, scene: Scene, tile: "tuple[int, int, int, int]",
+            anti_aliasing: int = 0, seed: int = 0, first_sample: int = 0) -> "list[Color]":
+        if self.russian_roulette:
+            self.start_roulette(seed, tile, first_sample)
+        if anti_aliasing and self.sampler is not None:
+            return self.sampler.render_tile(self, scene, tile, anti_aliasing, seed, first_sample)
+        x_start, y_start, x_end, y_end = tile
+        cam_focus, image_center, u, v, pixel_size = self.view_plane(scene)
+        ys, xs = np.mgrid[y_start:y_end, x_start:x_end]
+        xs = xs.ravel().astype(float)
+        ys = ys.ravel().astype(float)
+        u = np.array(tuple(u))
+        v = np.array(tuple(v))
+        focus = np.array(tuple(cam_focus))
+
+        if anti_aliasing:
+            # Same random sequence as the scalar engine: two numbers per sample, samples of a pixel in a row
+            random = self.sample_random(seed, tile, first_sample).random
+            samples = anti_aliasing - first_sample
+            jitter = np.array([random() for _ in range(2 * samples * len(xs))]).reshape(len(xs), samples, 2)
+            colors = np.zeros((len(xs), 3))
+            for sample in range(samples):
+                colors += self._trace_camera(scene, focus, image_center, u, v, pixel_size,
+                    xs + jitter[:, sample, 0], ys + jitter[:, sample, 1])
+            colors = colors / samples
+        else:
+            colors = self._trace_camera(scene, focus, image_center, u, v, pixel_size, xs, ys)
+        return [Color(*color) for color in colors.tolist()]
+
+    def trace_points(self, scene: Scene, xs: "list[float]", ys: "list[float]") -> "list[tuple[float, float, float]]":
+        if not xs:
+            return []
+        cam_focus, image_center, u, v, pixel_size = self.view_plane(scene)
+        colors = self._trace_camera(scene, np.array(tuple(cam_focus)), image_center,
+            np.array(tuple(u)), np.array(tuple(v)), pixel_size, np.array(xs), np.array(ys))
+        return colors.tolist()
+
+    def _trace_camera(self, scene, focus, image_center, u, v, pixel_size, xs, ys) -> np.ndarray:
+        position = np.array(tuple(image_center)) + ((xs[:, None] * u) - (ys[:, None] * v)) * pixel_size
+        directions = normalize(normalize(position - focus))
+        origins = np.broadcast_to(focus, directions.shape).copy()
+        with np.errstate(all='ignore'):
+            return self.trace_packet(self.packet_scene(scene), scene, origins, directions)
+
+    def trace_packet(
+            self, packet: PacketScene, scene: Scene, origins: np.ndarray, directions: np.ndarray, depth=0,
+            weights: "np.ndarray | None" = None) -> np.ndarray:
+        """Vectorized rayTrace, directions must be normalized, weights are the weights of the rays (1 by default)
+        With russian_roulette the survivors are drawn in packet order, so the noise differs from the scalar engine
+        """
+        colors = np.empty(origins.shape)
+        colors[:] = tuple(scene.bg_color)
+        found_normals = {}
+        distance, primitive = self.nearest_packet(packet, origins, directions, found_normals)
+        hit = np.flatnonzero(primitive >= 0)
+        if not hit.size:
+            return colors
+        # Same normals by index among the hits, hit is sorted
+        other_normals = dict(zip(np.searchsorted(hit, list(found_normals)).tolist(), found_normals.values()))
+
+        origins = origins[hit]
+        directions = directions[hit]
+        distance = distance[hit]
+        primitive = primitive[hit]
+        owner = packet.owner[primitive]
+        hit_pos = origins + directions * distance[:, None]
+        normal = self.normals(packet, primitive, hit_pos, other_normals)
+        color = self.shade_packet(packet, scene, owner, hit_pos, normal)
+
+        if depth < scene.max_depth:
+            materials = packet.materials
+            omega = -directions
+            cos_omega = dot(normal, omega)
+            leaving = cos_omega < 0
+            facing = np.where(leaving[:, None], -normal, normal)
+            reflection = materials.reflection[owner]
+            transmission = materials.transmission[owner]
+            refraction = materials.refraction[owner]
+
+            # All the secondary rays of the packet are traced together as a single packet
+            reflected = np.flatnonzero(reflection > 0)
+            child_weights = None
+            if self.min_weight:
+                refracted = np.flatnonzero(refraction > 0)
+                hit_weights = None if weights is None else weights[hit]
+                reflected, reflected_weight, reflection = self._prune(reflected, reflection, hit_weights)
+                refracted, refracted_weight, transmission = self._prune(refracted, transmission, hit_weights)
+            else:
+                # Refracted rays attenuated to zero can't change the color and are skipped
+                refracted = np.flatnonzero((refraction > 0) & (transmission != 0))
+            relative = np.where(leaving[refracted], 1 / refraction[refracted], refraction[refracted])
+            n = facing[refracted]
+            w = omega[refracted]
+            n_dot_w = dot(n, w)
+            delta = 1 - (1 / power(relative, 2)) * (1 - power(n_dot_w, 2))
+            through = np.flatnonzero(delta >= 0)
+            # On total internal reflection the ray is reflected, but still attenuated by the transmission
+            total = np.flatnonzero(delta < 0)
+
+            inverse = 1 / relative[through]
+            through_dirs = (w[through] * -inverse[:, None]) \
+                - n[through] * (np.sqrt(delta[through]) - inverse * n_dot_w[through])[:, None]
+            through_pos = hit_pos[refracted[through]] - n[through] * self.MIN_DISPLACE
+            bounced = np.concatenate((reflected, refracted[total]))
+            bounce_normal = np.concatenate((facing[reflected], n[total]))
+            bounce_pos = hit_pos[bounced] + bounce_normal * self.MIN_DISPLACE
+            bounce_dirs = directions[bounced] - bounce_normal * (2 * dot(directions[bounced], bounce_normal))[:, None]
+            if self.min_weight:
+                child_weights = np.concatenate((reflected_weight, refracted_weight[total], refracted_weight[through]))
+
+            if bounced.size or through.size:
+                child = self.trace_packet(
+                    packet, scene,
+                    np.concatenate((bounce_pos, through_pos)),
+                    normalize(np.concatenate((bounce_dirs, through_dirs))), depth + 1, child_weights)
+                reflected_color = child[:reflected.size]
+                refracted_color = np.empty((refracted.size, 3))
+                refracted_color[total] = child[reflected.size:bounced.size]
+                refracted_color[through] = child[bounced.size:]
+                # Same order as the scalar engine: reflection is added before refraction
+                color[reflected] = color[reflected] + reflected_color * reflection[reflected][:, None]
+                color[refracted] = color[refracted] + refracted_color * transmission[refracted][:, None]
+
+        colors[hit] = color
+        return colors
+
+    def _prune(
+            self, rays: np.ndarray, coefficients: np.ndarray, weights: "np.ndarray | None"
+            ) -> "tuple[np.ndarray, np.ndarray, np.ndarray]":
+        """Drops the secondary rays weighing less than min_weight, like rayTrace does, returns the indices of
+        the rays left, their weights and the coefficients of all the hits with those of roulette survivors raised
+        """
+        ray_weights = coefficients[rays] if weights is None else weights[rays] * coefficients[rays]
+        light = np.flatnonzero(ray_weights < self.min_weight)
+        if not light.size:
+            return rays, ray_weights, coefficients
+        keep = np.ones(rays.size, dtype=bool)
+        keep[light] = False
+        if self.russian_roulette:
+            random = self._roulette.random
+            draws = np.array([random() for _ in range(light.size)])
+            survivors = light[draws * self.min_weight < ray_weights[light]]
+            keep[survivors] = True
+            coefficients = coefficients.copy()
+            coefficients[rays[survivors]] *= self.min_weight / ray_weights[survivors]
+            ray_weights[survivors] = self.min_weight
+        self.pruned_rays += rays.size - np.count_nonzero(keep)
+        return rays[keep], ray_weights[keep], coefficients
+
+    def shade_packet(self, packet: PacketScene, scene: Scene, owner: np.ndarray, hit_pos: np.ndarray, normal: np.ndarray) -> np.ndarray:
+        """Vectorized color_at"""
+        materials = packet.materials
+        obj_color = materials.color_at(owner, hit_pos)
+        color = (obj_color * np.array(tuple(scene.ambient_color))) * materials.ambient[owner][:, None]
+        diffuse = materials.diffuse[owner]
+        specular = materials.specular[owner]
+        phong = materials.phong[owner]
+        to_camera = normalize(np.array(tuple(scene.camera.eye)) - hit_pos)
+
+        for light in scene.lights:
+            light_position = np.array(tuple(light.position))
+            light_color = np.array(tuple(light.color))
+            to_light_vector = light_position - hit_pos
+            to_light = normalize(to_light_vector)
+            lit = ~self.occluded_packet(packet, hit_pos, to_light, dot(to_light, to_light_vector))
+            if not lit.any():
+                continue
+
+            n_dot_l = dot(normal, to_light)
+            diffuse_color = ((obj_color * light_color) * diffuse[:, None]) * np.maximum(n_dot_l, 0)[:, None]
+            half_vector = normal * (2 * n_dot_l)[:, None] - to_light
+            specular_color = (light_color * specular[:, None]) \
+                * power(np.maximum(dot(half_vector, to_camera), 0), phong)[:, None]
+            color = np.where(lit[:, None], (color + diffuse_color) + specular_color, color)
+        return color
+
+    def normals(self, packet: PacketScene, primitive: np.ndarray, hit_pos: np.ndarray, other_normals: "dict[int, Vector3]") -> np.ndarray:
+        """Surface normals at the hit points of each primitive
+        other_normals has the normals nearest_packet found for the hits on objects of unknown types, by hit index
+        """
+        normal = np.empty(hit_pos.shape)
+        spheres = primitive < packet.sphere_count
+        if spheres.any():
+            normal[spheres] = normalize(hit_pos[spheres] - packet.sphere_center[primitive[spheres]])
+        first = packet.sphere_count
+        triangles = (primitive >= first) & (primitive < first + packet.triangle_count)
+        if triangles.any():
+            normal[triangles] = packet.triangle_normal[primitive[triangles] - first]
+        first += packet.triangle_count
+        planes = (primitive >= first) & (primitive < first + packet.plane_count)
+        if planes.any():
+            normal[planes] = packet.plane_normal[primitive[planes] - first]
+        if packet.others:
+            for i in np.flatnonzero(primitive >= first + packet.plane_count):
+                normal[i] = tuple(other_normals[i])
+        return normal
+
+    def nearest_packet(
+            self, packet: PacketScene, origins: np.ndarray, directions: np.ndarray,
+            other_normals: "dict[int, Vector3] | None" = None) -> "tuple[np.ndarray, np.ndarray]":
+        """Closest hit of every ray, returns distances and global primitive ids (-1 for misses)
+        The normals of the hits on objects of unknown types are kept in other_normals by ray index, if given
+        """
+        count = len(origins)
+        best = [np.full(count, np.inf), np.full(count, NO_KEY, dtype=np.int64), np.full(count, -1, dtype=np.int64)]
+        everyone = np.arange(count)
+
+        if packet.plane_count:
+            first = packet.sphere_count + packet.triangle_count
+            self._update(packet, best, everyone, intersect_planes(packet, origins, directions), np.arange(first, first + packet.plane_count))
+        for global_id in packet.unbounded_others:
+            self._intersect_other(packet, best, everyone, origins, directions, global_id, other_normals)
+
+        nodes = packet.bvh.nodes
+        if not nodes:
+            return best[0], best[2]
+        inverse = np.full(directions.shape, BIG_INVERSE)
+        np.divide(1, directions, out=inverse, where=directions != 0)
+        stack = [(0, everyone)]
+        while stack:
+            node_index, rays = stack.pop()
+            min_x, min_y, min_z, max_x, max_y, max_z, left, right, axis, primitives = nodes[node_index]
+            o = origins[rays]
+            inv = inverse[rays]
+            t1 = (np.array((min_x, min_y, min_z)) - o) * inv
+            t2 = (np.array((max_x, max_y, max_z)) - o) * inv
+            near = np.minimum(t1, t2).max(axis=1)
+            far = np.maximum(t1, t2).min(axis=1)
+            rays = rays[(near <= far) & (far >= 0) & (near <= best[0][rays])]
+            if not rays.size:
+                continue
+            if primitives is None:
+                # Visits first the child most rays of the packet reach first
+                if (inverse[rays, axis] < 0).sum() * 2 > rays.size:
+                    stack.append((left, rays))
+                    stack.append((right, rays))
+                else:
+                    stack.append((right, rays))
+                    stack.append((left, rays))
+                continue
+
+            spheres, triangles, others = packet.leaves[node_index]
+            if spheres.size:
+                distance = intersect_spheres(packet, origins[rays], directions[rays], spheres)
+                self._update(packet, best, rays, distance, spheres)
+            if triangles.size:
+                distance = intersect_triangles(packet, origins[rays], directions[rays], triangles - packet.sphere_count)
+                self._update(packet, best, rays, distance, triangles)
+            for global_id in others:
+                self._intersect_other(packet, best, rays, origins, directions, global_id, other_normals)
+        return best[0], best[2]
+
+    def _intersect_other(
+            self, packet: PacketScene, best: list, rays: np.ndarray, origins: np.ndarray, directions: np.ndarray,
+            global_id: int, other_normals: "dict[int, Vector3] | None") -> None:
+        """Intersects an object of unknown type one ray at a time, keeping the normals of the hits it wins"""
+        obj = packet.other_objects[global_id]
+        distance = np.full((len(rays), 1), np.inf)
+        normals = {}
+        for row, i in enumerate(rays.tolist()):
+            hit_distance, hit_normal = obj.intersects(make_ray(origins[i], directions[i]))
+            if hit_distance is not None:
+                distance[row, 0] = hit_distance
+                normals[i] = hit_normal
+        self._update(packet, best, rays, distance, np.array([global_id]))
+        if other_normals is not None:
+            for i, hit_normal in normals.items():
+                if best[2][i] == global_id:
+                    other_normals[i] = hit_normal
+
+    def occluded_packet(
+            self, packet: PacketScene, origins: np.ndarray, directions: np.ndarray, max_distance: np.ndarray) -> np.ndarray:
+        """Vectorized occluded, checks if anything blocks each ray before its max_distance
+        Rays leave the traversal at the first blocker found instead of searching for the closest hit
+        """
+        count = len(origins)
+        blocked = np.zeros(count, dtype=bool)
+
+        def block(rays: np.ndarray, distance: np.ndarray) -> None:
+            blocked[rays] |= ((0 < distance) & (distance < max_distance[rays][:, None])).any(axis=1)
+
+        if packet.plane_count:
+            block(np.arange(count), intersect_planes(packet, origins, directions))
+        for global_id in packet.unbounded_others:
+            self._occlude_other(packet, blocked, np.flatnonzero(~blocked), origins, directions, max_distance, global_id)
+
+        nodes = packet.bvh.nodes
+        if not nodes or blocked.all():
+            return blocked
+        inverse = np.full(directions.shape, BIG_INVERSE)
+        np.divide(1, directions, out=inverse, where=directions != 0)
+        stack = [(0, np.flatnonzero(~blocked))]
+        while stack:
+            node_index, rays = stack.pop()
+            rays = rays[~blocked[rays]]
+            if not rays.size:
+                continue
+            min_x, min_y, min_z, max_x, max_y, max_z, left, right, axis, primitives = nodes[node_index]
+            o = origins[rays]
+            inv = inverse[rays]
+            t1 = (np.array((min_x, min_y, min_z)) - o) * inv
+            t2 = (np.array((max_x, max_y, max_z)) - o) * inv
+            near = np.minimum(t1, t2).max(axis=1)
+            far = np.maximum(t1, t2).min(axis=1)
+            rays = rays[(near <= far) & (far >= 0) & (near <= max_distance[rays])]
+            if not rays.size:
+                continue
+            if primitives is None:
+                stack.append((right, rays))
+                stack.append((left, rays))
+                continue
+
+            spheres, triangles, others = packet.leaves[node_index]
+            if spheres.size:
+                block(rays, intersect_spheres(packet, origins[rays], directions[rays], spheres))
+                rays = rays[~blocked[rays]]
+            if triangles.size and rays.size:
+                block(rays, intersect_triangles(packet, origins[rays], directions[rays], triangles - packet.sphere_count))
+                rays = rays[~blocked[rays]]
+            for global_id in others:
+                self._occlude_other(packet, blocked, rays[~blocked[rays]], origins, directions, max_distance, global_id)
+        return blocked
+
+    @staticmethod
+    def _occlude_other(
+            packet: PacketScene, blocked: np.ndarray, rays: np.ndarray, origins: np.ndarray, directions: np.ndarray,
+            max_distance: np.ndarray, global_id: int) -> None:
+        """Marks the rays an object of unknown type blocks, one ray at a time"""
+        obj = packet.other_objects[global_id]
+        for i in rays.tolist():
+            hit_distance, _ = obj.intersects(make_ray(origins[i], directions[i]))
+            if hit_distance is not None and 0 < hit_distance < max_distance[i]:
+                blocked[i] = True
+
+    @staticmethod
+    def _update(packet: PacketScene, best: list, rays: np.ndarray, distance: np.ndarray, primitives: np.ndarray) -> None:
+        """Keeps the closest hit per ray, ties going to the lowest key like the scalar engine
+        distance has one column per primitive, which must be sorted by key
+        """
+        column = distance.argmin(axis=1)
+        candidate = distance[np.arange(len(rays)), column]
+        candidate_id = primitives[column]
+        candidate_key = packet.key[candidate_id]
+        current = best[0][rays]
+        better = (candidate < current) | ((candidate == current) & (candidate_key < best[1][rays]))
+        better &= candidate < np.inf
+        rays = rays[better]
+        best[0][rays] = candidate[better]
+        best[1][rays] = candidate_key[better]
+        best[2][rays] = candidate_id[better]
+
+
+def make_ray(origin: np.ndarray, direction: np.ndarray) -> Ray:
+    """Builds a Ray without normalizing the direction again, for objects without a vectorized test"""
+    ray = Ray.__new__(Ray)
+    ray.origin = Point(*origin.tolist())
+    ray.direction = Point(*direction.tolist())
+    return ray
+
+
+def intersect_spheres(packet: PacketScene, origins: np.ndarray, directions: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Sphere.intersects for every (ray, sphere) pair, misses are infinite"""
+    center = packet.sphere_center[ids]
+    to_sphere = origins[:, None, :] - center[None, :, :]
+    d = directions[:, None, :]
+    b = 2 * dot(d, to_sphere)
+    c = dot(to_sphere, to_sphere) - packet.sphere_radius2[ids]
+    square = b * b
+    # b * b can differ from Python's b ** 2 in the last bit, which the subtraction below amplifies.
+    # Only pairs that may hit are recomputed with Python's pow, clear misses stay approximate.
+    candidates = (square - 4 * c) >= -1e-9 * (square + np.abs(4 * c))
+    square[candidates] = power(b[candidates], 2)
+    discriminant = square - (4 * c)
+    root = np.sqrt(discriminant)
+    near = (-b - root) / 2
+    far = (-b + root) / 2
+    distance = np.where(near > 0.001, near, np.where(far > 0.001, far, np.inf))
+    return np.where(discriminant >= 0, distance, np.inf)
+
+
+def intersect_planes(packet: PacketScene, origins: np.ndarray, directions: np.ndarray) -> np.ndarray:
+    """Plane.intersects for every (ray, plane) pair, misses are infinite"""
+    normal = packet.plane_normal[None, :, :]
+    denominator = dot(normal, directions[:, None, :])
+    distance = dot(normal, packet.plane_point[None, :, :] - origins[:, None, :]) / denominator
+    return np.where((np.abs(denominator) >= 0.001) & (distance > 0.001), distance, np.inf)
+
+
+def intersect_triangles(packet: PacketScene, origins: np.ndarray, directions: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Triangle.intersects for every (ray, triangle) pair, misses are infinite"""
+    EPSILON = 0.001
+    vertex = packet.triangle_vertex[ids][None, :, :]
+    edge1 = packet.triangle_edge1[ids][None, :, :]
+    edge2 = packet.triangle_edge2[ids][None, :, :]
+    dx, dy, dz = (directions[:, None, i] for i in range(3))
+    e1x, e1y, e1z = edge1[..., 0], edge1[..., 1], edge1[..., 2]
+    e2x, e2y, e2z = edge2[..., 0], edge2[..., 1], edge2[..., 2]
+    hx = dy * e2z - dz * e2y
+    hy = dz * e2x - dx * e2z
+    hz = dx * e2y - dy * e2x
+    a = (e1x * hx) + (e1y * hy) + (e1z * hz)
+    f = 1 / a
+    sx = origins[:, None, 0] - vertex[..., 0]
+    sy = origins[:, None, 1] - vertex[..., 1]
+    sz = origins[:, None, 2] - vertex[..., 2]
+    u = f * ((sx * hx) + (sy * hy) + (sz * hz))
+    qx = sy * e1z - sz * e1y
+    qy = sz * e1x - sx * e1z
+    qz = sx * e1y - sy * e1x
+    v = f * ((dx * qx) + (dy * qy) + (dz * qz))
+    t = f * ((e2x * qx) + (e2y * qy) + (e2z * qz))
+    valid = ~((-EPSILON < a) & (a < EPSILON)) & (u >= 0.0) & (u <= 1.0) & (v >= 0.0) & (u + v <= 1.0) & (t > EPSILON)
+    return np.where(valid, t, np.inf)